@@ -0,0 +1,760 @@
+import math
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from ss.cim.autotuner import Autotuner
+from ss.cim.board import Board
+from ss.cim.cell_index_method import CellIndexMethod
+from ss.cim.distance_matrix import DistanceMatrix
+from ss.cim.neighbor_view import NeighborView
+
+
+class ArrayCellIndexMethod:
+    """Cell Index Method working on X, Y and radius arrays instead of Particle objects. Particles are binned with a
+    counting sort (cell histogram + cumulative sum) and the half-shell stencil of every cell is checked in bulk with
+    NumPy. Neighbors are stored in CSR form: neighbors of particle i are `indices[offsets[i]:offsets[i+1]]`, at
+    `distances[offsets[i]:offsets[i+1]]`.
+
+    Accepts the same keyword arguments as CellIndexMethod (radius, width, height, m, mx, my, periodic, autotune,
+    tuning_cache), plus:
+        - workers: Number of row strips to search in parallel, balanced by particle count. Defaults to 1 (serial).
+        - pool: 'process' (default) to search strips in worker processes over shared memory, or 'thread'. The pool
+        and shared memory are kept for later searches, see #update; free them with #close or a `with` block.
+        - cutoffs: Radii (up to the interaction radius) to read neighbors within, see #neighbor_ends. Neighbors of
+        each particle are then sorted by distance instead of by index.
+        - obstacles: Static walls (see Obstacles) whose contacts with particles within the interaction radius are
+        found along with neighbors, see #walls.
+        - search_pairs: Whether to find every pair of particles within the interaction radius when built and on
+        #update. Defaults to True; with False particles are only binned, for instances used just for queries (e.g.
+        #knn), and neighbors aren't available."""
+
+    # Neighbor cells checked for each cell, as (delta_col, delta_row); the cell itself is checked separately. Same
+    # cells as Cell#getNeighborCells: above, above-right, right and below-right
+    HALF_SHELL = ((0, 1), (1, 1), (1, 0), (1, -1))
+
+    # Max number of candidate pairs checked at once, caps memory use for big frames
+    CHUNK_SIZE = 1 << 21
+
+    # Arrays that worker processes need to search a strip of the board, see #parallel_strip_pairs
+    SHARED_ARRAYS = ('xs', 'ys', 'radii', 'cell_ids', 'order', 'cell_start')
+    SHARED_ATTRIBUTES = ('interaction_radius', 'is_periodic', 'width', 'height', 'num_cols', 'num_rows')
+
+    def __init__(self, xs, ys, radii=None, **kwargs):
+        self.xs = np.asarray(xs, dtype=np.float64)
+        self.ys = np.asarray(ys, dtype=np.float64)
+        self.radii = np.zeros(len(self.xs)) if radii is None else np.asarray(radii, dtype=np.float64)
+        self.particles = kwargs.get('particles')
+        self.interaction_radius = kwargs['radius']
+        self.is_periodic = kwargs.get('periodic', False)
+        self.width = kwargs.get('width', -1)
+        self.height = kwargs.get('height', -1)
+        self.m = kwargs.get('m', -1)
+        # Parallel search: number of row strips searched at once, and whether to use a 'process' or 'thread' pool
+        self.workers = kwargs.get('workers', 1)
+        self.pool = kwargs.get('pool', 'process')
+        self.num_cols = kwargs.get('mx', -1)
+        self.num_rows = kwargs.get('my', -1)
+        self.autotune = kwargs.get('autotune', False)
+        self.tuning_cache = kwargs.get('tuning_cache')
+        self.cell_width = self.cell_height = -1
+        self.cell_ids = self.order = self.cell_start = None
+        self.pair_i = self.pair_j = self.pair_distances = None
+        self.offsets = self.indices = self.distances = None
+        self._neighbors = None
+        # Smaller radii answered by the same search, as prefixes of each particle's neighbors
+        self.cutoffs = np.sort(np.asarray(kwargs.get('cutoffs', []), dtype=np.float64))
+        if len(self.cutoffs) > 0 and self.cutoffs[-1] > self.interaction_radius:
+            raise Exception("Cutoffs can't be greater than the interaction radius (cutoff = %g, Rc = %g)"
+                            % (self.cutoffs[-1], self.interaction_radius))
+        self.cutoff_ends = None
+        self.obstacles = kwargs.get('obstacles')
+        if self.obstacles is not None and self.is_periodic:
+            raise Exception("Obstacles are not supported on periodic boards")
+        self.wall_i = self.wall_segments = self.wall_dx = self.wall_dy = self.wall_distances = None
+        self.search_pairs = kwargs.get('search_pairs', True)
+        # Worker pool and shared memory blocks of parallel searches, kept between searches (see #update) until #close
+        self.resources = {'executor': None, 'blocks': dict()}
+        weakref.finalize(self, _release, self.resources)
+
+        self.create_board()
+        self.check_particles_in_bounds()
+        self.bin()
+        if self.search_pairs:
+            self.calculate_neighbors()
+
+    @classmethod
+    def from_particles(cls, particles, **kwargs):
+        """Builds an instance from a list of Particles. `neighbors` is then keyed by particle ID and holds Particles,
+        just like CellIndexMethod#neighbors."""
+
+        xs = np.fromiter((p.x for p in particles), dtype=np.float64, count=len(particles))
+        ys = np.fromiter((p.y for p in particles), dtype=np.float64, count=len(particles))
+        radii = np.fromiter((p.radius for p in particles), dtype=np.float64, count=len(particles))
+        kwargs['particles'] = particles
+        return cls(xs, ys, radii, **kwargs)
+
+    @classmethod
+    def from_system(cls, system, **kwargs):
+        """Builds an instance from a ParticleSystem, using its position and radius arrays. `neighbors` is then keyed by
+        particle index and holds indices, like the arrays of the system."""
+
+        return cls(system.xs, system.ys, system.radii, **kwargs)
+
+    def update(self, xs=None, ys=None, radii=None, particles=None):
+        """Recalculates neighbors after particles moved, keeping this instance's board (size and number of cells, which
+        aren't chosen or tuned again) and options. Particles are binned again in bulk, see #bin.
+
+        :arg xs : (Optional) New X coordinates of the particles.
+        :arg ys : (Optional) New Y coordinates of the particles.
+        :arg radii : (Optional) New radii of the particles.
+        :arg particles : (Optional) New list of particles, for instances built with `from_particles` where particles
+                         are added, removed or replaced between steps. When built with `from_particles`, coordinates
+                         and radii that aren't given are read from the particles.
+        :return The updated offsets, indices and distances, see #calculate_neighbors, or None without `search_pairs`"""
+
+        self.set_particles(xs, ys, radii, particles)
+        self.check_particles_in_bounds()
+        self.bin()
+        if self.search_pairs:
+            return self.calculate_neighbors()
+
+    def set_particles(self, xs=None, ys=None, radii=None, particles=None):
+        """Replaces the coordinates and radii of the particles with the given ones, see #update for the arguments."""
+
+        if particles is not None:
+            self.particles = particles
+        if self.particles is not None and xs is None:
+            xs = np.fromiter((p.x for p in self.particles), dtype=np.float64, count=len(self.particles))
+            ys = np.fromiter((p.y for p in self.particles), dtype=np.float64, count=len(self.particles))
+        if self.particles is not None and radii is None:
+            radii = np.fromiter((p.radius for p in self.particles), dtype=np.float64, count=len(self.particles))
+        if xs is not None:
+            self.xs = np.asarray(xs, dtype=np.float64)
+        if ys is not None:
+            self.ys = np.asarray(ys, dtype=np.float64)
+        if radii is not None:
+            self.radii = np.asarray(radii, dtype=np.float64)
+        if not len(self.xs) == len(self.ys) == len(self.radii):
+            raise Exception("Got %i X coordinates, %i Y coordinates and %i radii, they must match"
+                            % (len(self.xs), len(self.ys), len(self.radii)))
+
+    def create_board(self):
+        """Fills in missing board parameters (width, height, M) and computes the number of columns (Mx) and rows (My),
+        see CellIndexMethod#cell_counts."""
+
+        if self.width == -1 or self.height == -1:
+            if len(self.xs) == 0:
+                raise Exception("Can't calculate board size without particles, specify width and height")
+            if self.width == -1:
+                self.width = float(self.xs.max()) + Board.EPSILON
+            if self.height == -1:
+                self.height = float(self.ys.max()) + Board.EPSILON
+
+        l = max(self.width, self.height)
+        if self.m == -1 and self.autotune and (self.num_cols == -1 or self.num_rows == -1):
+            self.m = self.tune_m()
+        if self.m != -1:
+            if self.m <= 0 or l / self.m <= self.interaction_radius:
+                raise Exception("L / M > Rc is not met, can't perform cell index method, aborting. (L = %g, M = %g, "
+                                "Rc = %g)" % (l, self.m, self.interaction_radius))
+            # Round down so cells are at least L / M long on both axes (tolerance protects the longest side from
+            # floating point error)
+            num_cols = max(1, math.floor(self.width / l * self.m + 1e-9))
+            num_rows = max(1, math.floor(self.height / l * self.m + 1e-9))
+        else:
+            max_radius = float(self.radii.max()) if len(self.radii) > 0 else 0
+            num_cols = max(1, CellIndexMethod.optimal_m(self.width, self.interaction_radius, max_radius))
+            num_rows = max(1, CellIndexMethod.optimal_m(self.height, self.interaction_radius, max_radius))
+
+        self.num_cols = self.num_cols if self.num_cols != -1 else num_cols
+        self.num_rows = self.num_rows if self.num_rows != -1 else num_rows
+        self.m = self.num_cols if self.width >= self.height else self.num_rows
+        self.cell_width = self.width / self.num_cols
+        self.cell_height = self.height / self.num_rows
+        if self.cell_width <= self.interaction_radius and self.num_cols > 1 or \
+                self.cell_height <= self.interaction_radius and self.num_rows > 1:
+            raise Exception("W / Mx > Rc and H / My > Rc are not met, can't perform cell index method, aborting. "
+                            "(W = %g, H = %g, Mx = %g, My = %g, Rc = %g)" % (self.width, self.height, self.num_cols,
+                                                                              self.num_rows, self.interaction_radius))
+
+    def tune_m(self):
+        """Chooses M with an Autotuner, timing searches on this instance's particles."""
+
+        def build(m):
+            ArrayCellIndexMethod(self.xs, self.ys, self.radii, radius=self.interaction_radius, width=self.width,
+                                 height=self.height, periodic=self.is_periodic, workers=self.workers, pool=self.pool,
+                                 m=m).close()
+
+        max_radius = float(self.radii.max()) if len(self.radii) > 0 else 0
+        tuner = Autotuner(cache_file=self.tuning_cache)
+        return tuner.best_m(len(self.xs), self.width, self.height, self.interaction_radius + 2 * max_radius,
+                            CellIndexMethod.optimal_m(max(self.width, self.height), self.interaction_radius, max_radius),
+                            self.is_periodic, build)
+
+    def check_particles_in_bounds(self):
+        outside = (self.xs < 0) | (self.ys < 0) | (self.xs > self.width) | (self.ys > self.height)
+        if outside.any():
+            i = int(np.flatnonzero(outside)[0])
+            raise Exception("Particle #%i @ (%g, %g) is out of board bounds, board height: %g, board width: %g"
+                            % (i, self.xs[i], self.ys[i], self.height, self.width))
+
+    def to_cells(self, xs, ys):
+        """Converts arrays of X and Y coordinates to arrays of (col, row) cell coordinates."""
+
+        cols = np.minimum((xs / self.cell_width).astype(np.int64), self.num_cols - 1)
+        rows = np.minimum((ys / self.cell_height).astype(np.int64), self.num_rows - 1)
+        return cols, rows
+
+    def bin(self):
+        """Sorts particles by cell. After this, particles in cell c are `order[cell_start[c]:cell_start[c+1]]`, with
+        cells numbered row by row."""
+
+        cols, rows = self.to_cells(self.xs, self.ys)
+        self.cell_ids = rows * self.num_cols + cols
+        counts = np.bincount(self.cell_ids, minlength=self.num_cols * self.num_rows)
+        self.cell_start = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.cell_start[1:])
+        self.order = np.argsort(self.cell_ids, kind='stable')
+
+    def shift_cells(self, cols, rows, delta_col, delta_row):
+        """Returns the IDs of the cells at the given offset from the given cells, and a mask telling which of those are
+        within the board (always true for periodic boards). IDs of cells outside the board are 0."""
+
+        cols, rows = cols + delta_col, rows + delta_row
+        if self.is_periodic:
+            cols %= self.num_cols
+            rows %= self.num_rows
+            valid = np.ones(len(cols), dtype=bool)
+        else:
+            valid = (0 <= cols) & (cols < self.num_cols) & (0 <= rows) & (rows < self.num_rows)
+        return np.where(valid, rows * self.num_cols + cols, 0), valid
+
+    def candidate_pairs(self, first=0, last=None):
+        """Generates chunks of (i, j) arrays pairing the particles at sorted positions [first, last) (see #bin, all
+        particles by default) with the particles in their cell and in half-shell neighbor cells. Each pair appears
+        once, except in periodic boards with less than 3 rows or columns, where wrapped neighbor cells may repeat."""
+
+        for homes, firsts, lengths in self.stencil_ranges(first, last):
+            for chunk_homes, chunk_js in self.expand_ranges(homes, firsts, lengths):
+                yield self.order[chunk_homes], self.order[chunk_js]
+
+    def cell_coordinates(self, cells):
+        """Converts an array of cell IDs to arrays of (col, row) cell coordinates."""
+
+        return cells % self.num_cols, cells // self.num_cols
+
+    def stencil_ranges(self, first=0, last=None):
+        """For each cell of the stencil (the particle's own cell first, then the half shell), generates the
+        (home, first, length) ranges of sorted positions to pair each particle at sorted positions [first, last) with.
+        In its own cell, a particle is only paired with the particles after it to get each pair once."""
+
+        counts = np.diff(self.cell_start)
+        positions = np.arange(first, len(self.xs) if last is None else last)
+        sorted_cells = self.cell_ids[self.order[positions]]
+        cols, rows = self.cell_coordinates(sorted_cells)
+
+        ranges = [(positions + 1, self.cell_start[sorted_cells + 1] - positions - 1)]
+        for delta_col, delta_row in self.HALF_SHELL:
+            neighbor_cells, valid = self.shift_cells(cols, rows, delta_col, delta_row)
+            ranges.append((self.cell_start[neighbor_cells], np.where(valid, counts[neighbor_cells], 0)))
+
+        for firsts, lengths in ranges:
+            keep = lengths > 0
+            yield positions[keep], firsts[keep], lengths[keep]
+
+    def surrounding_pairs(self, xs, ys, reach_cols=1, reach_rows=1):
+        """Generates chunks of (q, j) arrays pairing each of the given points (q indexes `xs` and `ys`) with every
+        particle in the point's cell and in the cells up to `reach_cols` columns and `reach_rows` rows away from it (the
+        8 cells around it by default). Each couple appears once, even on small periodic boards."""
+
+        cols, rows = self.to_cells(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        offsets = [(delta_col, delta_row) for delta_col in self.stencil_offsets(self.num_cols, reach_cols)
+                   for delta_row in self.stencil_offsets(self.num_rows, reach_rows)]
+        return self.offset_pairs(cols, rows, offsets)
+
+    def offset_pairs(self, cols, rows, offsets):
+        """Generates chunks of (q, j) arrays pairing each of the given (col, row) cells (q indexes `cols` and `rows`)
+        with every particle in the cells at the given (delta_col, delta_row) offsets from it."""
+
+        counts = np.diff(self.cell_start)
+        firsts, lengths = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for delta_col, delta_row in offsets:
+            neighbor_cells, valid = self.shift_cells(cols, rows, delta_col, delta_row)
+            firsts.append(self.cell_start[neighbor_cells])
+            lengths.append(np.where(valid, counts[neighbor_cells], 0))
+
+        homes = np.tile(np.arange(len(cols)), len(firsts) - 1)
+        firsts, lengths = np.concatenate(firsts), np.concatenate(lengths)
+        keep = lengths > 0
+        for chunk_homes, chunk_js in self.expand_ranges(homes[keep], firsts[keep], lengths[keep]):
+            yield chunk_homes, self.order[chunk_js]
+
+    def stencil_offsets(self, num_cells, reach=1):
+        """Cell offsets up to `reach` cells away to check along an axis with the given number of cells. On periodic
+        boards where the offsets would wrap around to the same cells, each cell is listed once."""
+
+        if self.is_periodic and 2 * reach + 1 > num_cells:
+            return range(num_cells)
+        return range(-reach, reach + 1)
+
+    def query_radius(self, x, y, r):
+        """Particles whose border is within distance r of the point (x, y). Only the cells around the point are
+        checked.
+
+        :return (indices, distances) arrays sorted by index, distances being measured from the point to the border of
+        each particle (negative for particles covering the point)."""
+
+        _, indices, distances = self.query_radius_batch([x], [y], r)
+        return indices, distances
+
+    def query_radius_batch(self, xs, ys, r):
+        """Like #query_radius for many points at once.
+
+        :arg xs : X coordinates of the query points.
+        :arg ys : Y coordinates of the query points.
+        :arg r : Query radius, either one for all points or an array with one for each point.
+        :return CSR arrays (offsets, indices, distances): particles near point q are
+        `indices[offsets[q]:offsets[q+1]]`, sorted by index, at `distances[offsets[q]:offsets[q+1]]`."""
+
+        xs, ys = self.to_board(xs, ys)
+        rs = np.broadcast_to(np.asarray(r, dtype=np.float64), xs.shape)
+        reach = float(rs.max()) + float(self.radii.max()) if len(xs) > 0 and len(self.radii) > 0 else 0
+
+        found_q, found_j, found_distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for q, j in self.surrounding_pairs(xs, ys, math.ceil(reach / self.cell_width),
+                                           math.ceil(reach / self.cell_height)):
+            dx, dy = self.wrap(self.xs[j] - xs[q], self.ys[j] - ys[q])
+            distances = np.hypot(dx, dy) - self.radii[j]
+            accepted = distances <= rs[q]
+            found_q.append(q[accepted])
+            found_j.append(j[accepted])
+            found_distances.append(distances[accepted])
+
+        return self.to_csr(np.concatenate(found_q), np.concatenate(found_j), np.concatenate(found_distances), len(xs))
+
+    def query_box(self, x_min, y_min, x_max, y_max):
+        """Indices (sorted) of the particles that overlap the given box. On periodic boards, the box may go past the
+        board's edges and wrap around. Only the cells around the box are checked."""
+
+        half_width, half_height = (x_max - x_min) / 2, (y_max - y_min) / 2
+        xs, ys = self.to_board([x_min + half_width], [y_min + half_height])
+        max_radius = float(self.radii.max()) if len(self.radii) > 0 else 0
+
+        found = [np.zeros(0, dtype=np.int64)]
+        for q, j in self.surrounding_pairs(xs, ys, math.ceil((half_width + max_radius) / self.cell_width),
+                                           math.ceil((half_height + max_radius) / self.cell_height)):
+            dx, dy = self.wrap(self.xs[j] - xs[q], self.ys[j] - ys[q])
+            # Distance from the center of each particle to the closest point of the box
+            dx, dy = np.maximum(np.abs(dx) - half_width, 0), np.maximum(np.abs(dy) - half_height, 0)
+            found.append(j[np.hypot(dx, dy) <= self.radii[j]])
+        return np.sort(np.concatenate(found))
+
+    def knn(self, k):
+        """The k nearest neighbors of every particle (not counting itself), see #query_knn."""
+
+        return self.query_knn(self.xs, self.ys, k, exclude=np.arange(len(self.xs)))
+
+    def query_knn(self, xs, ys, k, exclude=None):
+        """The k particles nearest to each of the given points, for topological neighborhoods. Rings of cells around
+        each point are checked outwards until the k-th nearest particle found so far is closer than any particle in
+        the cells not yet checked, so with evenly spread particles only a few rings are needed for small k, whatever
+        the interaction radius. Works with periodic boards, using the minimum image.
+
+        :arg xs : X coordinates of the query points.
+        :arg ys : Y coordinates of the query points.
+        :arg k : Number of neighbors to find for each point.
+        :arg exclude : (Optional) Index of a particle to leave out for each point, e.g. the particle at the point.
+        :return (indices, distances) arrays of shape (len(xs), k), each row sorted by distance (then by index).
+        Distances are measured from the point to the border of each particle, like #query_radius. Rows are padded
+        with index -1 and distance inf when there are less than k particles."""
+
+        xs, ys = self.to_board(xs, ys)
+        n = len(xs)
+        best = np.full((n, k), -1, dtype=np.int64)
+        best_distances = np.full((n, k), np.inf)
+        if n == 0 or k <= 0:
+            return best, best_distances
+        exclude = None if exclude is None else np.asarray(exclude, dtype=np.int64)
+        max_radius = float(self.radii.max()) if len(self.radii) > 0 else 0
+        cols, rows = self.to_cells(xs, ys)
+        (first_col, last_col), (first_row, last_row) = self.cell_bounds()
+
+        active = np.arange(n)
+        checked = set()
+        reach = 0
+        while len(active) > 0:
+            found_q, found_j, found_distances = [active.repeat(k)], [best[active].ravel()], \
+                [best_distances[active].ravel()]
+            for q, j in self.offset_pairs(cols[active], rows[active], self.ring_offsets(reach, checked)):
+                q = active[q]
+                if exclude is not None:
+                    kept = j != exclude[q]
+                    q, j = q[kept], j[kept]
+                dx, dy = self.wrap(self.xs[j] - xs[q], self.ys[j] - ys[q])
+                found_q.append(q)
+                found_j.append(j)
+                found_distances.append(np.hypot(dx, dy) - self.radii[j])
+
+            # Keep the k nearest of the previous best and the new candidates of each point
+            q, j, distances = np.concatenate(found_q), np.concatenate(found_j), np.concatenate(found_distances)
+            order = np.lexsort((np.where(j < 0, len(self.xs), j), distances, q))
+            q, j, distances = q[order], j[order], distances[order]
+            group_starts = np.flatnonzero(np.r_[True, q[1:] != q[:-1]])
+            ranks = np.arange(len(q)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(q)]))
+            kept = ranks < k
+            best[q[kept], ranks[kept]] = j[kept]
+            best_distances[q[kept], ranks[kept]] = distances[kept]
+
+            # Particles in unchecked cells are farther than the distance from the point to the checked region
+            bound = np.minimum(self.ring_bound(xs[active], cols[active], reach, self.cell_width, first_col, last_col),
+                               self.ring_bound(ys[active], rows[active], reach, self.cell_height, first_row,
+                                               last_row))
+            active = active[best_distances[active, -1] > bound - max_radius]
+            reach += 1
+
+        return best, best_distances
+
+    def ring_offsets(self, reach, checked):
+        """Offsets of the cells exactly `reach` cells away (the ring around the cells checked so far), skipping those
+        in `checked` and adding the rest to it. On periodic boards, offsets that wrap around to an already checked cell
+        are skipped too."""
+
+        result = []
+        for delta_col in range(-reach, reach + 1):
+            for delta_row in range(-reach, reach + 1):
+                if max(abs(delta_col), abs(delta_row)) != reach:
+                    continue
+                key = (delta_col % self.num_cols, delta_row % self.num_rows) if self.is_periodic else \
+                    (delta_col, delta_row)
+                if key not in checked:
+                    checked.add(key)
+                    result.append((delta_col, delta_row))
+        return result
+
+    def cell_bounds(self):
+        """Returns the ((first, last) column, (first, last) row) range of cells that may hold particles."""
+
+        return (0, self.num_cols - 1), (0, self.num_rows - 1)
+
+    def ring_bound(self, coordinates, cells, reach, cell_side, first_cell, last_cell):
+        """Distance along an axis from each coordinate to the closest cell (within [first_cell, last_cell]) more than
+        `reach` cells away from its cell, inf if there is no such cell."""
+
+        if self.is_periodic:
+            if 2 * reach + 1 >= last_cell - first_cell + 1:
+                return np.full(len(coordinates), np.inf)
+            return np.minimum(coordinates - (cells - reach) * cell_side, (cells + reach + 1) * cell_side - coordinates)
+        lower = np.where(cells - reach > first_cell, coordinates - (cells - reach) * cell_side, np.inf)
+        upper = np.where(cells + reach < last_cell, (cells + reach + 1) * cell_side - coordinates, np.inf)
+        return np.minimum(lower, upper)
+
+    def to_board(self, xs, ys):
+        """Converts query coordinates to arrays, wrapping them into the board on periodic boards."""
+
+        xs, ys = np.atleast_1d(np.asarray(xs, dtype=np.float64)), np.atleast_1d(np.asarray(ys, dtype=np.float64))
+        if self.is_periodic:
+            xs, ys = xs % self.width, ys % self.height
+        return xs, ys
+
+    @classmethod
+    def expand_ranges(cls, homes, firsts, lengths):
+        """Expands (home, first, length) ranges to (home, first + k) pairs for 0 <= k < length, in chunks of about
+        CHUNK_SIZE pairs."""
+
+        ends = np.cumsum(lengths)
+        start = 0
+        while start < len(lengths):
+            done = ends[start - 1] if start > 0 else 0
+            end = max(int(np.searchsorted(ends, done + cls.CHUNK_SIZE, side='right')), start + 1)
+            chunk_lengths = lengths[start:end]
+            chunk_starts = np.cumsum(chunk_lengths) - chunk_lengths
+            js = np.repeat(firsts[start:end] - chunk_starts, chunk_lengths) + np.arange(int(chunk_lengths.sum()))
+            yield np.repeat(homes[start:end], chunk_lengths), js
+            start = end
+
+    def displacements(self, i, j):
+        """Returns (dx, dy) arrays from particles i to particles j, using the minimum image on periodic boards."""
+
+        return self.wrap(self.xs[j] - self.xs[i], self.ys[j] - self.ys[i])
+
+    def wrap(self, dx, dy):
+        """Applies the minimum image convention to arrays of displacements on periodic boards."""
+
+        if self.is_periodic:
+            dx = dx - self.width * np.round(dx / self.width)
+            dy = dy - self.height * np.round(dy / self.height)
+        return dx, dy
+
+    def calculate_pairs(self):
+        """Calculates every pair of particles within the interaction radius of each other. Returns (i, j, distances)
+        arrays, where distances are measured between particle borders like Particle#distance_to. With more than one
+        worker, row strips of the board are searched in parallel, with the same result as a serial search."""
+
+        if self.workers > 1 and self.num_rows > 1:
+            strips = self.parallel_strip_pairs()
+        else:
+            strips = [self.strip_pairs(0, len(self.xs))]
+
+        # Merge cell offset by cell offset, which gives pairs in the same order as a single strip with every particle
+        found = [strip[offset] for offset in range(len(self.HALF_SHELL) + 1) for strip in strips]
+        i = np.concatenate([pairs[0] for pairs in found])
+        j = np.concatenate([pairs[1] for pairs in found])
+        distances = np.concatenate([pairs[2] for pairs in found])
+
+        if self.is_periodic and (self.num_cols < 3 or self.num_rows < 3):
+            # Wrapped neighbor cells may repeat (or be the cell itself), drop self-pairs and repeated pairs
+            i, j = np.minimum(i, j), np.maximum(i, j)
+            _, unique = np.unique(i * len(self.xs) + j, return_index=True)
+            unique = unique[i[unique] != j[unique]]
+            i, j, distances = i[unique], j[unique], distances[unique]
+
+        return i, j, distances
+
+    def strip_pairs(self, first, last):
+        """Finds the pairs within the interaction radius for the particles at sorted positions [first, last), checking
+        their cell and half shell. Returns a list with (i, j, distances) arrays for each cell offset of the stencil."""
+
+        result = []
+        for homes, firsts, lengths in self.stencil_ranges(first, last):
+            found_i, found_j, found_distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], \
+                [np.zeros(0)]
+            for chunk_homes, chunk_js in self.expand_ranges(homes, firsts, lengths):
+                i, j = self.order[chunk_homes], self.order[chunk_js]
+                dx, dy = self.displacements(i, j)
+                distances = np.hypot(dx, dy) - self.radii[i] - self.radii[j]
+                accepted = distances <= self.interaction_radius
+                found_i.append(i[accepted])
+                found_j.append(j[accepted])
+                found_distances.append(distances[accepted])
+            result.append((np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_distances)))
+        return result
+
+    def strips(self):
+        """Splits the board in up to `workers` strips of whole cell rows, with about the same number of particles
+        each. Returns a list of [first, last) ranges of sorted positions, see #bin."""
+
+        n = len(self.xs)
+        row_starts = self.cell_start[::self.num_cols]
+        targets = np.arange(1, self.workers) * n / self.workers
+        bounds = row_starts[np.searchsorted(row_starts, targets)]
+        bounds = np.unique(np.concatenate(([0], bounds, [n])))
+        return [(int(first), int(last)) for first, last in zip(bounds[:-1], bounds[1:])]
+
+    def parallel_strip_pairs(self):
+        """Runs #strip_pairs for each strip in a worker pool and returns the results in strip order. Strips need the
+        row above and below them (their halo), so workers get the whole board: threads share this instance's arrays,
+        processes attach to a shared memory copy of them."""
+
+        strips = self.strips()
+        executor = self.executor()
+        if self.pool == 'thread':
+            return list(executor.map(lambda strip: self.strip_pairs(*strip), strips))
+
+        state = self.share()
+        futures = [executor.submit(_shared_strip_pairs, state, first, last) for first, last in strips]
+        return [future.result() for future in futures]
+
+    def executor(self):
+        """Worker pool of parallel searches, started on the first one and kept until #close."""
+
+        if self.resources['executor'] is None:
+            self.resources['executor'] = ThreadPoolExecutor(self.workers) if self.pool == 'thread' \
+                else ProcessPoolExecutor(self.workers)
+        return self.resources['executor']
+
+    def share(self):
+        """Copies the arrays needed by #strip_pairs to shared memory. Blocks are kept until #close and reused by later
+        searches, getting a new one only for arrays that outgrew theirs. Returns the state needed to rebuild an
+        instance that uses them, see _shared_strip_pairs."""
+
+        blocks, arrays = self.resources['blocks'], dict()
+        for name in self.SHARED_ARRAYS:
+            array = getattr(self, name)
+            block = blocks.get(name)
+            if block is None or block.size < array.nbytes:
+                if block is not None:
+                    block.close()
+                    block.unlink()
+                # Leave room to grow, so arrays that change size between updates rarely need a new block
+                block = blocks[name] = SharedMemory(create=True, size=max(1, 2 * array.nbytes))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            arrays[name] = (block.name, array.shape, array.dtype.str)
+
+        attributes = {name: getattr(self, name) for name in self.SHARED_ATTRIBUTES}
+        return {'class': type(self), 'arrays': arrays, 'attributes': attributes}
+
+    def close(self):
+        """Stops the worker pool and frees the shared memory of parallel searches. Searching again (e.g. on #update)
+        starts them again. Also done when the instance is garbage collected."""
+
+        _release(self.resources)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def calculate_neighbors(self):
+        """Calculates neighbors of every particle and stores them in CSR form, in `offsets`, `indices` and `distances`.
+        Neighbors of each particle are sorted by index, or by distance (and then by index) when there are cutoffs, in
+        which case the end of each particle's neighbors within each cutoff is stored in `cutoff_ends`."""
+
+        self.pair_i, self.pair_j, self.pair_distances = self.calculate_pairs()
+        self.offsets, self.indices, self.distances = self.to_csr(
+            np.concatenate((self.pair_i, self.pair_j)), np.concatenate((self.pair_j, self.pair_i)),
+            np.concatenate((self.pair_distances, self.pair_distances)), len(self.xs), by_value=len(self.cutoffs) > 0)
+        self.cutoff_ends = np.array([self.count_within(cutoff) for cutoff in self.cutoffs], dtype=np.int64) \
+            .reshape(len(self.cutoffs), len(self.xs))
+        self._neighbors = None
+        if self.obstacles is not None:
+            self.wall_i, self.wall_segments, self.wall_dx, self.wall_dy, self.wall_distances = \
+                self.obstacles.find_contacts(self.xs, self.ys, self.radii, self.interaction_radius)
+
+        return self.offsets, self.indices, self.distances
+
+    def count_within(self, cutoff):
+        """Ends of each particle's neighbors within the given cutoff, neighbors being sorted by distance."""
+
+        rows = np.repeat(np.arange(len(self.xs)), np.diff(self.offsets))
+        return self.offsets[:-1] + np.bincount(rows[self.distances <= cutoff], minlength=len(self.xs))
+
+    def neighbor_ends(self, cutoff):
+        """Ends of each particle's neighbors within the given cutoff: neighbors of particle i within it are
+        `indices[offsets[i]:ends[i]]`, at `distances[offsets[i]:ends[i]]`, the closest ones first. Free for one of the
+        `cutoffs` the search was built with, and a single pass over the neighbors for any other cutoff up to the
+        interaction radius."""
+
+        if len(self.cutoffs) == 0:
+            raise Exception("Neighbors are only sorted by distance when built with cutoffs")
+        if cutoff > self.interaction_radius:
+            raise Exception("Cutoff can't be greater than the interaction radius (cutoff = %g, Rc = %g)"
+                            % (cutoff, self.interaction_radius))
+        k = int(np.searchsorted(self.cutoffs, cutoff))
+        if k < len(self.cutoffs) and self.cutoffs[k] == cutoff:
+            return self.cutoff_ends[k]
+        return self.count_within(cutoff)
+
+    def neighbors_within(self, cutoff):
+        """Neighbors within the given cutoff, in the same form as #neighbors and sharing its arrays, see
+        #neighbor_ends."""
+
+        ends = self.neighbor_ends(cutoff)
+        if self.particles is None:
+            return NeighborView(self.offsets, self.indices, self.distances, ends=ends)
+        return NeighborView(self.offsets, self.indices, self.distances, keys=[p.id for p in self.particles],
+                            items=self.particles, ends=ends)
+
+    @staticmethod
+    def to_csr(rows, cols, values, num_rows, by_value=False):
+        """Converts (row, col, value) entries to CSR arrays (offsets, indices, values), sorted by row and then by col,
+        or by row, value and then col if `by_value`."""
+
+        order = np.lexsort((cols, values, rows)) if by_value else np.lexsort((cols, rows))
+        offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_rows), out=offsets[1:])
+        return offsets, cols[order], values[order]
+
+    def distance_matrix(self):
+        """Neighbor distances as a sparse symmetric DistanceMatrix, sharing this instance's CSR arrays unless they are
+        sorted by distance (see `cutoffs`), since matrix columns are sorted by index."""
+
+        ids = None if self.particles is None else [p.id for p in self.particles]
+        if len(self.cutoffs) > 0:
+            return DistanceMatrix.from_pairs(self.pair_i, self.pair_j, self.pair_distances, len(self.xs), ids)
+        return DistanceMatrix(self.offsets, self.indices, self.distances, ids)
+
+    def pair_arrays(self):
+        """Returns every pair of neighbors exactly once, as arrays (i, j, dx, dy, distances), where (dx, dy) goes from
+        particle i to particle j."""
+
+        dx, dy = self.displacements(self.pair_i, self.pair_j)
+        return self.pair_i, self.pair_j, dx, dy, self.pair_distances
+
+    def pairs(self):
+        """Iterates over every pair of neighbors exactly once, as (p1, p2, dx, dy, distance) tuples. p1 and p2 are
+        Particles when built with `from_particles`, indices otherwise."""
+
+        i, j, dx, dy, distances = self.pair_arrays()
+        firsts, seconds = i.tolist(), j.tolist()
+        if self.particles is not None:
+            firsts = [self.particles[k] for k in firsts]
+            seconds = [self.particles[k] for k in seconds]
+        return zip(firsts, seconds, dx.tolist(), dy.tolist(), distances.tolist())
+
+    def wall_arrays(self):
+        """Returns every contact between a particle and a wall within the interaction radius, as arrays (i, segments,
+        dx, dy, distances), where segments are indices of walls in `obstacles`, (dx, dy) goes from particle i to the
+        closest point of the wall and distances are measured from the particle's border."""
+
+        return self.wall_i, self.wall_segments, self.wall_dx, self.wall_dy, self.wall_distances
+
+    def walls(self):
+        """Iterates over every contact between a particle and a wall, as (particle, segment, dx, dy, distance) tuples
+        (see #wall_arrays). Particles are Particles when built with `from_particles`, indices otherwise."""
+
+        firsts = self.wall_i.tolist()
+        if self.particles is not None:
+            firsts = [self.particles[k] for k in firsts]
+        return zip(firsts, self.wall_segments.tolist(), self.wall_dx.tolist(), self.wall_dy.tolist(),
+                   self.wall_distances.tolist())
+
+    @property
+    def neighbors(self):
+        """Neighbors in the same form as CellIndexMethod#neighbors. Keyed by particle ID with Particles as neighbors
+        when built with `from_particles`, keyed by index with indices as neighbors otherwise. Built lazily."""
+
+        if self._neighbors is None:
+            if self.particles is None:
+                self._neighbors = NeighborView(self.offsets, self.indices, self.distances)
+            else:
+                self._neighbors = NeighborView(self.offsets, self.indices, self.distances,
+                                               keys=[p.id for p in self.particles], items=self.particles)
+        return self._neighbors
+
+    def get_distances(self, id):
+        """List with distances of particle with id to its corresponding neighbors"""
+        return [x[1] for x in self.neighbors[id]]
+
+    def __str__(self):
+        counts = np.diff(self.cell_start).reshape(self.num_rows, self.num_cols)
+        result = ""
+        for row in reversed(range(self.num_rows)):
+            result += '|'
+            for col in range(self.num_cols):
+                result += "%i|" % counts[row, col]
+            result += "\n"
+        return result
+
+
+def _shared_strip_pairs(state, first, last):
+    """Worker process entry point: searches a strip of a board shared with ArrayCellIndexMethod#share."""
+
+    blocks = []
+    grid = state['class'].__new__(state['class'])
+    grid.__dict__.update(state['attributes'])
+    try:
+        for name, (block_name, shape, dtype) in state['arrays'].items():
+            blocks.append(SharedMemory(name=block_name))
+            setattr(grid, name, np.ndarray(shape, dtype=dtype, buffer=blocks[-1].buf))
+        return grid.strip_pairs(first, last)
+    finally:
+        # Views on the shared memory must be gone before closing it
+        del grid
+        for block in blocks:
+            block.close()
+
+
+def _release(resources):
+    """Stops the worker pool and frees the shared memory blocks of an ArrayCellIndexMethod, see #close."""
+
+    if resources['executor'] is not None:
+        resources['executor'].shutdown()
+        resources['executor'] = None
+    for block in resources['blocks'].values():
+        block.close()
+        block.unlink()
+    resources['blocks'].clear()
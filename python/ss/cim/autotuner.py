@@ -0,0 +1,108 @@
+import json
+import math
+import os
+import time
+
+
+class Autotuner:
+    """Chooses M (cells per longest side) for the Cell Index Method. Every valid M (see CellIndexMethod#optimal_m) is
+    ranked with a cost model of the work done by a neighbor search, and the best few are then timed with the actual
+    particles. M = 1 puts every particle in a single cell, which is the brute force method, so small N gets brute force
+    whenever it's cheaper. Choices are cached per (N, width, height, Rc, periodic) profile, in memory and optionally in a
+    JSON file so later runs start from the fastest configuration."""
+
+    # Cost model weights, in units of the time it takes to check a candidate pair. Visiting a cell (and its half shell)
+    # and placing a particle in its cell are several times more expensive than checking a pair
+    PAIR_COST = 1
+    CELL_COST = 4
+    PARTICLE_COST = 3
+
+    # Profile => best M, shared by all autotuners so repeated searches with the same profile are only tuned once
+    CACHE = dict()
+
+    def __init__(self, **kwargs):
+        """
+        :arg cache_file : (Optional) JSON file where choices are saved, and loaded from if it exists.
+        :arg benchmark : Whether to time the best candidates (True by default) or trust the cost model.
+        :arg candidates : Number of best ranked candidates to time, 3 by default.
+        :arg repetitions : Number of times each candidate is timed (keeping the best time), 1 by default.
+        """
+        self.cache_file = kwargs.get('cache_file')
+        self.benchmark = kwargs.get('benchmark', True)
+        self.candidates = kwargs.get('candidates', 3)
+        self.repetitions = kwargs.get('repetitions', 1)
+        self.timings = dict()   # M => seconds, of the last benchmark
+        if self.cache_file is not None and os.path.isfile(self.cache_file):
+            with open(self.cache_file) as file:
+                self.CACHE.update(json.load(file))
+
+    @staticmethod
+    def profile(n, width, height, radius, periodic):
+        """Key of the cache for a given problem. `radius` is the distance at which particles must be found, i.e.
+        the interaction radius plus twice the biggest particle radius (and the skin, in Verlet list mode)."""
+
+        return "%i,%g,%g,%g,%s" % (n, width, height, radius, periodic)
+
+    @classmethod
+    def cell_counts(cls, width, height, m):
+        """Cells along the width and the height for M cells per longest side, like CellIndexMethod#cell_counts."""
+
+        l = max(width, height)
+        return max(1, math.floor(width / l * m + 1e-9)), max(1, math.floor(height / l * m + 1e-9))
+
+    @classmethod
+    def estimate(cls, n, width, height, periodic, m):
+        """Estimated cost of a neighbor search with M cells per longest side, assuming uniformly spread particles."""
+
+        mx, my = cls.cell_counts(width, height, m)
+        cells = mx * my
+        per_cell = n / cells
+        if periodic:
+            # Every cell has its 4 half shell neighbors, though small boards have repeated ones that are checked once
+            neighbor_couples = len({(dc % mx, dr % my) for dc, dr in ((0, 1), (1, 1), (1, 0), (1, -1))} - {(0, 0)}) * \
+                cells
+        else:
+            neighbor_couples = (mx - 1) * my + mx * (my - 1) + 2 * (mx - 1) * (my - 1)
+        pair_checks = cells * per_cell * max(per_cell - 1, 0) / 2 + neighbor_couples * per_cell ** 2
+        return pair_checks * cls.PAIR_COST + cells * cls.CELL_COST + n * cls.PARTICLE_COST
+
+    def best_m(self, n, width, height, radius, max_m, periodic=False, build=None):
+        """Best M for a problem, from the cache if this profile was already tuned.
+
+        :arg n : Number of particles.
+        :arg width : Board width.
+        :arg height : Board height.
+        :arg radius : Distance at which particles must be found, see #profile.
+        :arg max_m : Biggest valid M, see CellIndexMethod#optimal_m.
+        :arg periodic : Whether the board is periodic.
+        :arg build : (Optional) Function that runs a neighbor search with a given M, used to time the best candidates.
+        :return The chosen M"""
+
+        key = self.profile(n, width, height, radius, periodic)
+        if key in self.CACHE:
+            return self.CACHE[key]
+
+        candidates = sorted(range(1, max(1, max_m) + 1), key=lambda m: self.estimate(n, width, height, periodic, m))
+        best = candidates[0]
+        self.timings = dict()
+        if self.benchmark and build is not None and len(candidates) > 1:
+            for m in candidates[:self.candidates]:
+                self.timings[m] = min(self.time(build, m) for _ in range(self.repetitions))
+            best = min(self.timings, key=self.timings.get)
+
+        self.CACHE[key] = best
+        self.save()
+        return best
+
+    @staticmethod
+    def time(build, m):
+        start = time.perf_counter()
+        build(m)
+        return time.perf_counter() - start
+
+    def save(self):
+        """Writes the cache to the cache file, if any."""
+
+        if self.cache_file is not None:
+            with open(self.cache_file, 'w') as file:
+                json.dump(self.CACHE, file, indent=1, sort_keys=True)
@@ -0,0 +1,70 @@
+"""Benchmark of the array-based Cell Index Method on random particles, stored in generation order and then sorted along a
+space-filling curve. Reports neighbor search and force pass times, and the locality of neighbor pairs in memory."""
+
+import time
+
+import numpy as np
+
+import ss.util.args as arg_base
+from ss.cim.array_cell_index_method import ArrayCellIndexMethod
+from ss.cim.particle_system import ParticleSystem
+from ss.cim.space_filling_curve import SpaceFillingCurve
+
+arg_base.parser.description = "Cell Index Method benchmark. Times neighbor search and a force pass over neighbor pairs " \
+                              "on random particles, before and after sorting them along a space-filling curve."
+arg_base.parser.add_argument("-n", help="Amount of particles. Default is 100000", type=int, default=100000)
+arg_base.parser.add_argument("--radius", "-r", help="Interaction radius. Default is 1", type=float, default=1)
+arg_base.parser.add_argument("--curve", "-c", help="Space-filling curve to sort particles with. Default is morton",
+                             choices=SpaceFillingCurve.CURVES, default='morton')
+arg_base.parser.add_argument("--repetitions", help="Times each measurement is repeated, keeping the best. Default is 3",
+                             type=int, default=3)
+arg_base.parser.set_defaults(width=300, height=300)
+args = arg_base.to_dict_no_none()
+
+
+def best_time(function):
+    """Best time of running the given function `repetitions` times, and its last result."""
+
+    best, result = float('inf'), None
+    for _ in range(args['repetitions']):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def search():
+    return ArrayCellIndexMethod.from_system(system, radius=args['radius'], width=args['width'],
+                                            height=args['height'], periodic=args['periodic'], m=args.get('m', -1))
+
+
+def force_pass(cim):
+    """Sums a pair force over every neighbor pair, gathering and scattering particle data like force kernels do."""
+
+    i, j, dx, dy, distances = cim.pair_arrays()
+    magnitude = 1 / (distances + 1) * (system.masses[i] * system.masses[j])
+    fx = np.bincount(i, -magnitude * dx, len(system)) + np.bincount(j, magnitude * dx, len(system))
+    fy = np.bincount(i, -magnitude * dy, len(system)) + np.bincount(j, magnitude * dy, len(system))
+    return fx, fy
+
+
+system = ParticleSystem(args['n'])
+for x, y in zip(np.random.uniform(0, args['width'], args['n']), np.random.uniform(0, args['height'], args['n'])):
+    system.add(x, y, mass=1)
+
+results = dict()
+for label in ('generation order', '%s order' % args['curve']):
+    if label != 'generation order':
+        system.sort_spatially(cim.cell_width, args['curve'])
+    search_time, cim = best_time(search)
+    force_time, forces = best_time(lambda: force_pass(cim))
+    locality = SpaceFillingCurve.locality(cim.pair_i, cim.pair_j)
+    results[label] = (search_time, force_time, locality, system.in_order(forces[0]))
+    print("%-18s search: %.4fs\tforce pass: %.4fs\tmean index gap of neighbor pairs: %.1f"
+          % (label, search_time, force_time, locality))
+
+(search_before, force_before, locality_before, forces_before), (search_after, force_after, locality_after,
+                                                                 forces_after) = results.values()
+print("Locality gain: %.1fx closer in memory, search %.2fx and force pass %.2fx faster (same forces: %s)"
+      % (locality_before / max(locality_after, 1e-12), search_before / search_after, force_before / force_after,
+         np.allclose(forces_before, forces_after)))
@@ -14,8 +14,11 @@ class Board:
         self.height = kwargs.get('height')
         self.cell_side_length = kwargs.get('cell_side_length')
         self.is_periodic = kwargs.get('is_periodic', False)
-        self.num_cols = int(math.ceil(self.width / self.cell_side_length))
-        self.num_rows = int(math.ceil(self.height / self.cell_side_length))
+        self.particle_cells = dict()    # Particle ID => (particle, col, row), see #update
+        # Cells along each axis may be given separately for rectangular cells, otherwise cells are squares of the given
+        # side length
+        self.num_cols = kwargs.get('num_cols') or int(math.ceil(self.width / self.cell_side_length))
+        self.num_rows = kwargs.get('num_rows') or int(math.ceil(self.height / self.cell_side_length))
         self.cells = self.create_board()
         self.populate()
 
@@ -35,6 +38,11 @@ class Board:
     def get_cell(self, particle):
         if particle not in self.particles:
             raise Exception("%s is not part of this board" % particle)
+        return self.locate(particle)
+
+    def locate(self, particle):
+        """Gets the (col, row) of the cell in which a particle should be, without checking that it is on this board."""
+
         if particle.x < 0 or particle.y < 0 or particle.x> self.width or particle.y > self.height:
             raise Exception("%s is outside the board bounds" %particle)
         return self.to_col_row(particle.x, particle.y)
@@ -45,7 +53,7 @@ class Board:
         self.cells = [[]]
         for y in range(self.num_rows):
             self.cells.append([])
-            for x in range(int(math.ceil(self.width / self.cell_side_length))):
+            for x in range(self.num_cols):
                 self.cells[y].append(Cell(y, x))
 
         return self.cells
@@ -53,12 +61,64 @@ class Board:
     def populate(self):
         """Populates cells with the particles self was initialized with."""
 
+        self.particle_cells = dict()
         for particle in self.particles:
-            col, row = self.get_cell(particle)
-            self.cells[row][col].particles.append(particle)
+            self.add(particle)
 
         return self
 
+    def add(self, particle):
+        """Puts a particle in its corresponding cell."""
+
+        col, row = self.locate(particle)
+        self.cells[row][col].particles.append(particle)
+        self.particle_cells[particle.id] = (particle, col, row)
+
+    def remove(self, particle_id):
+        """Takes the particle with the given ID out of its cell."""
+
+        particle, col, row = self.particle_cells.pop(particle_id)
+        self.cells[row][col].particles.remove(particle)
+
+    def relocate(self, particle):
+        """Moves a particle to a new cell if it changed cells since it was last placed. Returns whether it moved."""
+
+        _, col, row = self.particle_cells[particle.id]
+        new_col, new_row = self.locate(particle)
+        if new_col == col and new_row == row:
+            return False
+
+        self.cells[row][col].particles.remove(particle)
+        self.cells[new_row][new_col].particles.append(particle)
+        self.particle_cells[particle.id] = (particle, new_col, new_row)
+        return True
+
+    def update(self, particles=None):
+        """Brings cells up to date with the current particle positions, touching only particles that changed cells.
+
+        :arg particles : (Optional) New list of particles for this board. Particles that are no longer present (or
+                         were replaced by a different Particle with the same ID) are taken out of the board, and new
+                         ones are added.
+        :return Number of particles that were moved, added or removed."""
+
+        changed = 0
+        if particles is not None:
+            current = {p.id: p for p in particles}
+            gone = [id for id, (p, _, _) in self.particle_cells.items() if current.get(id) is not p]
+            for particle_id in gone:
+                self.remove(particle_id)
+            changed += len(gone)
+            self.particles = particles
+
+        for particle in self.particles:
+            if particle.id not in self.particle_cells:
+                self.add(particle)
+                changed += 1
+            elif self.relocate(particle):
+                changed += 1
+
+        return changed
+
     @staticmethod
     def calculate_mbb(particles):
         """Calculates minimum bounding box for a given list of particles. Returns (width, height)"""
@@ -1,81 +1,127 @@
 from math import ceil
-from ss.util.ddict import Ddict
-from collections import defaultdict
-from ss.cim.cell import Cell
+
+import numpy as np
+
+from ss.cim.distance_matrix import DistanceMatrix
+from ss.cim.neighbor_view import NeighborView
+
 
 class BruteForce:
+    """Reference neighbor search that checks every pair of particles. The distance matrix is computed with NumPy in
+    square tiles, only over its upper triangle, so memory use is capped (see `max_memory`) and 10^5 particles can be
+    checked to validate optimized searches. Neighbors have the same form as CellIndexMethod#neighbors: keyed by particle
+    ID, with lists of (particle, distance) tuples, distances being measured between particle borders."""
+
+    # Bytes used per entry of a tile: coordinates, displacements, distances and masks
+    TILE_ENTRY_BYTES = 64
 
-    def __init__(self, *particles, interaction_radius, is_periodic=False):
+    def __init__(self, *particles, interaction_radius, is_periodic=False, **kwargs):
+        """
+        :arg particles : Particles to search.
+        :arg interaction_radius : Max distance between borders of neighbors.
+        :arg is_periodic : Whether to use minimum image distances on a periodic board.
+        :arg width : (Optional) Board width, for periodic boards. Defaults to the smallest integer width holding every
+        particle.
+        :arg height : (Optional) Board height, same as width.
+        :arg max_memory : (Optional) Approximate max bytes used by a tile of the distance matrix. Defaults to 64 MB.
+        """
         self.particles = particles
         self.interaction_radius = interaction_radius
         self.is_periodic = is_periodic
-        self.l = -1
-        self.cells_per_row = -1
-        self.board = self.particles_in_cells(particles, interaction_radius)
+        self.max_memory = kwargs.get('max_memory', 64 << 20)
+        self.xs = np.fromiter((p.x for p in particles), dtype=np.float64, count=len(particles))
+        self.ys = np.fromiter((p.y for p in particles), dtype=np.float64, count=len(particles))
+        self.radii = np.fromiter((p.radius for p in particles), dtype=np.float64, count=len(particles))
+        epsilon = 1e-5  # Quick fix to prevent bugs when particles are at EXACTLY the board limit
+        self.width = kwargs.get('width', ceil(self.xs.max()) + epsilon if len(particles) > 0 else -1)
+        self.height = kwargs.get('height', ceil(self.ys.max() + epsilon) if len(particles) > 0 else -1)
+        self.pair_i, self.pair_j, self.pair_distances = self.calculate_pairs()
         self.neighbors = self.calculate_neighbors()
 
-    def calculate_neighbors(self):
-        result = defaultdict(list)
-        for row in self.board:
-            for cell in row:
-                for me in cell.particles:
-                    for row2 in self.board:
-                        for cell2 in row2:
-                            for otherParticle in cell2.particles:
-                                if me == otherParticle or otherParticle in result[me.id]:
-                                    continue
-                                if me.distance_to(otherParticle) <= self.interaction_radius:
-                                    result[me.id].append(otherParticle.original_particle if otherParticle.is_fake else otherParticle)
-                                    result[otherParticle.original_particle.id if otherParticle.is_fake else otherParticle.id].append(me)
-
-        # Don't convert to plain dict because caller doesn't know which particles have neighbors and which don't. Keep
-        # behavior of returning empty list when accessing a new key (doesn't contemplate invalid keys though, those will
-        # also return empty list)
-        return result
+    def tile_size(self):
+        """Side of the square tiles the distance matrix is computed in."""
 
-    def particles_in_cells(self, particles, interaction_radius):
-        """Calculates a minimum bounding rectangle that contains the specified particles, calculates the optimum number
-        of cells per row, and places all particles in their corresponding cell."""
+        return max(1, int((self.max_memory / self.TILE_ENTRY_BYTES) ** 0.5))
 
-        # Calculate minimum bounding rectangle for particles
-        xs, ys = [], []
-        max_radius = 0
-        for particle in particles:
-            xs.append(particle.x)
-            ys.append(particle.y)
-            max_radius = max((max_radius, particle.radius))
+    def tiles(self):
+        """Generates the [first, last) row and column ranges of the tiles over the upper triangle of the distance
+        matrix, diagonal tiles included."""
 
-        # Compute optimal board parameters
-        epsilon = 1e-5  # Quick fix to prevent bugs when particles are at EXACTLY the board limit
-        width, height = ceil(max(xs)) + epsilon, ceil(
-            max(ys) + epsilon)  # No negative positions allowed, no need to subtract min(xs|ys)
-        self.l = max((width, height))
-        # TODO support rectangular boards
-        self.cells_per_row = int(ceil(self.l / (interaction_radius + 2 * max_radius)))
+        n, size = len(self.xs), self.tile_size()
+        for row in range(0, n, size):
+            for col in range(row, n, size):
+                yield row, min(row + size, n), col, min(col + size, n)
+
+    def calculate_pairs(self):
+        """Checks every pair of particles, tile by tile. Returns (i, j, distances) arrays with each pair within the
+        interaction radius once (i < j)."""
+
+        # Squared center distances are checked first against the biggest possible reach, in single precision and in
+        # place to keep tiles cheap (the reach is padded to cover rounding errors), and exact border distances are then
+        # computed only for those candidates
+        max_radius = float(self.radii.max()) if len(self.radii) > 0 else 0
+        xs, ys = self.xs.astype(np.float32), self.ys.astype(np.float32)
+        scale = max(float(np.abs(self.xs).max()), float(np.abs(self.ys).max()), self.width, self.height) \
+            if len(self.xs) > 0 else 0
+        max_reach = (self.interaction_radius + 2 * max_radius + 1e-5 * scale) ** 2
+        found_i, found_j = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for first_row, last_row, first_col, last_col in self.tiles():
+            squared = self.axis_distances(xs, self.width, first_row, last_row, first_col, last_col)
+            squared *= squared
+            dy = self.axis_distances(ys, self.height, first_row, last_row, first_col, last_col)
+            dy *= dy
+            squared += dy
+            rows, cols = np.nonzero(squared <= max_reach)
+            rows, cols = rows + first_row, cols + first_col
+            above_diagonal = rows < cols
+            found_i.append(rows[above_diagonal])
+            found_j.append(cols[above_diagonal])
+
+        i, j = np.concatenate(found_i), np.concatenate(found_j)
+        dx, dy = self.xs[j] - self.xs[i], self.ys[j] - self.ys[i]
+        if self.is_periodic:
+            dx -= self.width * np.round(dx / self.width)
+            dy -= self.height * np.round(dy / self.height)
+        distances = np.hypot(dx, dy) - self.radii[i] - self.radii[j]
+        accepted = distances <= self.interaction_radius
+        return i[accepted], j[accepted], distances[accepted]
 
-        # Create board and put particles in it
-        board = self.create_board(self.cells_per_row, self.cells_per_row)
+    def axis_distances(self, coordinates, side, first_row, last_row, first_col, last_col):
+        """Tile of absolute distances along an axis between particles [first_row, last_row) and [first_col, last_col),
+        using the minimum image on periodic boards."""
 
-        for particle in particles:
-            row, col = self.get_cell(particle, board, self.l)
-            # TODO: If a particle has EXACTLY the same x or y as the side length, we get out of bounds
-            board[row][col].particles.append(particle)
+        result = np.subtract.outer(coordinates[first_row:last_row], coordinates[first_col:last_col])
+        np.abs(result, out=result)
+        if self.is_periodic:
+            # Particles are on the board, so |dx| <= side and the closest image is either the particle or the one
+            # `side` away
+            np.minimum(result, np.float32(side) - result, out=result)
+        return result
+
+    def calculate_neighbors(self):
+        """Neighbors of every particle as a dictionary-like NeighborView keyed by particle ID. Keys without neighbors
+        give an empty list, like a defaultdict."""
 
-        return board
+        matrix = self.distance_matrix()
+        return NeighborView(matrix.offsets, matrix.indices, matrix.distances, keys=matrix.ids.tolist(),
+                            items=self.particles)
 
-    def get_cell(self, particle, board, side_length):
-        """Gets the cell to which a given particle belongs in a given board"""
+    def distance_matrix(self):
+        """Neighbor distances as a sparse symmetric DistanceMatrix."""
 
-        row, col = int(particle.y / side_length * self.cells_per_row), int(
-            particle.x / side_length * self.cells_per_row)
-        return row, col  # Return array indices rather than raw (x,y)
+        return DistanceMatrix.from_pairs(self.pair_i, self.pair_j, self.pair_distances, len(self.particles),
+                                         [p.id for p in self.particles])
 
-    def create_board(self, width, height):
-        board = []
-        for y in range(height):  # TODO: Support rectangular boards?
-            board.append([])
-            for x in range(width):
-                board[y].append(Cell(y, x))
+    def compare(self, i, j):
+        """Compares the given pairs of particle indices (in the order particles were given, each pair in any order)
+        with the pairs found here, to validate other neighbor searches.
 
-        return board
+        :return (missing, extra) arrays of shape (k, 2): pairs found here but not given, and given pairs not found
+        here."""
 
+        n = len(self.particles)
+        i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+        expected = np.unique(np.minimum(self.pair_i, self.pair_j) * n + np.maximum(self.pair_i, self.pair_j))
+        given = np.unique(np.minimum(i, j) * n + np.maximum(i, j))
+        missing, extra = np.setdiff1d(expected, given), np.setdiff1d(given, expected)
+        return np.stack((missing // n, missing % n), axis=1), np.stack((extra // n, extra % n), axis=1)
@@ -1,6 +1,3 @@
-from ss.cim.particle import Particle
-
-
 class Cell:
     def __init__(self, row, col, particles=None, is_fake=False):
         if particles is None:
@@ -13,7 +10,9 @@ class Cell:
     # def getNeighborCells(self, board: CellIndexMethod):
     def getNeighborCells(self, board):
         """Gets neighboring cells above and to the right of the cell that are within the board. Ver teórica 1
-        filmina 24. """
+        filmina 24. On periodic boards, neighbors past the board's edges are the cells on the opposite side; particles
+        in them are the original particles, so distances to them should use the minimum image convention (see
+        CellIndexMethod#distance). """
 
         result = []
         for delta_row in [1, 0, -1]:
@@ -25,30 +24,16 @@ class Cell:
                 col, row, = self.col + delta_col, self.row + delta_row
                 # Only add cells within the board
                 if 0 <= col < board.num_cols and 0 <= row < board.num_rows:
-                    result.append(board.cells[row][col])
+                    cell = board.cells[row][col]
                 elif board.is_periodic:
-                    particles = []
-                    # Create fake cells with fake coordinates for infinite boards
-                    delta_x = delta_y = 0
-                    if col < 0:
-                        delta_x = -board.width
-                    elif col >= board.num_cols:
-                        delta_x = board.width
-                    if row < 0:
-                        delta_y = -board.height
-                    elif row >= board.num_rows:
-                        delta_y = board.height
-
-                    for original_particle in board.cells[row % board.num_rows][col % board.num_cols].particles:
-                        particles.append(Particle(original_particle.x + delta_x, original_particle.y + delta_y,
-                                                  radius=original_particle.radius,
-                                                  mass=original_particle.mass,
-                                                  v=original_particle.velocity.magnitude(),
-                                                  o=original_particle.vel_angle(),
-                                                  is_fake=True,
-                                                  original_particle=original_particle))
+                    # Wrap around to the other side of infinite boards
+                    cell = board.cells[row % board.num_rows][col % board.num_cols]
+                else:
+                    continue
 
-                    result.append(Cell(row, col, particles, True))
+                # On small periodic boards wrapped neighbors may repeat, or be this same cell
+                if cell is not self and cell not in result:
+                    result.append(cell)
 
         return result
 
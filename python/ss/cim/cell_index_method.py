@@ -1,14 +1,34 @@
 import math
-from ss.util.ddict import Ddict
+import time
+
+import numpy as np
+
 from collections import defaultdict
+from ss.cim.autotuner import Autotuner
 from ss.cim.board import Board
+from ss.cim.distance_matrix import DistanceMatrix
+from ss.cim.search_stats import SearchStats
 
 class CellIndexMethod:
 
-    def check_particles_in_bounds(self, particles):
-        for p in particles:
-            if p.x < 0 or p.y < 0 or p.y > self.height or p.x > self.width:
-                raise Exception("Particle %s is out of board bounds, board height: %d, board width: %d" %(p, self.height, self.width))
+    def check_particles_in_bounds(self, particles, xs=None, ys=None):
+        """Raises if any particle is off the board. Takes the particles' coordinates as arrays, if already gathered."""
+
+        if xs is None:
+            xs, ys, _ = self.particle_arrays(particles)
+        outside = (xs < 0) | (ys < 0) | (ys > self.height) | (xs > self.width)
+        if outside.any():
+            p = particles[int(np.flatnonzero(outside)[0])]
+            raise Exception("Particle %s is out of board bounds, board height: %d, board width: %d" %(p, self.height, self.width))
+
+    @staticmethod
+    def particle_arrays(particles):
+        """X coordinates, Y coordinates and radii of the given particles, as NumPy arrays."""
+
+        xs = np.fromiter((p.x for p in particles), dtype=np.float64, count=len(particles))
+        ys = np.fromiter((p.y for p in particles), dtype=np.float64, count=len(particles))
+        radii = np.fromiter((p.radius for p in particles), dtype=np.float64, count=len(particles))
+        return xs, ys, radii
 
     def __init__(self, particles, **kwargs):
         self.particles = particles
@@ -17,48 +37,425 @@ class CellIndexMethod:
         self.width = kwargs.get('width', -1)
         self.height = kwargs.get('height', -1)
         self.m = kwargs.get('m', -1)
+        # Cells per row (along the width) and per column (along the height), chosen independently unless provided
+        self.mx = kwargs.get('mx', -1)
+        self.my = kwargs.get('my', -1)
+        # Choose M with an Autotuner (when M, Mx and My are not all provided), optionally caching choices in a file
+        self.autotune = kwargs.get('autotune', False)
+        self.tuning_cache = kwargs.get('tuning_cache')
+        # Verlet list mode: when skin > 0, candidate neighbors are searched within radius + skin and are only searched
+        # again once some particle moved more than skin / 2, see #update
+        self.skin = kwargs.get('skin', 0)
+        # Candidates are kept as arrays of indices in `build_particles`, the particles as of the last search, whose
+        # positions then were `build_xs` and `build_ys`
+        self.candidate_i = self.candidate_j = None
+        self.build_particles = None
+        self.build_xs = self.build_ys = None
+        self.neighbor_pairs = None
+        self.rebuild_count = 0
+        self.update_count = 0
+        # Whether particles were added, removed or replaced by #relocate since neighbors were last searched
+        self.particles_relocated = False
+        # Counters and timings of the last search, off by default, see SearchStats
+        self.stats = SearchStats() if kwargs.get('stats', False) else None
+        # Static walls, whose contacts with particles are found along with neighbors, see Obstacles
+        self.obstacles = kwargs.get('obstacles')
+        if self.obstacles is not None and self.is_periodic:
+            raise Exception("Obstacles are not supported on periodic boards")
+        self.wall_cells = None
+        self.wall_candidate_i = self.wall_candidate_segments = None
+        self.wall_contacts = []
+        self.max_radius = max([p.radius for p in particles], default=0)     # As of the last update, used by queries
         self.check_particles_in_bounds(particles)
+        start = time.perf_counter() if self.stats is not None else 0
         self.board = self.create_board()
+        if self.stats is not None:
+            self.stats.binning_time = time.perf_counter() - start
+            self.stats.count_occupancy(self.board.cells)
         self.neighbors = self.calculate_neighbors()
+        if self.stats is not None:
+            self.stats.total_time = time.perf_counter() - start
 
     def calculate_distances(self):
-        result = Ddict.ddict()  # Dictionary that returns a new dictionary when accessing a nonexistent key
+        """Distances between every particle and the particles in its cell and in neighbor cells (whether or not they
+        are within the interaction radius), as a sparse symmetric DistanceMatrix indexed by position in `particles`."""
+
+        index = {p.id: i for i, p in enumerate(self.particles)}
+        pairs = self.find_pairs(math.inf)
+        i = np.fromiter((index[pair[0].id] for pair in pairs), dtype=np.int64, count=len(pairs))
+        j = np.fromiter((index[pair[1].id] for pair in pairs), dtype=np.int64, count=len(pairs))
+        distances = np.fromiter((pair[4] for pair in pairs), dtype=np.float64, count=len(pairs))
+        return DistanceMatrix.from_pairs(i, j, distances, len(self.particles), ids=list(index))
+
+    def update(self, positions=None, particles=None):
+        """Recalculates neighbors after particles moved, reusing this instance's board, cells and neighbor lists. Only
+        particles that changed cells are moved between cells. Note that neighbor lists returned before the update are
+        cleared and refilled.
+
+        :arg positions : (Optional) Iterable of (x, y) new positions for each particle, in the same order as
+                         `particles`. If not provided, particles are assumed to have been moved already.
+        :arg particles : (Optional) New list of particles, for simulations where particles are added, removed or
+                         replaced between steps.
+        :return The updated neighbors"""
+
+        self.update_count += 1
+        if self.stats is not None:
+            self.stats.reset()
+            start = time.perf_counter()
+        particles_changed = self.particles_relocated or particles is not None and self.particles_changed(particles)
+        self.particles_relocated = False
+        if particles is not None:
+            self.particles = particles
+        if positions is not None:
+            for particle, (x, y) in zip(self.particles, positions):
+                particle.move_to(x, y)
+
+        verlet_lists = self.skin > 0 and not particles_changed
+        # Particles are in the same order as candidates when they may be reused
+        particles = self.build_particles if verlet_lists else self.particles
+        xs, ys, radii = self.particle_arrays(particles)
+        self.check_particles_in_bounds(particles, xs, ys)
+        self.max_radius = float(radii.max()) if len(radii) > 0 else 0
+        if verlet_lists and self.max_displacement(xs, ys) <= self.skin / 2:
+            # No pair of particles can have come within the interaction radius without being candidates
+            self.neighbor_pairs = self.filter_candidates(xs, ys, radii)
+            if self.obstacles is not None:
+                self.wall_contacts = self.filter_wall_candidates(xs, ys, radii)
+            self.neighbors = self.fill_neighbors(self.neighbor_pairs, self.clear_neighbors(self.neighbors))
+            if self.stats is not None:
+                self.stats.total_time = time.perf_counter() - start
+            return self.neighbors
+
+        if self.stats is not None:
+            binning_start = time.perf_counter()
+            self.board.update(self.particles if particles is not None else None)
+            self.stats.binning_time = time.perf_counter() - binning_start
+            self.stats.count_occupancy(self.board.cells)
+        else:
+            self.board.update(self.particles if particles is not None else None)
+        self.neighbors = self.calculate_neighbors(self.neighbors)
+        if self.stats is not None:
+            self.stats.total_time = time.perf_counter() - start
+        return self.neighbors
+
+    def relocate(self, particles=None):
+        """Brings the board up to date with particle positions without searching neighbors again, for queries (see
+        #query_radius) in between calls to #update. Neighbors are left as they were.
+
+        :arg particles : (Optional) New list of particles, like in #update. The next #update searches neighbors again
+                         if particles were added, removed or replaced."""
+
+        if particles is not None:
+            self.particles_relocated = self.particles_relocated or self.particles_changed(particles)
+            self.particles = particles
+        self.check_particles_in_bounds(self.particles)
+        self.max_radius = max([p.radius for p in self.particles], default=0)
+        self.board.update(self.particles if particles is not None else None)
+
+    def particles_changed(self, particles):
+        """Whether the given particle list has particles that are not on the board, or lacks any that are."""
+
+        return len(particles) != len(self.board.particle_cells) or \
+            any(self.board.particle_cells.get(p.id, (None,))[0] is not p for p in particles)
+
+    def max_displacement(self, xs, ys):
+        """Maximum distance any particle moved since candidates were last searched, given the current coordinates of
+        `build_particles`."""
+
+        if len(xs) == 0:
+            return 0
+        return float(np.hypot(*self.wrap_arrays(xs - self.build_xs, ys - self.build_ys)).max())
+
+    def wrap(self, delta_x, delta_y):
+        """Applies the minimum image convention to a displacement on periodic boards."""
+
+        if self.is_periodic:
+            delta_x -= self.width * round(delta_x / self.width)
+            delta_y -= self.height * round(delta_y / self.height)
+        return delta_x, delta_y
+
+    def wrap_arrays(self, delta_x, delta_y):
+        """#wrap for arrays of displacements."""
+
+        if self.is_periodic:
+            delta_x = delta_x - self.width * np.round(delta_x / self.width)
+            delta_y = delta_y - self.height * np.round(delta_y / self.height)
+        return delta_x, delta_y
+
+    def distance(self, p1, p2):
+        """Distance between the borders of two particles, using the minimum image on periodic boards."""
+
+        if not self.is_periodic:
+            return p1.distance_to(p2)
+        return math.hypot(*self.wrap(p2.x - p1.x, p2.y - p1.y)) - p1.radius - p2.radius
+
+    def pair(self, p1, p2):
+        """Returns a (p1, p2, dx, dy, distance) tuple, where (dx, dy) goes from p1 to p2 (using the minimum image on
+        periodic boards) and distance is measured between particle borders, like Particle#distance_to."""
+
+        delta_x, delta_y = p2.x - p1.x, p2.y - p1.y
+        if self.is_periodic:
+            delta_x, delta_y = self.wrap(delta_x, delta_y)
+        return p1, p2, delta_x, delta_y, math.sqrt(delta_x ** 2 + delta_y ** 2) - p1.radius - p2.radius
+
+    def pairs(self):
+        """Iterates over every pair of neighbors exactly once, as (p1, p2, dx, dy, distance) tuples (see #pair)."""
+
+        return iter(self.neighbor_pairs)
+
+    def pair_arrays(self):
+        """Returns every pair of neighbors exactly once, as NumPy arrays (i, j, dx, dy, distances), where i and j are
+        indices in `particles`."""
+
+        index = {p.id: i for i, p in enumerate(self.particles)}
+        pairs = self.neighbor_pairs
+        i = np.fromiter((index[pair[0].id] for pair in pairs), dtype=np.int64, count=len(pairs))
+        j = np.fromiter((index[pair[1].id] for pair in pairs), dtype=np.int64, count=len(pairs))
+        geometry = np.array([pair[2:] for pair in pairs], dtype=np.float64).reshape(-1, 3)
+        return i, j, geometry[:, 0], geometry[:, 1], geometry[:, 2]
+
+    def walls(self):
+        """Iterates over every contact between a particle and a wall within the interaction radius, as (particle,
+        segment, dx, dy, distance) tuples, where segment is the index of the wall in `obstacles`, (dx, dy) goes from the
+        particle's center to the closest point of the wall and distance is measured from the particle's border."""
+
+        return iter(self.wall_contacts)
+
+    def wall_arrays(self):
+        """Returns every contact between a particle and a wall as NumPy arrays (i, segments, dx, dy, distances), where i
+        are indices in `particles`."""
+
+        index = {p.id: i for i, p in enumerate(self.particles)}
+        contacts = self.wall_contacts
+        i = np.fromiter((index[contact[0].id] for contact in contacts), dtype=np.int64, count=len(contacts))
+        segments = np.fromiter((contact[1] for contact in contacts), dtype=np.int64, count=len(contacts))
+        geometry = np.array([contact[2:] for contact in contacts], dtype=np.float64).reshape(-1, 3)
+        return i, segments, geometry[:, 0], geometry[:, 1], geometry[:, 2]
+
+    def clear_neighbors(self, result):
+        """Empties a previous neighbors dictionary so its lists can be reused, or creates a new one."""
+
+        if result is None:
+            return defaultdict(list)
+
+        for particle_id in [id for id in result if id not in self.board.particle_cells]:
+            del result[particle_id]
+        for neighbors in result.values():
+            neighbors.clear()
+        return result
+
+    def calculate_neighbors(self, result=None):
+        """Calculate neighbors of each particle optimally and return a dictionary with particle IDs as keys and neighbor
+        Particle lists as values. If a previous result is provided, its lists are cleared and reused."""
+        if self.skin > 0:
+            self.build_particles = np.empty(len(self.particles), dtype=object)
+            self.build_particles[:] = self.particles
+            index = {p.id: k for k, p in enumerate(self.particles)}
+            candidates = self.find_pairs(self.interaction_radius + self.skin)
+            self.candidate_i = np.fromiter((index[pair[0].id] for pair in candidates), dtype=np.int64,
+                                           count=len(candidates))
+            self.candidate_j = np.fromiter((index[pair[1].id] for pair in candidates), dtype=np.int64,
+                                           count=len(candidates))
+            xs, ys, radii = self.particle_arrays(self.particles)
+            self.build_xs, self.build_ys = xs, ys
+            self.rebuild_count += 1
+            self.neighbor_pairs = self.filter_candidates(xs, ys, radii)
+            if self.obstacles is not None:
+                contacts = self.find_wall_contacts(self.interaction_radius + self.skin)
+                self.wall_candidate_i = np.fromiter((index[contact[0].id] for contact in contacts), dtype=np.int64,
+                                                    count=len(contacts))
+                self.wall_candidate_segments = np.fromiter((contact[1] for contact in contacts), dtype=np.int64,
+                                                           count=len(contacts))
+                self.wall_contacts = self.filter_wall_candidates(xs, ys, radii)
+        else:
+            self.neighbor_pairs = self.find_pairs(self.interaction_radius)
+            if self.obstacles is not None:
+                self.wall_contacts = self.find_wall_contacts(self.interaction_radius)
+
+        return self.fill_neighbors(self.neighbor_pairs, self.clear_neighbors(result))
+
+    def filter_candidates(self, xs, ys, radii):
+        """Returns the candidate pairs that are currently within the interaction radius, as tuples of the form returned
+        by #pair, given the current coordinates and radii of `build_particles`. Candidates are tested all at once."""
+
+        start = time.perf_counter() if self.stats is not None else 0
+        i, j = self.candidate_i, self.candidate_j
+        delta_x, delta_y = self.wrap_arrays(xs[j] - xs[i], ys[j] - ys[i])
+        distances = np.hypot(delta_x, delta_y) - radii[i] - radii[j]
+        within = np.flatnonzero(distances <= self.interaction_radius)
+        result = list(zip(self.build_particles[i[within]].tolist(), self.build_particles[j[within]].tolist(),
+                          delta_x[within].tolist(), delta_y[within].tolist(), distances[within].tolist()))
+        if self.stats is not None:
+            self.stats.candidate_pairs += len(i)
+            self.stats.accepted_pairs += len(result)
+            self.stats.pair_time += time.perf_counter() - start
+        return result
+
+    @staticmethod
+    def fill_neighbors(pairs, result):
+        """Adds both particles of each pair to the other one's neighbors."""
+
+        for p1, p2, _, _, distance in pairs:
+            result[p1.id].append((p2, distance))
+            result[p2.id].append((p1, distance))
+
+        # Don't convert to plain dict because caller doesn't know which particles have neighbors and which don't. Keep
+        # behavior of returning empty list when accessing a new key (doesn't contemplate invalid keys though, those will
+        # also return empty list)
+        return result
+
+    def find_pairs(self, radius):
+        """Returns every pair of particles within the given radius of each other exactly once, as tuples of the form
+        returned by #pair. Each cell is checked against itself and its half shell of neighbor cells."""
+
+        stats = self.stats
+        start = time.perf_counter() if stats is not None else 0
+        result = []
+        # On small periodic boards two cells may be in each other's half shell, check each couple of cells once
+        check_repeats = self.is_periodic and (self.board.num_rows < 3 or self.board.num_cols < 3)
+        checked = set()
         for row in self.board.cells:
             for cell in row:
-                for me in cell.particles:
-                    for neighbor in cell.getNeighborParticles(self.board):
-                        if me == neighbor or neighbor in result[me.id]:
+                particles = cell.particles
+                if stats is not None:
+                    stats.cells_visited += 1
+                    stats.candidate_pairs += len(particles) * (len(particles) - 1) // 2
+                for i in range(len(particles)):
+                    # Pair particles in the same cell only with the ones after them
+                    for neighbor in particles[i + 1:]:
+                        pair = self.pair(particles[i], neighbor)
+                        if pair[4] <= radius:
+                            result.append(pair)
+
+                for neighbor_cell in cell.getNeighborCells(self.board):
+                    if check_repeats:
+                        key = frozenset(((cell.row, cell.col), (neighbor_cell.row, neighbor_cell.col)))
+                        if key in checked:
                             continue
+                        checked.add(key)
 
-                        distance = me.distance_to(neighbor)
-                        result[me.id][neighbor.id] = result[neighbor.id][me.id] = distance
+                    if stats is not None:
+                        self.count_neighbor_cell(cell, neighbor_cell)
+                    for me in particles:
+                        for neighbor in neighbor_cell.particles:
+                            pair = self.pair(me, neighbor)
+                            if pair[4] <= radius:
+                                result.append(pair)
 
-        return Ddict.to_dict(result)
+        if stats is not None:
+            stats.accepted_pairs += len(result)
+            stats.pair_time += time.perf_counter() - start
+        return result
 
-    def calculate_neighbors(self):
-        """Calculate neighbors of each particle optimally and return a dictionary with particle IDs as keys and neighbor
-        Particle lists as values."""
-        result = defaultdict(list)
+    def find_wall_contacts(self, radius):
+        """Returns every contact between a particle and a wall within the given radius, as tuples of the form returned
+        by #walls. Each cell's particles are checked only against the walls indexed for that cell."""
+
+        wall_cells = self.index_walls(radius + self.max_radius)
+        contact = self.obstacles.contact
+        result = []
         for row in self.board.cells:
             for cell in row:
-                for me in cell.particles:
-                    for neighbor in cell.getNeighborParticles(self.board):
-                        # result[me.id] is a list of tuples, particles are in the 0 position of each tuple.
-                        if me == neighbor or neighbor in [t[0] for t in result[me.id]]:
-                            continue
-                        distance = me.distance_to(neighbor)
-                        if distance <= self.interaction_radius:
-                            # Put only real particles in result
-                            result[me.id].append(
-                                (neighbor.original_particle if neighbor.is_fake else neighbor, distance))
-                            result[neighbor.original_particle.id if neighbor.is_fake else neighbor.id].append(
-                                (me, distance))
+                if not cell.particles:
+                    continue
+                for segment in wall_cells[cell.row][cell.col]:
+                    for particle in cell.particles:
+                        delta_x, delta_y, distance = contact(segment, particle.x, particle.y, particle.radius)
+                        if distance <= radius:
+                            result.append((particle, segment, delta_x, delta_y, distance))
+        return result
 
-        # Don't convert to plain dict because caller doesn't know which particles have neighbors and which don't. Keep
-        # behavior of returning empty list when accessing a new key (doesn't contemplate invalid keys though, those will
-        # also return empty list)
+    def filter_wall_candidates(self, xs, ys, radii):
+        """Returns the candidate wall contacts that are currently within the interaction radius, given the current
+        coordinates and radii of `build_particles`."""
+
+        i, segments = self.wall_candidate_i, self.wall_candidate_segments
+        delta_x, delta_y, distances = self.obstacles.contacts(segments, xs[i], ys[i], radii[i])
+        within = np.flatnonzero(distances <= self.interaction_radius)
+        return list(zip(self.build_particles[i[within]].tolist(), segments[within].tolist(), delta_x[within].tolist(),
+                        delta_y[within].tolist(), distances[within].tolist()))
+
+    def index_walls(self, reach):
+        """Lists of the walls within `reach` of each cell of the board, by row and column. Walls are only indexed again
+        if reach grows (e.g. particles grew)."""
+
+        board = self.board
+        if self.wall_cells is None or self.wall_cells[0] < reach:
+            starts, segments = self.obstacles.cell_segments(board.num_cols, board.num_rows, board.width / board.num_cols,
+                                                            board.height / board.num_rows, reach)
+            starts, segments = starts.tolist(), segments.tolist()
+            cells = [[segments[starts[row * board.num_cols + col]:starts[row * board.num_cols + col + 1]]
+                      for col in range(board.num_cols)] for row in range(board.num_rows)]
+            self.wall_cells = (reach, cells)
+        return self.wall_cells[1]
+
+    def count_neighbor_cell(self, cell, neighbor_cell):
+        """Adds the check of a cell against one of its neighbor cells to the stats."""
+
+        self.stats.cells_visited += 1
+        self.stats.candidate_pairs += len(cell.particles) * len(neighbor_cell.particles)
+        # Neighbors that aren't in the half shell within the board were reached across its edge
+        delta_row, delta_col = neighbor_cell.row - cell.row, neighbor_cell.col - cell.col
+        if delta_col not in (0, 1) or delta_row not in (-1, 0, 1) or (delta_row, delta_col) == (-1, 0):
+            self.stats.ghost_copies += len(neighbor_cell.particles)
+
+    def query_radius(self, x, y, r):
+        """Particles whose border is within distance r of the point (x, y), checking only the cells around the point.
+        The board must be up to date with particle positions, see #update.
+
+        :return List of (particle, distance) tuples like the ones in #neighbors, distance being measured from the point
+        to the particle's border (negative for particles covering the point)."""
+
+        # In Verlet list mode, particles may have moved up to skin / 2 since they were put in their cells
+        reach = r + self.max_radius + self.skin / 2
+        result = []
+        for cell in self.cells_around(x - reach, y - reach, x + reach, y + reach):
+            for particle in cell.particles:
+                distance = math.hypot(*self.wrap(particle.x - x, particle.y - y)) - particle.radius
+                if distance <= r:
+                    result.append((particle, distance))
         return result
 
+    def query_radius_batch(self, points, r):
+        """Like #query_radius for each (x, y) in `points`. Returns a list with the result for each point."""
+
+        return [self.query_radius(x, y, r) for x, y in points]
+
+    def query_box(self, x_min, y_min, x_max, y_max):
+        """Particles that overlap the given box, checking only the cells around it. On periodic boards, the box may go
+        past the board's edges and wrap around. The board must be up to date with particle positions, see #update."""
+
+        half_width, half_height = (x_max - x_min) / 2, (y_max - y_min) / 2
+        center_x, center_y = x_min + half_width, y_min + half_height
+        reach = self.max_radius + self.skin / 2
+        result = []
+        for cell in self.cells_around(x_min - reach, y_min - reach, x_max + reach, y_max + reach):
+            for particle in cell.particles:
+                delta_x, delta_y = self.wrap(particle.x - center_x, particle.y - center_y)
+                # Distance from the particle's center to the closest point of the box
+                if math.hypot(max(abs(delta_x) - half_width, 0), max(abs(delta_y) - half_height, 0)) <= particle.radius:
+                    result.append(particle)
+        return result
+
+    def cells_around(self, x_min, y_min, x_max, y_max):
+        """Cells that overlap the given rectangle, each one once. Wraps around periodic boards."""
+
+        cols = self.cell_range(x_min / self.board.width * self.board.num_cols,
+                               x_max / self.board.width * self.board.num_cols, self.board.num_cols)
+        rows = self.cell_range(y_min / self.board.height * self.board.num_rows,
+                               y_max / self.board.height * self.board.num_rows, self.board.num_rows)
+        return [self.board.cells[row][col] for row in rows for col in cols]
+
+    def cell_range(self, first, last, num_cells):
+        """Cell numbers from the one containing coordinate `first` to the one containing `last`, measured in cells."""
+
+        first, last = math.floor(first), math.floor(last)
+        if not self.is_periodic:
+            return range(max(first, 0), min(last, num_cells - 1) + 1)
+        if last - first + 1 >= num_cells:
+            return range(num_cells)
+        return [cell % num_cells for cell in range(first, last + 1)]
+
     def get_distances(self, id):
         """List with distances of particle with id to its corresponding neighbors"""
         return [x[1] for x in self.neighbors[id]]
@@ -68,7 +465,7 @@ class CellIndexMethod:
         necessary:
             - Width
             - Height
-            - M
+            - Mx and My (cells along the width and the height)
 
         :return The created board
         """
@@ -82,27 +479,68 @@ class CellIndexMethod:
                 # i.e:  self.height = max(self.width, height)
                 self.height = height
 
-        l = max(self.width, self.height)
-        if self.m == -1:
-            # Calculate max particle radius
-            max_radius = max([p.radius for p in self.particles])
-
-            # Compute optimal board parameters
-            self.m = math.ceil(l / (self.interaction_radius + 2 * max_radius))
-            if l / self.m <= self.interaction_radius:
-                # FIXME: This shouldn't happen, revise previous formula
-                # print("WARNING: The calculated M (%i) is over limit, restricting to " % self.m, end="")
-                self.m = math.floor(l / self.interaction_radius) - 1
-                # print(self.m)
-
-        if l / self.m <= self.interaction_radius:
-            raise Exception("L / M > Rc is not met, can't perform cell index method, aborting. (L = %g, M = %g, "
-                            "Rc = %g)" % (l, self.m, self.interaction_radius))
+        # In Verlet list mode, cells must fit the skin too
+        radius = self.interaction_radius + self.skin
+        self.mx, self.my = self.cell_counts(radius)
+        if self.width / self.mx <= radius and self.mx > 1 or self.height / self.my <= radius and self.my > 1:
+            raise Exception("W / Mx > Rc and H / My > Rc are not met, can't perform cell index method, aborting. "
+                            "(W = %g, H = %g, Mx = %g, My = %g, Rc = %g)" % (self.width, self.height, self.mx, self.my,
+                                                                              radius))
 
         board = Board(self.particles, width=self.width, height=self.height, is_periodic=self.is_periodic,
-                      cell_side_length=l/self.m)
+                      num_cols=self.mx, num_rows=self.my)
         return board
 
+    def cell_counts(self, radius):
+        """Number of cells along the width (Mx) and along the height (My). Each one is, in order of precedence: the one
+        provided, derived from M (cells per longest side, keeping cells square-ish; M is chosen by an Autotuner in
+        autotune mode) or chosen for its own side. Also sets M to the cells along the longest side.
+
+        :return (Mx, My)"""
+
+        l = max(self.width, self.height)
+        if self.m == -1 and self.autotune and (self.mx == -1 or self.my == -1):
+            self.m = self.tune_m(radius)
+        if self.m != -1:
+            if l / self.m <= radius:
+                raise Exception("L / M > Rc is not met, can't perform cell index method, aborting. (L = %g, M = %g, "
+                                "Rc = %g)" % (l, self.m, radius))
+            # Round down so cells are at least L / M long on both axes
+            mx = max(1, math.floor(self.width / l * self.m + 1e-9))
+            my = max(1, math.floor(self.height / l * self.m + 1e-9))
+        else:
+            mx = max(1, self.optimal_m(self.width, radius, self.max_radius))
+            my = max(1, self.optimal_m(self.height, radius, self.max_radius))
+
+        mx = self.mx if self.mx != -1 else mx
+        my = self.my if self.my != -1 else my
+        self.m = mx if self.width >= self.height else my
+        return mx, my
+
+    def tune_m(self, radius):
+        """Chooses M with an Autotuner, timing searches on this instance's particles."""
+
+        def build(m):
+            CellIndexMethod(self.particles, radius=self.interaction_radius, width=self.width, height=self.height,
+                            periodic=self.is_periodic, skin=self.skin, m=m)
+
+        tuner = Autotuner(cache_file=self.tuning_cache)
+        return tuner.best_m(len(self.particles), self.width, self.height, radius + 2 * self.max_radius,
+                            self.optimal_m(max(self.width, self.height), radius, self.max_radius), self.is_periodic,
+                            build)
+
+    @staticmethod
+    def optimal_m(l, interaction_radius, max_radius):
+        """Computes the optimal number of cells per side for a board of side L, given the interaction radius and the
+        biggest particle radius: the most cells for which cells are no smaller than Rc + 2 * (biggest radius), so that
+        any two particles within Rc of each other are in the same or in neighbor cells. Always at least 1."""
+
+        m = math.floor(l / (interaction_radius + 2 * max_radius))
+        if m > 1 and l / m <= interaction_radius:
+            # Cells exactly Rc long (only possible with point particles), L / M > Rc must hold
+            m -= 1
+        return max(1, m)
+
     def __str__(self):
         result = ""
         for row in reversed(range(self.board.num_rows)):
@@ -0,0 +1,111 @@
+import numpy as np
+
+
+class DistanceMatrix:
+    """Sparse symmetric matrix of distances between particles, stored in CSR form: the distances in row i are
+    `distances[offsets[i]:offsets[i+1]]`, at columns `indices[offsets[i]:offsets[i+1]]` (sorted). Rows and columns are
+    particle indices; `ids` optionally maps them to particle IDs."""
+
+    def __init__(self, offsets, indices, distances, ids=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.ids = None if ids is None else np.asarray(ids)
+        self._keys = None
+        self._rows_by_id = None
+
+    @classmethod
+    def from_pairs(cls, i, j, distances, n, ids=None):
+        """Builds the matrix of n particles from each pair (i, j, distance), given once."""
+
+        rows = np.concatenate((i, j)).astype(np.int64)
+        cols = np.concatenate((j, i)).astype(np.int64)
+        order = np.lexsort((cols, rows))
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+        return cls(offsets, cols[order], np.concatenate((distances, distances))[order], ids)
+
+    @property
+    def n(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nnz(self):
+        """Number of stored entries (twice the number of pairs)."""
+        return len(self.indices)
+
+    def row(self, i):
+        """Returns (columns, distances) arrays of row i."""
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.indices[start:end], self.distances[start:end]
+
+    def get(self, i, j, default=None):
+        """Distance between particles i and j, or `default` if it's not stored."""
+
+        columns, distances = self.row(i)
+        k = int(np.searchsorted(columns, j))
+        return float(distances[k]) if k < len(columns) and columns[k] == j else default
+
+    def lookup(self, i, j):
+        """Vectorized #get: distances between particles i[k] and j[k] for each k, NaN where not stored."""
+
+        if self._keys is None:
+            # Row-major keys are sorted, since columns are sorted within each row
+            self._keys = np.repeat(np.arange(self.n, dtype=np.int64), np.diff(self.offsets)) * self.n + self.indices
+        keys = np.asarray(i, dtype=np.int64) * self.n + np.asarray(j, dtype=np.int64)
+        if len(self._keys) == 0:
+            return np.full(keys.shape, np.nan)
+        positions = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        return np.where(self._keys[positions] == keys, self.distances[positions], np.nan)
+
+    def index_of(self, id):
+        """Row of the particle with the given ID."""
+
+        if self._rows_by_id is None:
+            self._rows_by_id = {id: row for row, id in enumerate(self.ids.tolist())}
+        return self._rows_by_id[id]
+
+    def by_id(self, id1, id2, default=None):
+        """Distance between the particles with the given IDs, or `default` if it's not stored."""
+
+        return self.get(self.index_of(id1), self.index_of(id2), default)
+
+    def coo(self):
+        """Returns (rows, columns, distances) arrays with every stored entry."""
+
+        return np.repeat(np.arange(self.n, dtype=np.int64), np.diff(self.offsets)), self.indices, self.distances
+
+    def to_scipy(self):
+        """Converts to a scipy.sparse CSR matrix. Requires SciPy."""
+
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.distances, self.indices, self.offsets), shape=(self.n, self.n))
+
+    def save(self, output):
+        """Writes the matrix to an .npz file, see #load."""
+
+        arrays = dict(offsets=self.offsets, indices=self.indices, distances=self.distances)
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+        np.savez(output, **arrays)
+
+    @classmethod
+    def load(cls, input):
+        """Reads a matrix written with #save."""
+
+        with np.load(input) as data:
+            return cls(data['offsets'], data['indices'], data['distances'], data['ids'] if 'ids' in data else None)
+
+    def __getitem__(self, key):
+        i, j = key
+        result = self.get(i, j)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+    def __len__(self):
+        return self.nnz
@@ -0,0 +1,398 @@
+import math
+
+import numpy as np
+
+from ss.cim.array_cell_index_method import ArrayCellIndexMethod
+from ss.cim.board import Board
+from ss.cim.cell_index_method import CellIndexMethod
+
+
+class KdTree(ArrayCellIndexMethod):
+    """Bucketed k-d tree neighbor search, for boards with strongly uneven densities (e.g. grains piled at the bottom of
+    a silo, or pedestrians crowding at a door) where a uniform grid has either huge or mostly empty cells. Nodes are
+    split at the median of their longest side until they hold at most `bucket_size` particles, so leaves adapt to the
+    local density. Pairs are found by walking the tree against itself, only descending into couples of nodes whose
+    bounding boxes are within the interaction radius.
+
+    Has the same interface as ArrayCellIndexMethod (neighbors, pairs, queries) and accepts the same keyword arguments
+    except the cell related ones (m, mx, my, autotune) and `workers`, plus:
+        - bucket_size: Max number of particles in a leaf. Defaults to 16.
+        - rebuild_ratio: See #update. Defaults to 1.5.
+    Like SparseCellIndexMethod, particles may have any (finite) coordinates, since the tree covers wherever they are;
+    width and height are only used to estimate densities. Periodic boards are not supported, use #best_index to fall
+    back to a grid for them."""
+
+    # Cost model weights used by #best_index, in units of the time the grid takes to check a candidate pair (and keep it
+    # if it's a neighbor). Visiting an empty cell is much cheaper than that, while placing a particle in the tree (and
+    # walking the tree for it) is several times more expensive than binning it. Measured with NumPy 2
+    GRID_CELL_COST = 0.03
+    GRID_PARTICLE_COST = 3
+    TREE_PARTICLE_COST = 15
+    TREE_PAIR_COST = 1.25
+
+    def __init__(self, xs, ys, radii=None, **kwargs):
+        self.bucket_size = kwargs.get('bucket_size', 16)
+        self.rebuild_ratio = kwargs.get('rebuild_ratio', 1.5)
+        if self.bucket_size < 1:
+            raise Exception("Bucket size must be at least 1 (bucket size = %g)" % self.bucket_size)
+        if kwargs.get('periodic', False):
+            raise Exception("Periodic boards are not supported by KdTree, use ArrayCellIndexMethod")
+        self.node_start = self.node_end = self.left = self.right = None
+        self.bounds = self.node_max_radius = None
+        self.levels = []    # IDs of the nodes split at each depth, root first
+        self.built_extent = 0
+        self.rebuild_count = 0
+        super().__init__(xs, ys, radii, **kwargs)
+
+    @staticmethod
+    def occupancy(xs, ys, radii, radius, width, height):
+        """Occupancy of the cells of the grid ArrayCellIndexMethod would use.
+
+        :return (cells, mean, variance): number of cells, and mean and variance of the number of particles per cell."""
+
+        max_radius = float(np.max(radii)) if len(radii) > 0 else 0
+        num_cols = max(1, CellIndexMethod.optimal_m(width, radius, max_radius))
+        num_rows = max(1, CellIndexMethod.optimal_m(height, radius, max_radius))
+        # Particles out of the board (which SparseCellIndexMethod and KdTree accept) count in the closest cell
+        cols = np.clip(np.floor(np.asarray(xs) / (width / num_cols)), 0, num_cols - 1).astype(np.int64)
+        rows = np.clip(np.floor(np.asarray(ys) / (height / num_rows)), 0, num_rows - 1).astype(np.int64)
+        counts = np.bincount(rows * num_cols + cols, minlength=num_cols * num_rows)
+        return len(counts), float(counts.mean()), float(counts.var())
+
+    @classmethod
+    def prefers_tree(cls, xs, ys, radii, radius, width, height):
+        """Whether a tree is expected to be faster than a uniform grid for the given particles. Candidate pairs of the
+        grid grow with the sum of squared cell occupancies, cells * (variance + mean ** 2), and the tree checks about
+        as many, so the tree wins when particles are clustered on a board whose empty cells outnumber them."""
+
+        n = len(xs)
+        cells, mean, variance = cls.occupancy(xs, ys, radii, radius, width, height)
+        # Each particle is checked against its own cell and half shell, about 4.5 cells of similar occupancy
+        pair_checks = 4.5 * cells * (variance + mean ** 2)
+        grid = cells * cls.GRID_CELL_COST + n * cls.GRID_PARTICLE_COST + pair_checks
+        tree = n * cls.TREE_PARTICLE_COST + pair_checks * cls.TREE_PAIR_COST
+        return tree < grid
+
+    @classmethod
+    def best_index(cls, xs, ys, radii=None, **kwargs):
+        """Builds a KdTree when it's expected to be faster than a uniform grid (see #prefers_tree) and the board isn't
+        periodic, or else a grid. Takes the keyword arguments of both, plus:
+            - grid: Class of the grid, ArrayCellIndexMethod or one of its subclasses (e.g. SparseCellIndexMethod for
+            particles that may leave the board). Defaults to ArrayCellIndexMethod."""
+
+        grid = kwargs.pop('grid', ArrayCellIndexMethod)
+        xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+        radii = np.zeros(len(xs)) if radii is None else np.asarray(radii, dtype=np.float64)
+        if kwargs.get('periodic', False) or len(xs) == 0:
+            return grid(xs, ys, radii, **kwargs)
+
+        width, height = kwargs.get('width', -1), kwargs.get('height', -1)
+        width = float(xs.max()) + Board.EPSILON if width == -1 else width
+        height = float(ys.max()) + Board.EPSILON if height == -1 else height
+        if cls.prefers_tree(xs, ys, radii, kwargs['radius'], width, height):
+            return cls(xs, ys, radii, **kwargs)
+        return grid(xs, ys, radii, **kwargs)
+
+    @classmethod
+    def best_index_from_particles(cls, particles, **kwargs):
+        """Like #best_index for a list of Particles, see ArrayCellIndexMethod#from_particles."""
+
+        xs = np.fromiter((p.x for p in particles), dtype=np.float64, count=len(particles))
+        ys = np.fromiter((p.y for p in particles), dtype=np.float64, count=len(particles))
+        radii = np.fromiter((p.radius for p in particles), dtype=np.float64, count=len(particles))
+        kwargs['particles'] = particles
+        return cls.best_index(xs, ys, radii, **kwargs)
+
+    def create_board(self):
+        """Fills in missing board dimensions. There are no cells."""
+
+        if self.width == -1 or self.height == -1:
+            if len(self.xs) == 0:
+                raise Exception("Can't calculate board size without particles, specify width and height")
+            if self.width == -1:
+                self.width = float(self.xs.max()) + Board.EPSILON
+            if self.height == -1:
+                self.height = float(self.ys.max()) + Board.EPSILON
+        self.workers = 1
+
+    def check_particles_in_bounds(self):
+        """Any finite coordinates are valid, see SparseCellIndexMethod#check_particles_in_bounds."""
+
+        invalid = ~(np.isfinite(self.xs) & np.isfinite(self.ys))
+        if invalid.any():
+            i = int(np.flatnonzero(invalid)[0])
+            raise Exception("Particle #%i @ (%g, %g) has invalid coordinates" % (i, self.xs[i], self.ys[i]))
+
+    def bin(self):
+        """Builds the tree. Particles in node k are `order[node_start[k]:node_end[k]]`, nodes without children are
+        leaves (`left` and `right` are -1)."""
+
+        n = len(self.xs)
+        self.order = np.arange(n)
+        starts, ends, lefts, rights = [np.zeros(1, dtype=np.int64)], [np.full(1, n, dtype=np.int64)], [], []
+        self.levels = []
+        num_nodes = 1
+        frontier, frontier_starts, frontier_ends = np.zeros(1, dtype=np.int64), starts[0], ends[0]
+        while True:
+            split = frontier_ends - frontier_starts > self.bucket_size
+            lefts.append(np.full(len(frontier), -1, dtype=np.int64))
+            rights.append(np.full(len(frontier), -1, dtype=np.int64))
+            if not split.any():
+                break
+            nodes, node_starts, node_ends = frontier[split], frontier_starts[split], frontier_ends[split]
+            self.levels.append(nodes)
+
+            # Sort the particles of each node along the longest side of the node
+            sizes = node_ends - node_starts
+            segments, positions = self.expand_ranges_once(node_starts, sizes)
+            particles = self.order[positions]
+            boundaries = np.cumsum(sizes) - sizes
+            spread_x = np.maximum.reduceat(self.xs[particles], boundaries) - \
+                np.minimum.reduceat(self.xs[particles], boundaries)
+            spread_y = np.maximum.reduceat(self.ys[particles], boundaries) - \
+                np.minimum.reduceat(self.ys[particles], boundaries)
+            keys = np.where((spread_x >= spread_y)[segments], self.xs[particles], self.ys[particles])
+            self.order[positions] = particles[np.lexsort((keys, segments))]
+
+            # Split at the median
+            middles = (node_starts + node_ends) // 2
+            children = num_nodes + np.arange(2 * len(nodes))
+            lefts[-1][split], rights[-1][split] = children[0::2], children[1::2]
+            frontier = children
+            frontier_starts = np.stack((node_starts, middles), axis=1).ravel()
+            frontier_ends = np.stack((middles, node_ends), axis=1).ravel()
+            starts.append(frontier_starts)
+            ends.append(frontier_ends)
+            num_nodes += len(children)
+
+        self.node_start, self.node_end = np.concatenate(starts), np.concatenate(ends)
+        self.left, self.right = np.concatenate(lefts), np.concatenate(rights)
+        self.refit()
+        self.built_extent = self.leaf_extent()
+        self.rebuild_count += 1
+
+    @staticmethod
+    def expand_ranges_once(firsts, lengths):
+        """Returns (range, firsts[range] + k) arrays for 0 <= k < lengths[range], see ArrayCellIndexMethod#expand_ranges.
+        """
+
+        range_starts = np.cumsum(lengths) - lengths
+        positions = np.repeat(firsts - range_starts, lengths) + np.arange(int(lengths.sum()))
+        return np.repeat(np.arange(len(lengths)), lengths), positions
+
+    def refit(self):
+        """Recomputes the bounding boxes (of particle centers) and biggest radius of every node for current positions,
+        keeping the tree's structure."""
+
+        num_nodes = len(self.node_start)
+        self.bounds = np.zeros((num_nodes, 4))
+        self.bounds[:, :2], self.bounds[:, 2:] = np.inf, -np.inf
+        self.node_max_radius = np.zeros(num_nodes)
+
+        leaves = np.flatnonzero((self.left == -1) & (self.node_end > self.node_start))
+        if len(leaves) > 0:
+            # Leaves are disjoint ranges of sorted positions, sorting them by start covers every particle in order
+            leaves = leaves[np.argsort(self.node_start[leaves])]
+            xs, ys, radii = self.xs[self.order], self.ys[self.order], self.radii[self.order]
+            boundaries = self.node_start[leaves]
+            self.bounds[leaves] = np.stack((np.minimum.reduceat(xs, boundaries), np.minimum.reduceat(ys, boundaries),
+                                            np.maximum.reduceat(xs, boundaries), np.maximum.reduceat(ys, boundaries)),
+                                           axis=1)
+            self.node_max_radius[leaves] = np.maximum.reduceat(radii, boundaries)
+
+        for nodes in reversed(self.levels):
+            left, right = self.left[nodes], self.right[nodes]
+            self.bounds[nodes, :2] = np.minimum(self.bounds[left, :2], self.bounds[right, :2])
+            self.bounds[nodes, 2:] = np.maximum(self.bounds[left, 2:], self.bounds[right, 2:])
+            self.node_max_radius[nodes] = np.maximum(self.node_max_radius[left], self.node_max_radius[right])
+
+    def leaf_extent(self):
+        """Sum of the half perimeters of the bounding boxes of the leaves, which grows as particles move away from the
+        rest of their leaf, see #update."""
+
+        leaves = (self.left == -1) & (self.node_end > self.node_start)
+        return float((self.bounds[leaves, 2:] - self.bounds[leaves, :2]).sum())
+
+    def update(self, xs=None, ys=None, radii=None, particles=None):
+        """Recalculates neighbors after particles moved, taking the same arguments as ArrayCellIndexMethod#update. The
+        tree is refit to the new positions, and only rebuilt once leaves have spread out `rebuild_ratio` times their
+        size when built, or when the number of particles changed.
+
+        :return The updated offsets, indices and distances, see #calculate_neighbors, or None without `search_pairs`"""
+
+        count = len(self.xs)
+        self.set_particles(xs, ys, radii, particles)
+        self.check_particles_in_bounds()
+        if len(self.xs) != count:
+            self.bin()
+        else:
+            self.refit()
+            if self.leaf_extent() > self.rebuild_ratio * self.built_extent:
+                self.bin()
+        if self.search_pairs:
+            return self.calculate_neighbors()
+
+    @staticmethod
+    def gaps(bounds, other_bounds):
+        """Distances between the given couples of bounding boxes (0 for overlapping boxes)."""
+
+        gap_x = np.maximum(np.maximum(bounds[:, 0] - other_bounds[:, 2], other_bounds[:, 0] - bounds[:, 2]), 0)
+        gap_y = np.maximum(np.maximum(bounds[:, 1] - other_bounds[:, 3], other_bounds[:, 1] - bounds[:, 3]), 0)
+        return np.hypot(gap_x, gap_y)
+
+    def leaf_pairs(self):
+        """Walks the tree against itself and returns (a, b) arrays with every couple of leaves (a == b included) whose
+        particles may be within the interaction radius of each other. Each couple appears once."""
+
+        found_a, found_b = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        a = b = np.zeros(1 if len(self.xs) > 0 else 0, dtype=np.int64)
+        while len(a) > 0:
+            leaf_a, leaf_b = self.left[a] == -1, self.left[b] == -1
+            done = leaf_a & leaf_b
+            found_a.append(a[done])
+            found_b.append(b[done])
+
+            # A node with itself: couples of its children
+            same = (a == b) & ~done
+            l, r = self.left[a[same]], self.right[a[same]]
+            next_a, next_b = [l, l, r], [l, r, r]
+
+            # Different nodes: split the biggest one that isn't a leaf
+            split_a = (a != b) & ~done & ~leaf_a & (leaf_b | (self.node_end[a] - self.node_start[a] >=
+                                                             self.node_end[b] - self.node_start[b]))
+            split_b = (a != b) & ~done & ~split_a
+            next_a += [self.left[a[split_a]], self.right[a[split_a]], a[split_b], a[split_b]]
+            next_b += [b[split_a], b[split_a], self.left[b[split_b]], self.right[b[split_b]]]
+
+            a, b = np.concatenate(next_a), np.concatenate(next_b)
+            near = self.gaps(self.bounds[a], self.bounds[b]) <= \
+                self.interaction_radius + self.node_max_radius[a] + self.node_max_radius[b]
+            a, b = a[near], b[near]
+
+        return np.concatenate(found_a), np.concatenate(found_b)
+
+    def calculate_pairs(self):
+        """Calculates every pair of particles within the interaction radius of each other, see
+        ArrayCellIndexMethod#calculate_pairs."""
+
+        a, b = self.leaf_pairs()
+        same = a == b
+
+        # Within a leaf, pair each particle with the ones after it. Across leaves, with every particle of the other leaf
+        homes_same = self.expand_ranges_once(self.node_start[a[same]], (self.node_end - self.node_start)[a[same]])[1]
+        leaves_same = np.repeat(a[same], (self.node_end - self.node_start)[a[same]])
+        sizes_a = (self.node_end - self.node_start)[a[~same]]
+        homes_cross = self.expand_ranges_once(self.node_start[a[~same]], sizes_a)[1]
+        homes = np.concatenate((homes_same, homes_cross))
+        firsts = np.concatenate((homes_same + 1, np.repeat(self.node_start[b[~same]], sizes_a)))
+        lengths = np.concatenate((self.node_end[leaves_same] - homes_same - 1,
+                                  np.repeat((self.node_end - self.node_start)[b[~same]], sizes_a)))
+
+        found_i, found_j, found_distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for chunk_homes, chunk_js in self.expand_ranges(homes, firsts, lengths):
+            i, j = self.order[chunk_homes], self.order[chunk_js]
+            distances = np.hypot(self.xs[j] - self.xs[i], self.ys[j] - self.ys[i]) - self.radii[i] - self.radii[j]
+            accepted = distances <= self.interaction_radius
+            found_i.append(i[accepted])
+            found_j.append(j[accepted])
+            found_distances.append(distances[accepted])
+
+        return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_distances)
+
+    def point_leaves(self, xs, ys, rs):
+        """Walks the tree for each of the given points and returns (q, leaf) arrays with every leaf that may hold
+        particles whose border is within distance rs[q] of point q."""
+
+        found_q, found_leaves = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        q = np.arange(len(xs) if len(self.xs) > 0 else 0)
+        nodes = np.zeros(len(q), dtype=np.int64)
+        while len(q) > 0:
+            points = np.stack((xs[q], ys[q], xs[q], ys[q]), axis=1)
+            near = self.gaps(points, self.bounds[nodes]) <= rs[q] + self.node_max_radius[nodes]
+            q, nodes = q[near], nodes[near]
+            leaves = self.left[nodes] == -1
+            found_q.append(q[leaves])
+            found_leaves.append(nodes[leaves])
+            q, nodes = np.concatenate((q[~leaves], q[~leaves])), \
+                np.concatenate((self.left[nodes[~leaves]], self.right[nodes[~leaves]]))
+
+        return np.concatenate(found_q), np.concatenate(found_leaves)
+
+    def query_radius_batch(self, xs, ys, r):
+        """See ArrayCellIndexMethod#query_radius_batch, the tree is walked for each point."""
+
+        xs, ys = self.to_board(xs, ys)
+        rs = np.broadcast_to(np.asarray(r, dtype=np.float64), xs.shape)
+        q, leaves = self.point_leaves(xs, ys, rs)
+
+        found_q, found_j, found_distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for q, positions in self.expand_ranges(q, self.node_start[leaves], self.node_end[leaves] -
+                                                                           self.node_start[leaves]):
+            j = self.order[positions]
+            distances = np.hypot(self.xs[j] - xs[q], self.ys[j] - ys[q]) - self.radii[j]
+            accepted = distances <= rs[q]
+            found_q.append(q[accepted])
+            found_j.append(j[accepted])
+            found_distances.append(distances[accepted])
+
+        return self.to_csr(np.concatenate(found_q), np.concatenate(found_j), np.concatenate(found_distances), len(xs))
+
+    def query_box(self, x_min, y_min, x_max, y_max):
+        """See ArrayCellIndexMethod#query_box. Boxes can't wrap around, since boards aren't periodic."""
+
+        half_width, half_height = (x_max - x_min) / 2, (y_max - y_min) / 2
+        center_x, center_y = np.array([x_min + half_width]), np.array([y_min + half_height])
+        _, leaves = self.point_leaves(center_x, center_y, np.array([math.hypot(half_width, half_height)]))
+
+        found = [np.zeros(0, dtype=np.int64)]
+        for _, positions in self.expand_ranges(np.zeros(len(leaves), dtype=np.int64), self.node_start[leaves],
+                                               self.node_end[leaves] - self.node_start[leaves]):
+            j = self.order[positions]
+            dx = np.maximum(np.abs(self.xs[j] - center_x[0]) - half_width, 0)
+            dy = np.maximum(np.abs(self.ys[j] - center_y[0]) - half_height, 0)
+            found.append(j[np.hypot(dx, dy) <= self.radii[j]])
+        return np.sort(np.concatenate(found))
+
+    def query_knn(self, xs, ys, k, exclude=None):
+        """See ArrayCellIndexMethod#query_knn. Points are queried with #query_radius_batch, starting with the radius
+        expected to hold k particles on average and doubling it for the points with less than k particles found."""
+
+        xs, ys = self.to_board(xs, ys)
+        n = len(xs)
+        best = np.full((n, k), -1, dtype=np.int64)
+        best_distances = np.full((n, k), np.inf)
+        if n == 0 or k <= 0 or len(self.xs) == 0:
+            return best, best_distances
+        exclude = None if exclude is None else np.asarray(exclude, dtype=np.int64)
+        wanted = min(k, len(self.xs) - (0 if exclude is None else 1))
+
+        # Every particle is within this radius of any of the points
+        root = self.bounds[0]
+        max_r = math.hypot(max(root[2] - xs.min(), xs.max() - root[0]), max(root[3] - ys.min(), ys.max() - root[1]))
+        r = math.sqrt((k + 1) * self.width * self.height / (math.pi * len(self.xs)))
+        active = np.arange(n)
+        while len(active) > 0:
+            offsets, indices, distances = self.query_radius_batch(xs[active], ys[active], r)
+            q = np.repeat(np.arange(len(active)), np.diff(offsets))
+            if exclude is not None:
+                kept = indices != exclude[active][q]
+                q, indices, distances = q[kept], indices[kept], distances[kept]
+            counts = np.bincount(q, minlength=len(active))
+            done = (counts >= wanted) | (r >= max_r)
+
+            order = np.lexsort((indices, distances, q))
+            q, indices, distances = q[order], indices[order], distances[order]
+            ranks = np.arange(len(q)) - np.repeat(np.cumsum(counts) - counts, counts)
+            kept = done[q] & (ranks < k)
+            best[active[q[kept]], ranks[kept]] = indices[kept]
+            best_distances[active[q[kept]], ranks[kept]] = distances[kept]
+            active = active[~done]
+            r *= 2
+
+        return best, best_distances
+
+    def __str__(self):
+        leaves = self.left == -1
+        sizes = (self.node_end - self.node_start)[leaves]
+        return "k-d tree with %i nodes, %i leaves of up to %i particles (mean %g)" % (
+            len(self.left), int(leaves.sum()), self.bucket_size, sizes.mean() if len(sizes) > 0 else 0)
@@ -0,0 +1,82 @@
+from collections.abc import MutableMapping
+from numbers import Integral
+
+
+class NeighborView(MutableMapping):
+    """Dictionary-like view over neighbors stored in CSR form (`offsets`, `indices`, `distances`), behaving like the
+    `neighbors` defaultdict of CellIndexMethod: `view[key]` is a list of (neighbor, distance) tuples, and an empty list
+    for keys without neighbors. Lists are only built when a key is first accessed, and are then kept so that callers
+    may append to or replace them just like with the original dictionary."""
+
+    def __init__(self, offsets, indices, distances, keys=None, items=None, ends=None):
+        """
+        :arg offsets : array of N+1 ints. Neighbors of row i are in positions [offsets[i], offsets[i+1]).
+        :arg indices : array of ints, row numbers of each neighbor.
+        :arg distances : array of floats, distance to each neighbor.
+        :arg keys : (Optional) sequence of N keys (e.g. particle IDs) used to access each row. Defaults to row numbers.
+        :arg items : (Optional) sequence of N objects (e.g. particles) returned in place of neighbor row numbers.
+        :arg ends : (Optional) array of N ints. If provided, neighbors of row i are only those in positions
+                    [offsets[i], ends[i]), e.g. the ones within a smaller cutoff.
+        """
+        self.offsets = offsets
+        self.indices = indices
+        self.distances = distances
+        self.keys_list = keys
+        self.items_list = items
+        self.ends = offsets[1:] if ends is None else ends
+        self._rows = None if keys is None else {key: row for row, key in enumerate(keys)}
+        self._cache = dict()
+        self._deleted = set()
+
+    def row(self, key):
+        """Row number of the given key, or None if the key is unknown."""
+        if self._rows is not None:
+            return self._rows.get(key)
+        return key if isinstance(key, Integral) and 0 <= key < len(self.offsets) - 1 else None
+
+    def _build(self, row):
+        start, end = self.offsets[row], self.ends[row]
+        neighbor_rows = self.indices[start:end].tolist()
+        distances = self.distances[start:end].tolist()
+        if self.items_list is not None:
+            neighbor_rows = [self.items_list[i] for i in neighbor_rows]
+        return list(zip(neighbor_rows, distances))
+
+    def __getitem__(self, key):
+        if key in self._cache:
+            return self._cache[key]
+
+        row = None if key in self._deleted else self.row(key)
+        # Keep defaultdict behavior, unknown keys get (and store) an empty list
+        result = [] if row is None else self._build(row)
+        self._cache[key] = result
+        self._deleted.discard(key)
+        return result
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._cache.pop(key, None)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._cache:
+            return True
+        if key in self._deleted:
+            return False
+        row = self.row(key)
+        return row is not None and self.ends[row] > self.offsets[row]
+
+    def __iter__(self):
+        for row in range(len(self.offsets) - 1):
+            key = row if self.keys_list is None else self.keys_list[row]
+            if key not in self._cache and key not in self._deleted and self.ends[row] > self.offsets[row]:
+                yield key
+        yield from self._cache
+
+    def __len__(self):
+        return sum(1 for _ in self)
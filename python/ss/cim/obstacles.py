@@ -0,0 +1,172 @@
+import math
+
+import numpy as np
+
+
+class Obstacles:
+    """Static walls of a simulation as line segments: box boundaries, walls with slits (e.g. a door or an aperture) or
+    any other segment. Segments are indexed once into a grid of cells, keeping for each cell the segments that may be
+    within reach of its particles, so particle-wall contacts are found with the same cell pass as particle pairs instead
+    of creating fake wall particles for every particle on every step.
+
+    Contacts have the same form as neighbor pairs: (dx, dy) goes from the particle's center to the closest point of the
+    segment, and distance is measured from the particle's border to that point (negative when they overlap)."""
+
+    def __init__(self):
+        self.x1 = np.zeros(0)
+        self.y1 = np.zeros(0)
+        self.x2 = np.zeros(0)
+        self.y2 = np.zeros(0)
+        # Python copies of the segments, for scalar distances
+        self.segments = []
+        # Cached indexes of segments per cell, keyed by grid
+        self.cell_indexes = dict()
+        self.grid = None
+
+    def add_segment(self, x1, y1, x2, y2):
+        """Adds the segment from (x1, y1) to (x2, y2). Segments can't be added after they are indexed.
+
+        :return The index of the new segment"""
+
+        if self.cell_indexes or self.grid is not None:
+            raise Exception("Obstacles are already indexed, can't add segments")
+        self.x1, self.y1 = np.append(self.x1, float(x1)), np.append(self.y1, float(y1))
+        self.x2, self.y2 = np.append(self.x2, float(x2)), np.append(self.y2, float(y2))
+        self.segments.append((float(x1), float(y1), float(x2), float(y2)))
+        return len(self.segments) - 1
+
+    def add_box(self, x_min, y_min, x_max, y_max):
+        """Adds the 4 sides of a box, in order: bottom, right, top and left.
+
+        :return List with the indices of the new segments"""
+
+        return [self.add_segment(x_min, y_min, x_max, y_min), self.add_segment(x_max, y_min, x_max, y_max),
+                self.add_segment(x_max, y_max, x_min, y_max), self.add_segment(x_min, y_max, x_min, y_min)]
+
+    def add_slit(self, x1, y1, x2, y2, gap_start, gap_end):
+        """Adds a wall from (x1, y1) to (x2, y2) with an opening, as up to 2 segments. The edges of the opening are the
+        segments' ends, so particles going through it bounce off them like off corners.
+
+        :arg gap_start : Distance from (x1, y1) along the wall to where the opening starts.
+        :arg gap_end : Distance from (x1, y1) along the wall to where the opening ends.
+        :return List with the indices of the new segments"""
+
+        length = math.hypot(x2 - x1, y2 - y1)
+        if not 0 <= gap_start <= gap_end <= length:
+            raise Exception("Invalid opening [%g, %g] for a wall of length %g" % (gap_start, gap_end, length))
+        ux, uy = (x2 - x1) / length, (y2 - y1) / length
+        result = []
+        if gap_start > 0:
+            result.append(self.add_segment(x1, y1, x1 + ux * gap_start, y1 + uy * gap_start))
+        if gap_end < length:
+            result.append(self.add_segment(x1 + ux * gap_end, y1 + uy * gap_end, x2, y2))
+        return result
+
+    def __len__(self):
+        return len(self.segments)
+
+    def contact(self, segment, x, y, radius):
+        """Contact between a particle and a segment, as a (dx, dy, distance) tuple."""
+
+        x1, y1, x2, y2 = self.segments[segment]
+        ex, ey = x2 - x1, y2 - y1
+        length = ex * ex + ey * ey
+        t = ((x - x1) * ex + (y - y1) * ey) / length if length > 0 else 0
+        t = 0 if t < 0 else 1 if t > 1 else t
+        delta_x, delta_y = x1 + t * ex - x, y1 + t * ey - y
+        return delta_x, delta_y, math.sqrt(delta_x * delta_x + delta_y * delta_y) - radius
+
+    def contacts(self, segments, xs, ys, radii):
+        """Vectorized #contact, for arrays of segment indices and particle coordinates and radii.
+
+        :return (dx, dy, distances) arrays"""
+
+        x1, y1 = self.x1[segments], self.y1[segments]
+        ex, ey = self.x2[segments] - x1, self.y2[segments] - y1
+        length = ex * ex + ey * ey
+        t = np.clip(((xs - x1) * ex + (ys - y1) * ey) / np.where(length > 0, length, 1), 0, 1)
+        delta_x, delta_y = x1 + t * ex - xs, y1 + t * ey - ys
+        return delta_x, delta_y, np.hypot(delta_x, delta_y) - radii
+
+    def cell_segments(self, num_cols, num_rows, cell_width, cell_height, reach, origin_x=0, origin_y=0):
+        """Indexes segments into a grid of num_cols x num_rows cells of the given size, whose bottom left corner is at
+        (origin_x, origin_y). A segment is kept for every cell with some point within `reach` of it, so any particle in
+        the cell whose border is within R of the segment is found with reach >= R + (biggest particle radius). Indexes
+        are cached, so this is only computed once per grid.
+
+        :return (starts, segments) arrays: segments of the cell at (col, row) are segments[starts[c]:starts[c + 1]],
+        where c = row * num_cols + col"""
+
+        key = (num_cols, num_rows, cell_width, cell_height, reach, origin_x, origin_y)
+        if key in self.cell_indexes:
+            return self.cell_indexes[key]
+
+        cells, segments = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        half_diagonal = math.hypot(cell_width, cell_height) / 2
+        for segment, (x1, y1, x2, y2) in enumerate(self.segments):
+            # Cells overlapping the segment's bounding box grown by reach...
+            first_col = max(math.floor((min(x1, x2) - reach - origin_x) / cell_width), 0)
+            last_col = min(math.floor((max(x1, x2) + reach - origin_x) / cell_width), num_cols - 1)
+            first_row = max(math.floor((min(y1, y2) - reach - origin_y) / cell_height), 0)
+            last_row = min(math.floor((max(y1, y2) + reach - origin_y) / cell_height), num_rows - 1)
+            if first_col > last_col or first_row > last_row:
+                continue
+            cols, rows = np.meshgrid(np.arange(first_col, last_col + 1), np.arange(first_row, last_row + 1))
+            cols, rows = cols.ravel(), rows.ravel()
+            # ...whose center is close enough to the segment for some point of the cell to be within reach
+            centers_x, centers_y = origin_x + (cols + 0.5) * cell_width, origin_y + (rows + 0.5) * cell_height
+            _, _, distances = self.contacts(np.full(len(cols), segment), centers_x, centers_y, 0)
+            close = distances <= reach + half_diagonal
+            cells.append(rows[close] * num_cols + cols[close])
+            segments.append(np.full(int(close.sum()), segment, dtype=np.int64))
+
+        cells, segments = np.concatenate(cells), np.concatenate(segments)
+        order = np.argsort(cells, kind='stable')
+        starts = np.zeros(num_cols * num_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=num_cols * num_rows), out=starts[1:])
+        self.cell_indexes[key] = starts, segments[order]
+        return self.cell_indexes[key]
+
+    def index(self, reach):
+        """Indexes segments into a grid of its own, covering their bounding box grown by `reach` with cells about
+        `reach` long (capped to about 10^6 cells), for searches that don't have a bounded grid of their own. Reindexes
+        only when reach grows.
+
+        :return (origin_x, origin_y, cell_side, num_cols, num_rows, starts, segments)"""
+
+        if self.grid is not None and self.grid[0] >= reach:
+            return self.grid[1:]
+        x_min, y_min = min(self.x1.min(), self.x2.min()) - reach, min(self.y1.min(), self.y2.min()) - reach
+        width = max(self.x1.max(), self.x2.max()) + reach - x_min
+        height = max(self.y1.max(), self.y2.max()) + reach - y_min
+        side = max(reach, math.sqrt(width * height / (1 << 20)), 1e-9)
+        num_cols, num_rows = math.floor(width / side) + 1, math.floor(height / side) + 1
+        starts, segments = self.cell_segments(num_cols, num_rows, side, side, reach, x_min, y_min)
+        self.grid = (reach, x_min, y_min, side, num_cols, num_rows, starts, segments)
+        return self.grid[1:]
+
+    def find_contacts(self, xs, ys, radii, radius):
+        """Contacts between particles and segments within the given radius, checking for each particle only the
+        segments indexed in its cell (see #index).
+
+        :return (i, segments, dx, dy, distances) arrays, where i are indices of particles"""
+
+        xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), xs.shape)
+        if len(self.segments) == 0 or len(xs) == 0:
+            empty = np.zeros(0)
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), empty, empty, empty
+
+        origin_x, origin_y, side, num_cols, num_rows, starts, segments = self.index(radius + float(radii.max()))
+        cols, rows = np.floor((xs - origin_x) / side), np.floor((ys - origin_y) / side)
+        # Particles off the grid are farther than reach from every segment
+        inside = np.flatnonzero((cols >= 0) & (cols < num_cols) & (rows >= 0) & (rows < num_rows))
+        cells = rows[inside].astype(np.int64) * num_cols + cols[inside].astype(np.int64)
+        counts = starts[cells + 1] - starts[cells]
+        i = np.repeat(inside, counts)
+        # Position of each candidate within its particle's cell range
+        offsets = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = segments[np.repeat(starts[cells], counts) + offsets]
+        delta_x, delta_y, distances = self.contacts(candidates, xs[i], ys[i], radii[i])
+        close = distances <= radius
+        return i[close], candidates[close], delta_x[close], delta_y[close], distances[close]
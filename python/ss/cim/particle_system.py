@@ -0,0 +1,360 @@
+import math
+
+import numpy as np
+from euclid3 import Vector2
+
+from ss.cim.particle import Particle
+from ss.cim.space_filling_curve import SpaceFillingCurve
+
+
+class ParticleSystem:
+    """Particles stored as a structure of arrays: positions, velocities and accelerations are (N, 2) float arrays, and
+    radii, masses and IDs are N-long arrays, all indexed by dense particle indices (0 to N-1). Whole-system code works on
+    the arrays directly (neighbor search with ArrayCellIndexMethod#from_system, integration with verlet#step, output
+    with OvitoWriter#write_system or TrajectoryWriter#write_system), while `system[i]` gives a Particle-like view for
+    code written for Particle objects.
+
+    Arrays are allocated with spare room and grow as particles are added, so always access them through the properties,
+    which only expose the N particles in use. Previous positions, velocities and accelerations are only allocated once
+    something stores them, and are NaN until set.
+
+    Storage may be reordered (see #sort_spatially) to keep particles that are close in space close in memory. The
+    insertion order is kept in `order`, and iterating over the system always follows it, so IDs, output files and
+    observables don't depend on how particles are stored."""
+
+    VECTORS = ('positions', 'velocities', 'accelerations')
+    SCALARS = ('radii', 'masses')
+
+    def __init__(self, capacity=16):
+        self.n = 0
+        self.capacity = max(1, capacity)
+        self._vectors = {name: np.full((self.capacity, 2), np.nan) for name in self.VECTORS}
+        self._scalars = {name: np.zeros(self.capacity) for name in self.SCALARS}
+        self._ids = np.zeros(self.capacity, dtype=np.int64)
+        self._order = np.zeros(self.capacity, dtype=np.int64)
+        self._views = []
+
+    @classmethod
+    def from_particles(cls, particles):
+        """Builds a system with the state of the given Particles, keeping their IDs."""
+
+        result = cls(len(particles))
+        for particle in particles:
+            i = result.add(particle.x, particle.y, radius=particle.radius, mass=particle.mass, id=particle.id)
+            result.velocities[i] = particle.velocity.x, particle.velocity.y
+            result.accelerations[i] = particle.acceleration.x, particle.acceleration.y
+            for attribute, name in (('previous_position', 'previous_positions'),
+                                    ('previous_velocity', 'previous_velocities'),
+                                    ('previous_acceleration', 'previous_accelerations')):
+                previous = getattr(particle, attribute)
+                if previous is not None:
+                    result.vectors(name)[i] = previous.x, previous.y
+        return result
+
+    def add(self, x, y, radius=0.0, mass=0.0, v=0.0, o=0.0, id=None):
+        """Adds a particle, with the same arguments as Particle (speed `v` and angle `o`). Unless given, the ID is the
+        particle's index. Returns the index of the new particle."""
+
+        if self.n == self.capacity:
+            self.grow(2 * self.capacity)
+
+        i = self.n
+        self.n += 1
+        for array in self._vectors.values():
+            array[i] = np.nan
+        self.positions[i] = x, y
+        self.velocities[i] = math.cos(o) * v, math.sin(o) * v
+        self.accelerations[i] = 0, 0
+        self.radii[i] = radius
+        self.masses[i] = mass
+        self.ids[i] = i if id is None else id
+        self.order[i] = i
+        self._views.append(None)
+        return i
+
+    def remove(self, i):
+        """Removes the particle at index i by moving the last particle to its place, so indices stay dense. Views of the
+        moved particle follow it to its new index, views of the removed particle can no longer be used."""
+
+        last = self.n - 1
+        # Take i out of the insertion order, and follow the last particle to its new index
+        order = self.order
+        position = int(np.flatnonzero(order == i)[0])
+        order[position:last] = order[position + 1:].copy()
+        order[:last][order[:last] == last] = i
+        for array in list(self._vectors.values()) + list(self._scalars.values()) + [self._ids]:
+            array[i] = array[last]
+        if self._views[i] is not None:
+            self._views[i].index = None
+        self._views[i] = self._views[last]
+        if self._views[i] is not None:
+            self._views[i].index = i
+        self._views.pop()
+        self.n -= 1
+
+    def grow(self, capacity):
+        """Reallocates arrays with room for `capacity` particles."""
+
+        for name in self._vectors:
+            array = np.full((capacity, 2), np.nan)
+            array[:self.n] = self._vectors[name][:self.n]
+            self._vectors[name] = array
+        for name in self.SCALARS:
+            array = np.zeros(capacity)
+            array[:self.n] = self._scalars[name][:self.n]
+            self._scalars[name] = array
+        ids, order = np.zeros(capacity, dtype=np.int64), np.zeros(capacity, dtype=np.int64)
+        ids[:self.n], order[:self.n] = self._ids[:self.n], self._order[:self.n]
+        self._ids, self._order = ids, order
+        self.capacity = capacity
+
+    def reorder(self, permutation):
+        """Reorders storage so that the particle at index `permutation[k]` goes to index k. Views follow their
+        particles, and the insertion order is kept."""
+
+        permutation = np.asarray(permutation, dtype=np.int64)
+        for array in list(self._vectors.values()) + list(self._scalars.values()) + [self._ids]:
+            array[:self.n] = array[:self.n][permutation]
+        inverse = np.empty(self.n, dtype=np.int64)
+        inverse[permutation] = np.arange(self.n)
+        self.order[:] = inverse[self.order]
+        self._views = [self._views[i] for i in permutation.tolist()]
+        for i, view in enumerate(self._views):
+            if view is not None:
+                view.index = i
+
+    def sort_spatially(self, cell_size, curve='morton'):
+        """Reorders storage along a space-filling curve ('morton' or 'hilbert') over cells of the given side, usually
+        the neighbor search's cell side. Meant to be called every few steps, as particles move. Returns the permutation
+        applied, see #reorder."""
+
+        permutation = np.argsort(SpaceFillingCurve.keys(self.xs, self.ys, cell_size, curve), kind='stable')
+        self.reorder(permutation)
+        return permutation
+
+    def in_order(self, array):
+        """Given an array in storage order (e.g. `positions`, or a per-particle observable), returns it in insertion
+        order."""
+
+        return np.asarray(array)[self.order]
+
+    def move_to(self, positions):
+        """Moves every particle to the given (N, 2) positions, storing current ones as previous positions."""
+
+        self.previous_positions[:] = self.positions
+        self.positions[:] = positions
+
+    def set_velocities(self, velocities):
+        """Sets the (N, 2) velocities of every particle, storing current ones as previous velocities."""
+
+        self.previous_velocities[:] = self.velocities
+        self.velocities[:] = velocities
+
+    def set_accelerations(self, accelerations):
+        """Sets the (N, 2) accelerations of every particle, storing current ones as previous accelerations."""
+
+        self.previous_accelerations[:] = self.accelerations
+        self.accelerations[:] = accelerations
+
+    def vectors(self, name):
+        """(N, 2) array with the given name, allocating it if it's a previous state array that wasn't used yet."""
+
+        if name not in self._vectors:
+            self._vectors[name] = np.full((self.capacity, 2), np.nan)
+        return self._vectors[name][:self.n]
+
+    @property
+    def positions(self):
+        return self._vectors['positions'][:self.n]
+
+    @property
+    def velocities(self):
+        return self._vectors['velocities'][:self.n]
+
+    @property
+    def accelerations(self):
+        return self._vectors['accelerations'][:self.n]
+
+    @property
+    def previous_positions(self):
+        return self.vectors('previous_positions')
+
+    @property
+    def previous_velocities(self):
+        return self.vectors('previous_velocities')
+
+    @property
+    def previous_accelerations(self):
+        return self.vectors('previous_accelerations')
+
+    @property
+    def xs(self):
+        return self._vectors['positions'][:self.n, 0]
+
+    @property
+    def ys(self):
+        return self._vectors['positions'][:self.n, 1]
+
+    @property
+    def radii(self):
+        return self._scalars['radii'][:self.n]
+
+    @property
+    def masses(self):
+        return self._scalars['masses'][:self.n]
+
+    @property
+    def ids(self):
+        return self._ids[:self.n]
+
+    @property
+    def order(self):
+        """Storage indices of the particles, in insertion order."""
+        return self._order[:self.n]
+
+    def view(self, i):
+        """Particle-like view of the particle at index i. Views are cached, so the same object is always returned for a
+        given particle."""
+
+        if self._views[i] is None:
+            self._views[i] = ParticleView(self, i)
+        return self._views[i]
+
+    def __getitem__(self, i):
+        return self.view(i)
+
+    def __iter__(self):
+        """Iterates over views of the particles, in insertion order."""
+        return (self.view(i) for i in self.order.tolist())
+
+    def __len__(self):
+        return self.n
+
+
+class ParticleView:
+    """Particle-like view of a particle in a ParticleSystem, reading and writing the system's arrays. Vectors are
+    returned as new euclid3 Vector2 objects, so modifying them in place doesn't change the particle; assign them
+    instead. Scalars are read straight from the storage arrays with `item`, which is about as fast as reading the
+    attributes of a Particle, since code written for Particles (e.g. CellIndexMethod) reads them in tight loops."""
+
+    __slots__ = ('system', 'index')
+
+    is_fake = False
+    original_particle = None
+
+    def __init__(self, system, index):
+        self.system = system
+        self.index = index
+
+    def vector(self, name):
+        if name not in self.system._vectors:
+            return None
+        x, y = self.system._vectors[name][self.index]
+        return None if math.isnan(x) else Vector2(x, y)
+
+    def move_to(self, x, y):
+        """Moves this particle to the specified position."""
+
+        self.system.positions[self.index] = x, y
+
+    def move(self, delta_x, delta_y):
+        """Moves this particle the specified amounts in X and Y from its current position"""
+
+        self.move_to(self.x + delta_x, self.y + delta_y)
+
+    def distance_to(self, other):
+        center_distance = math.sqrt((other.x - self.x) ** 2 + (other.y - self.y) ** 2)
+        return center_distance - self.radius - other.radius
+
+    @property
+    def id(self):
+        return self.system._ids.item(self.index)
+
+    @property
+    def x(self):
+        return self.system._vectors['positions'].item(self.index, 0)
+
+    @property
+    def y(self):
+        return self.system._vectors['positions'].item(self.index, 1)
+
+    @property
+    def radius(self):
+        return self.system._scalars['radii'].item(self.index)
+
+    @radius.setter
+    def radius(self, value):
+        self.system.radii[self.index] = value
+
+    @property
+    def mass(self):
+        return self.system._scalars['masses'].item(self.index)
+
+    @mass.setter
+    def mass(self, value):
+        self.system.masses[self.index] = value
+
+    @property
+    def position(self):
+        return self.vector('positions')
+
+    @position.setter
+    def position(self, value):
+        self.system.previous_positions[self.index] = self.system.positions[self.index]
+        self.system.positions[self.index] = value.x, value.y
+
+    @property
+    def previous_position(self):
+        return self.vector('previous_positions')
+
+    def relative_position(self, other):
+        """Return other.position - self.position (ie. position relative to self)"""
+        return other.position - self.position
+
+    @property
+    def velocity(self):
+        return self.vector('velocities')
+
+    @velocity.setter
+    def velocity(self, value):
+        """Sets velocity. Value should be a tuple of the form `(mod, angle)`, like Particle#velocity. Stores current
+        velocity in previous_velocity property."""
+
+        self.system.previous_velocities[self.index] = self.system.velocities[self.index]
+        self.system.velocities[self.index] = math.cos(value[1]) * value[0], math.sin(value[1]) * value[0]
+
+    @property
+    def previous_velocity(self):
+        return self.vector('previous_velocities')
+
+    def relative_velocity(self, other):
+        """Return other.velocity - self.velocity (ie. relative to self)"""
+        return other.velocity - self.velocity
+
+    @property
+    def acceleration(self):
+        return self.vector('accelerations')
+
+    @acceleration.setter
+    def acceleration(self, value):
+        self.system.previous_accelerations[self.index] = self.system.accelerations[self.index]
+        self.system.accelerations[self.index] = value.x, value.y
+
+    @property
+    def previous_acceleration(self):
+        return self.vector('previous_accelerations')
+
+    def vel_angle(self):
+        """Returns the angle of the particle's velocity"""
+        vx, vy = self.system.velocities[self.index]
+        return math.atan2(vy, vx)
+
+    def vel_module(self):
+        vx, vy = self.system.velocities[self.index]
+        return math.sqrt(vx ** 2 + vy ** 2)
+
+    to_x_y = staticmethod(Particle.to_x_y)
+    to_v_o = staticmethod(Particle.to_v_o)
+
+    def __str__(self) -> str:
+        return "Particle #%i @ (%g, %g), r = %g" % (self.id, self.x, self.y, self.radius)
@@ -0,0 +1,139 @@
+import math
+
+import numpy as np
+
+from ss.cim.array_cell_index_method import ArrayCellIndexMethod
+
+
+class PolydisperseCellIndexMethod(ArrayCellIndexMethod):
+    """Cell Index Method for particles with mixed radii. Instead of sizing every cell by the biggest radius, particles
+    are split in radius classes (each class spans a factor of `ratio` in radius) and every class is binned on its own
+    grid, with cells of side Rc + 2 * (biggest radius of the class). Pairs within a class are searched on the class's
+    grid, and particles of smaller classes are searched for on the grids of bigger classes (their cells are big enough
+    for the pair). Neighbor semantics are the same as ArrayCellIndexMethod: particles are neighbors when the distance
+    between their borders is at most the interaction radius.
+
+    Accepts the same keyword arguments as ArrayCellIndexMethod (Mx and My are chosen per class, `m`, `mx` and `my`
+    are ignored), plus:
+        - ratio: Max ratio between the biggest and smallest radius of a class. Defaults to 2.
+        - levels: Max number of radius classes, smaller particles all go in the last class. Defaults to 4."""
+
+    def __init__(self, xs, ys, radii=None, **kwargs):
+        self.ratio = kwargs.get('ratio', 2)
+        self.max_levels = kwargs.get('levels', 4)
+        if self.ratio <= 1 or self.max_levels < 1:
+            raise Exception("Radius class ratio must be greater than 1 and there must be at least 1 level (ratio = %g, "
+                            "levels = %g)" % (self.ratio, self.max_levels))
+        self.levels = []    # (members, grid) for each radius class, from the smallest to the biggest radii
+        self.level_grids = {}   # Grid of each radius class, kept between bins (see #bin) so their worker pools are too
+        super().__init__(xs, ys, radii, **kwargs)
+
+    def level_m(self, l, max_radius):
+        """Cells along a side of length L for a class whose biggest radius is `max_radius`, so that cells are no smaller
+        than Rc + 2 * max_radius."""
+
+        return max(1, math.floor(l / (self.interaction_radius + 2 * max_radius)))
+
+    def classify(self):
+        """Assigns each particle a radius class, 0 being the class with the biggest particles. Returns an array with
+        the class of each particle."""
+
+        classes = np.full(len(self.radii), self.max_levels - 1, dtype=np.int64)
+        if len(self.radii) == 0:
+            return classes
+
+        max_radius = float(self.radii.max())
+        positive = self.radii > 0
+        classes[positive] = np.floor(np.log(max_radius / self.radii[positive]) / math.log(self.ratio))
+        return np.minimum(classes, self.max_levels - 1)
+
+    def bin(self):
+        """Splits particles in radius classes and bins each class on its own grid. Grids of previous bins are updated
+        (see ArrayCellIndexMethod#update) while their number of cells still fits their class, and built again
+        otherwise."""
+
+        classes = self.classify()
+        self.levels = []
+        for level in reversed(range(self.max_levels)):
+            members = np.flatnonzero(classes == level)
+            grid = self.level_grids.pop(level, None)
+            if len(members) == 0:
+                if grid is not None:
+                    grid.close()
+                continue
+
+            radii = self.radii[members]
+            mx, my = self.level_m(self.width, float(radii.max())), self.level_m(self.height, float(radii.max()))
+            if grid is not None and (grid.num_cols, grid.num_rows) == (mx, my):
+                grid.update(self.xs[members], self.ys[members], radii)
+            else:
+                if grid is not None:
+                    grid.close()
+                grid = ArrayCellIndexMethod(self.xs[members], self.ys[members], radii, radius=self.interaction_radius,
+                                            width=self.width, height=self.height, periodic=self.is_periodic, mx=mx,
+                                            my=my, workers=self.workers, pool=self.pool)
+            self.level_grids[level] = grid
+            self.levels.append((members, grid))
+
+    def close(self):
+        """See ArrayCellIndexMethod#close, also closes the grid of each radius class."""
+
+        for grid in self.level_grids.values():
+            grid.close()
+        super().close()
+
+    def calculate_pairs(self):
+        """Calculates every pair of particles within the interaction radius of each other. Returns (i, j, distances)
+        arrays, where distances are measured between particle borders like Particle#distance_to."""
+
+        found_i, found_j, found_distances = [], [], []
+        for level, (members, grid) in enumerate(self.levels):
+            # Pairs within the class were found when its grid was built
+            found_i.append(members[grid.pair_i])
+            found_j.append(members[grid.pair_j])
+            found_distances.append(grid.pair_distances)
+
+            # Pairs with particles of smaller classes, checked on this class's (coarser) grid
+            for smaller, _ in self.levels[:level]:
+                for q, j in grid.surrounding_pairs(self.xs[smaller], self.ys[smaller]):
+                    i, j = smaller[q], members[j]
+                    dx, dy = self.displacements(i, j)
+                    distances = np.hypot(dx, dy) - self.radii[i] - self.radii[j]
+                    accepted = distances <= self.interaction_radius
+                    found_i.append(i[accepted])
+                    found_j.append(j[accepted])
+                    found_distances.append(distances[accepted])
+
+        i = np.concatenate(found_i) if found_i else np.zeros(0, dtype=np.int64)
+        j = np.concatenate(found_j) if found_j else np.zeros(0, dtype=np.int64)
+        distances = np.concatenate(found_distances) if found_distances else np.zeros(0)
+        return i, j, distances
+
+    def query_radius_batch(self, xs, ys, r):
+        """See ArrayCellIndexMethod#query_radius_batch, each radius class is queried on its own grid."""
+
+        xs, ys = self.to_board(xs, ys)
+        found_q, found_j, found_distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for members, grid in self.levels:
+            offsets, indices, distances = grid.query_radius_batch(xs, ys, r)
+            found_q.append(np.repeat(np.arange(len(xs)), np.diff(offsets)))
+            found_j.append(members[indices])
+            found_distances.append(distances)
+
+        return self.to_csr(np.concatenate(found_q), np.concatenate(found_j), np.concatenate(found_distances), len(xs))
+
+    def query_box(self, x_min, y_min, x_max, y_max):
+        """See ArrayCellIndexMethod#query_box, each radius class is queried on its own grid."""
+
+        found = [np.zeros(0, dtype=np.int64)]
+        for members, grid in self.levels:
+            found.append(members[grid.query_box(x_min, y_min, x_max, y_max)])
+        return np.sort(np.concatenate(found))
+
+    def __str__(self):
+        result = ""
+        for members, grid in self.levels:
+            result += "Radii up to %g (%i particles, %ix%i cells):\n" % (grid.radii.max(), len(members), grid.num_cols,
+                                                                        grid.num_rows)
+            result += str(grid)
+        return result
@@ -0,0 +1,47 @@
+class SearchStats:
+    """Counters and timings of the last neighbor search (or update) of a CellIndexMethod built with `stats=True`, used
+    to see why a search is slow and to tune M and the interaction radius. Counters are reset at the start of each
+    search; simulation loops that want totals should add them up."""
+
+    def __init__(self):
+        self.cells_visited = 0          # Cells checked, counting each cell once for itself and once per neighbor check
+        self.candidate_pairs = 0        # Pairs of particles whose distance was computed
+        self.accepted_pairs = 0         # Candidate pairs within the search radius
+        self.max_occupancy = 0          # Most particles in a cell
+        self.mean_occupancy = 0.0       # Particles per cell
+        self.ghost_copies = 0           # Particles checked across the edge of a periodic board (through the minimum
+                                        # image, instead of copying them like ghost particles would)
+        self.binning_time = 0.0         # Seconds spent putting particles in cells
+        self.pair_time = 0.0            # Seconds spent testing candidate pairs
+        self.total_time = 0.0           # Seconds spent in the whole search, including filling neighbor lists
+
+    def reset(self):
+        """Zeroes counters and timings. Occupancy is kept, since it only changes when particles are binned again."""
+
+        max_occupancy, mean_occupancy = self.max_occupancy, self.mean_occupancy
+        self.__init__()
+        self.max_occupancy, self.mean_occupancy = max_occupancy, mean_occupancy
+
+    @property
+    def accept_ratio(self):
+        """Fraction of candidate pairs that were within the search radius."""
+        return self.accepted_pairs / self.candidate_pairs if self.candidate_pairs > 0 else 0.0
+
+    def count_occupancy(self, cells):
+        """Sets occupancy statistics from a board's rows of cells."""
+
+        counts = [len(cell.particles) for row in cells for cell in row]
+        self.max_occupancy = max(counts, default=0)
+        self.mean_occupancy = sum(counts) / len(counts) if counts else 0.0
+
+    def as_dict(self):
+        result = dict(vars(self))
+        result['accept_ratio'] = self.accept_ratio
+        return result
+
+    def __str__(self):
+        return "%i cells visited, %i candidate pairs, %i accepted (%.1f%%), occupancy max %i mean %.2f, %i ghost " \
+               "copies, binning %.4fs, pair testing %.4fs, total %.4fs" \
+               % (self.cells_visited, self.candidate_pairs, self.accepted_pairs, 100 * self.accept_ratio,
+                  self.max_occupancy, self.mean_occupancy, self.ghost_copies, self.binning_time, self.pair_time,
+                  self.total_time)
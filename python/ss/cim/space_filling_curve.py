@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class SpaceFillingCurve:
+    """Keys of space-filling curves over a grid of cells. Sorting particles by the key of their cell puts particles that
+    are close in space close in memory, see ParticleSystem#sort_spatially."""
+
+    CURVES = ('morton', 'hilbert')
+
+    @staticmethod
+    def spread_bits(values):
+        """Spreads the lower 32 bits of each value so there is a 0 between every two bits."""
+
+        result = np.asarray(values).astype(np.uint64) & np.uint64(0xFFFFFFFF)
+        for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                            (2, 0x3333333333333333), (1, 0x5555555555555555)):
+            result = (result | (result << np.uint64(shift))) & np.uint64(mask)
+        return result
+
+    @classmethod
+    def morton(cls, cols, rows):
+        """Morton (Z-order) keys of the given cells: the bits of the column and row, interleaved."""
+
+        return cls.spread_bits(cols) | (cls.spread_bits(rows) << np.uint64(1))
+
+    @staticmethod
+    def hilbert(cols, rows):
+        """Hilbert curve keys of the given cells. Unlike the Morton curve, consecutive keys are always neighbor
+        cells."""
+
+        x, y = np.array(cols, dtype=np.int64), np.array(rows, dtype=np.int64)
+        side = 1 << int(max(x.max(initial=0), y.max(initial=0))).bit_length()
+        result = np.zeros(len(x), dtype=np.int64)
+        s = side // 2
+        while s > 0:
+            rx, ry = (x & s) > 0, (y & s) > 0
+            result += s * s * ((3 * rx) ^ ry)
+            # Rotate the quadrant so the curve inside it starts and ends next to the neighbor quadrants
+            flip = ~ry & rx
+            x, y = np.where(flip, side - 1 - x, x), np.where(flip, side - 1 - y, y)
+            x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+            s //= 2
+        return result
+
+    @classmethod
+    def keys(cls, xs, ys, cell_size, curve='morton'):
+        """Key of the cell of side `cell_size` in which each (x, y) point is."""
+
+        if curve not in cls.CURVES:
+            raise Exception("Unknown space-filling curve '%s', valid options are %s" % (curve, cls.CURVES))
+        cols = np.maximum(np.asarray(xs) // cell_size, 0).astype(np.int64)
+        rows = np.maximum(np.asarray(ys) // cell_size, 0).astype(np.int64)
+        return cls.morton(cols, rows) if curve == 'morton' else cls.hilbert(cols, rows)
+
+    @staticmethod
+    def locality(i, j):
+        """Mean distance in memory (difference of indices) between the particles of each (i, j) pair, lower is better.
+        Used to measure the gain of sorting particles along a curve."""
+
+        return float(np.abs(np.asarray(i) - np.asarray(j)).mean()) if len(i) > 0 else 0.0
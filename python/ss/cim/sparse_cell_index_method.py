@@ -0,0 +1,121 @@
+import numpy as np
+
+from ss.cim.array_cell_index_method import ArrayCellIndexMethod
+
+
+class SparseCellIndexMethod(ArrayCellIndexMethod):
+    """Cell Index Method over an unbounded plane. Only occupied cells are stored: each cell is keyed by its packed
+    (col, row) coordinates, and the keys of occupied cells are kept in a sorted table where neighbor cells are looked up
+    in bulk with a binary search. Memory grows with the number of occupied cells instead of the board's area, and
+    particles may have any coordinates (negative, or drifting away from each other), so there is no board to size.
+
+    Accepts the same keyword arguments as ArrayCellIndexMethod, except that there is no board (`width`, `height`, `m`,
+    `mx`, `my`, `autotune` and `periodic` are ignored), plus:
+        - cell_size: Side of the (square) cells. Defaults to Rc + 2 * (biggest particle radius), the smallest valid
+        side."""
+
+    SHARED_ARRAYS = ArrayCellIndexMethod.SHARED_ARRAYS + ('cell_keys', 'cell_cols', 'cell_rows')
+
+    # Packed keys store the row in the upper 32 bits and the (shifted) column in the lower 32 bits, so sorting keys
+    # sorts cells row by row
+    COL_SHIFT = 1 << 31
+
+    def __init__(self, xs, ys, radii=None, **kwargs):
+        self.cell_size = kwargs.get('cell_size', -1)
+        self.cell_keys = self.cell_cols = self.cell_rows = None
+        kwargs['periodic'] = False
+        super().__init__(xs, ys, radii, **kwargs)
+
+    def create_board(self):
+        """Chooses the cell size. Width and height are those of the bounding box of the particles, for reference."""
+
+        max_radius = float(self.radii.max()) if len(self.radii) > 0 else 0
+        if self.cell_size == -1:
+            self.cell_size = self.interaction_radius + 2 * max_radius
+            if self.cell_size <= 0:
+                self.cell_size = 1
+        self.check_cell_size()
+
+        self.cell_width = self.cell_height = self.cell_size
+        if len(self.xs) > 0:
+            self.width = float(self.xs.max() - self.xs.min())
+            self.height = float(self.ys.max() - self.ys.min())
+
+    def check_cell_size(self):
+        max_radius = float(self.radii.max()) if len(self.radii) > 0 else 0
+        if self.cell_size < self.interaction_radius + 2 * max_radius or self.cell_size <= 0:
+            raise Exception("Cell size must be at least Rc + 2 * (biggest radius), can't perform cell index method, "
+                            "aborting. (Cell size = %g, Rc = %g, biggest radius = %g)"
+                            % (self.cell_size, self.interaction_radius, max_radius))
+
+    def check_particles_in_bounds(self):
+        """Any finite coordinates are valid. Also checks that the cell size (which is kept on #update) still fits the
+        biggest radius, cells too small would miss neighbors."""
+
+        self.check_cell_size()
+        invalid = ~(np.isfinite(self.xs) & np.isfinite(self.ys))
+        if invalid.any():
+            i = int(np.flatnonzero(invalid)[0])
+            raise Exception("Particle #%i @ (%g, %g) has invalid coordinates" % (i, self.xs[i], self.ys[i]))
+
+    def to_cells(self, xs, ys):
+        """Converts arrays of X and Y coordinates to arrays of (col, row) cell coordinates, which may be negative."""
+
+        return np.floor(xs / self.cell_size).astype(np.int64), np.floor(ys / self.cell_size).astype(np.int64)
+
+    @classmethod
+    def to_keys(cls, cols, rows):
+        return (rows << 32) + (cols + cls.COL_SHIFT)
+
+    def bin(self):
+        """Sorts particles by cell, like ArrayCellIndexMethod#bin. Cell IDs are positions in the table of occupied
+        cells, `cell_keys`, whose coordinates are `cell_cols` and `cell_rows`."""
+
+        cols, rows = self.to_cells(self.xs, self.ys)
+        self.cell_keys, self.cell_ids = np.unique(self.to_keys(cols, rows), return_inverse=True)
+        self.cell_ids = self.cell_ids.reshape(-1).astype(np.int64)
+        self.cell_rows = self.cell_keys >> 32
+        self.cell_cols = (self.cell_keys & 0xFFFFFFFF) - self.COL_SHIFT
+        counts = np.bincount(self.cell_ids, minlength=len(self.cell_keys))
+        self.cell_start = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.cell_start[1:])
+        self.order = np.argsort(self.cell_ids, kind='stable')
+
+        # Span of the occupied cells, so strips and queries know where particles may be
+        (first_col, last_col), (first_row, last_row) = self.cell_bounds()
+        self.num_cols = last_col - first_col + 1
+        self.num_rows = last_row - first_row + 1
+
+    def cell_coordinates(self, cells):
+        return self.cell_cols[cells], self.cell_rows[cells]
+
+    def cell_bounds(self):
+        if len(self.cell_keys) == 0:
+            return (0, 0), (0, 0)
+        return (int(self.cell_cols.min()), int(self.cell_cols.max())), (int(self.cell_rows[0]),
+                                                                        int(self.cell_rows[-1]))
+
+    def shift_cells(self, cols, rows, delta_col, delta_row):
+        """Returns the IDs of the cells at the given offset from the given cells, and a mask telling which of those are
+        occupied. IDs of empty cells are 0."""
+
+        keys = self.to_keys(cols + delta_col, rows + delta_row)
+        positions = np.minimum(np.searchsorted(self.cell_keys, keys), max(len(self.cell_keys) - 1, 0))
+        valid = self.cell_keys[positions] == keys if len(self.cell_keys) > 0 else np.zeros(len(keys), dtype=bool)
+        return np.where(valid, positions, 0), valid
+
+    def strips(self):
+        """Splits occupied cells in up to `workers` strips of whole cell rows, with about the same number of particles
+        each, see ArrayCellIndexMethod#strips."""
+
+        n = len(self.xs)
+        row_starts = self.cell_start[np.flatnonzero(np.r_[True, np.diff(self.cell_rows) != 0])]
+        targets = np.arange(1, self.workers) * n / self.workers
+        bounds = row_starts[np.minimum(np.searchsorted(row_starts, targets), len(row_starts) - 1)]
+        bounds = np.unique(np.concatenate(([0], bounds, [n])))
+        return [(int(first), int(last)) for first, last in zip(bounds[:-1], bounds[1:])]
+
+    def __str__(self):
+        counts = np.diff(self.cell_start)
+        return "\n".join("(%i, %i): %i" % (col, row, count) for col, row, count in
+                         zip(self.cell_cols.tolist(), self.cell_rows.tolist(), counts.tolist()))
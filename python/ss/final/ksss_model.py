@@ -4,7 +4,7 @@ from ss.final.car import Car
 import random
 from euclid3 import Vector2
 import ss.util.args as arg_base
-from ss.util.file_writer import FileWriter
+from ss.util.file_writer import OvitoWriter
 
 # https://es.wikipedia.org/wiki/Modelo_Knospe,_Santen,_Schadschneider,_Schreckenberg
 
@@ -105,6 +105,7 @@ fake_cars = list()
 fake_cars.append(Car(0, 0, 0, 0, 0,0))
 fake_cars.append(Car(0, ROAD_LENGTH, 0, 0, 0,0))
 fake_colors = [(255, 255, 0)] * 2
+positions_writer = OvitoWriter("output.txt")
 while t < MAX_TIME:
     new_velocities = list()
 
@@ -174,11 +175,12 @@ while t < MAX_TIME:
                 colors.append((255, 255, 255))
 
         # Also save car velocity
-        extra_data = lambda car: ("%g" % car.velocity.x)
-        FileWriter.export_positions_ovito(cars + fake_cars, t, colors=colors + fake_colors, extra_data_function=extra_data,
-                                          mode="w" if t == 0 else "a", output="output.txt")
+        saved = cars + fake_cars
+        positions_writer.write_particles(saved, t, colors=colors + fake_colors, extra=[[car.velocity.x for car in saved]])
 
         # Reset counter
         t_accum = 0
 
     t += DELTA_T
+
+positions_writer.close()
@@ -10,7 +10,7 @@ import random
 from euclid3 import Vector2
 import ss.util.args as arg_base
 from ss.cim.cell_index_method import CellIndexMethod
-from ss.util.file_writer import FileWriter
+from ss.util.file_writer import OvitoWriter
 from ss.util.file_reader import FileReader
 from ss.cim.particle import Particle
 
@@ -136,6 +136,8 @@ fake_particles = generate_fake_particles()
 t_accum = 0
 t = 0
 
+positions_writer = OvitoWriter("output.txt")
+
 while t < MAX_TIME:
     new_velocities = list()
 
@@ -166,9 +168,9 @@ while t < MAX_TIME:
         colors = [(255, 255, 255)] * NUM_PARTICLES     # Real particles are white
         colors += [(0, 255, 0)] * len(fake_particles)  # Fake particles are green
         # Also save particle radius and velocity
-        extra_data = lambda car: ("%g\t%g" % (car.radius, car.velocity.x))
-        FileWriter.export_positions_ovito(cars + fake_particles, t, colors=colors, extra_data_function=extra_data,
-                                          mode="w" if t == 0 else "a", output="output.txt")
+        saved = cars + fake_particles
+        positions_writer.write_particles(saved, t, colors=colors,
+                                         extra=[[car.radius for car in saved], [car.velocity.x for car in saved]])
 
         # Reset counter
         t_accum = 0
@@ -180,4 +182,5 @@ while t < MAX_TIME:
     t += DELTA_T
 
 # Simulation complete
+positions_writer.close()
 print("Done")
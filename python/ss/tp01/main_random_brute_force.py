@@ -27,7 +27,7 @@ for i in range(args.amount):
     # print(particles[-1])
 # print()
 
-data = BruteForce(*particles,interaction_radius=r, is_periodic=args.periodic)
+data = BruteForce(*particles, interaction_radius=r, is_periodic=args.periodic, width=l, height=l)
 
 # FileWriter.export_positions_matlab(data, 0, args.output)
 FileWriter.export_positions_ovito(particles, 0, args.output)
@@ -14,7 +14,7 @@ import numpy as np
 
 from ss.cim.cell_index_method import CellIndexMethod
 from ss.cim.particle import Particle
-from ss.util.file_writer import FileWriter
+from ss.util.file_writer import OvitoWriter
 
 import ss.util.args as args
 
@@ -80,6 +80,7 @@ for N,L in [(40, 3), (100, 5), (400, 10), (4000, 31), (10000, 50)]:
 
         # MAIN
         v_as = [[], []] # "Tuples" of the form (t, Va)
+        positions_writer = OvitoWriter("%s_positions.txt" % prefix)
         for i in range(arguments['iterations']):
             print("Processing frame #%i" % (i + 1))
             data = CellIndexMethod(particles, **arguments)
@@ -117,8 +118,9 @@ for N,L in [(40, 3), (100, 5), (400, 10), (4000, 31), (10000, 50)]:
                 file.write("%g\n" % (sum(v_as[1]) / len(v_as[1])))
                 file.close()
 
-            # Truncate file for first frame, append for following frames
-            FileWriter.export_positions_ovito(particles, i, colors, ("%s_positions.txt" % prefix), 'w' if i == 0 else 'a')
+            positions_writer.write_particles(particles, i, colors)
+
+        positions_writer.close()
 
         if arguments['verbose']:
             print("Output written to %s", arguments['output'])
@@ -8,13 +8,13 @@ sys.path.append(os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__
 
 import math
 import random
-import euclid3
 import datetime
+import numpy as np
 # import matplotlib.pyplot as plt
 
-from ss.cim.cell_index_method import CellIndexMethod
-from ss.cim.particle import Particle
-from ss.util.file_writer import FileWriter
+from ss.cim.array_cell_index_method import ArrayCellIndexMethod
+from ss.cim.particle_system import ParticleSystem
+from ss.util.file_writer import FileWriter, OvitoWriter
 from ss.util.colors import radians_to_rgb
 
 import ss.util.args as args
@@ -27,6 +27,9 @@ args.parser.add_argument("eta", help="Noise that will be added when calculating
                                      "particle", type=float)
 args.parser.add_argument("-n", help="Amount of particles", type=int, default=100)
 args.parser.add_argument("--iterations", "-i", help="Amount of iterations", type=int, default=100)
+args.parser.add_argument("--topological", "-k", help="Topological interaction: align with the K nearest particles "
+                                                    "instead of those within the interaction radius. Integer",
+                         type=int)
 
 arguments = args.to_dict_no_none()
 
@@ -35,74 +38,83 @@ if 'time' in arguments:
 
 particle_velocity = 0.3
 side_length = arguments.get('l', 100)
-particles = list()
+# Particles are kept as arrays, so neighbors, angles and output are computed for all of them at once
+particles = ParticleSystem(arguments['n'])
 for particle_count in range(arguments['n']):
     x = random.uniform(0.0, side_length)
     y = random.uniform(0.0, side_length)
     o = random.uniform(0.0, 2 * math.pi)
-    particles.append(Particle(x, y, radius=0.0, v=particle_velocity, o=o))
+    # IDs start at 1, like Particles'
+    particles.add(x, y, radius=0.0, v=particle_velocity, o=o, id=particle_count + 1)
 
 delta_t = 1
 start_time = datetime.datetime.now().isoformat("_").replace(":", "-")
 
 
-def avg_angle(neighbors):
-    sin_accum = 0
-    cos_accum = 0
-    length = 0
-    for tuple in neighbors:
-        length += 1
-        angle = tuple[0].vel_angle()
-        sin_accum += math.sin(angle)
-        cos_accum += math.cos(angle)
-    return math.atan2(sin_accum / length, cos_accum / length)
+def avg_angles(rows, neighbors, angles):
+    """Average angle of each particle and its neighbors, given as a list of (particle, neighbor) index pairs."""
+
+    sin_accum = np.sin(angles) + np.bincount(rows, np.sin(angles[neighbors]), len(angles))
+    cos_accum = np.cos(angles) + np.bincount(rows, np.cos(angles[neighbors]), len(angles))
+    length = 1 + np.bincount(rows, minlength=len(angles))
+    return np.arctan2(sin_accum / length, cos_accum / length)
+
+
+# Particles are binned once per iteration into the same grid. In topological mode neighbors are only looked up with
+# knn, so the search for every pair within the interaction radius is skipped
+grid = ArrayCellIndexMethod.from_system(particles, search_pairs='topological' not in arguments, **arguments)
+
+
+def neighbor_pairs():
+    """(particle, neighbor) index pairs, with neighbors within the interaction radius or, in topological mode, the k
+    nearest particles"""
+
+    grid.update(particles.xs, particles.ys)
+    if 'topological' in arguments:
+        indices, _ = grid.knn(arguments['topological'])
+        rows = np.repeat(np.arange(len(particles)), indices.shape[1])
+        indices = indices.ravel()
+        return rows[indices != -1], indices[indices != -1]
+    return np.repeat(np.arange(len(particles)), np.diff(grid.offsets)), grid.indices
 
 
 # MAIN
 v_as = [[], []] # "Tuples" of the form (t, Va)
+positions_writer = OvitoWriter("%s_positions.txt" % start_time)
 for i in range(arguments['iterations']):
     print("Processing frame #%i" % (i + 1))
-    data = CellIndexMethod(particles, **arguments)
-    # Color each particle according to its direction
-    colors = []
-    # For calculating Va
-    v_accum = euclid3.Vector2()
-
-    for particle in particles:
-        # Move particle
-        new_position = particle.position + (particle.velocity * delta_t)
-        # Use modulo because board is periodic
-        particle.move_to(new_position.x % data.width, new_position.y % data.width)
-
-        # Change direction using neighbors
-        noise = random.uniform(-arguments['eta'] / 2, arguments['eta'] / 2)
-        # Calculate new direction using neighbors and self
-        newVelAngle = noise + avg_angle(data.neighbors[particle.id] + [(particle, 0)])
-        particle.velocity = (particle_velocity, newVelAngle)
-        if arguments['verbose']:
-            print("Velocity of particle #%i: %s" % (particle.id, particle.velocity))
+    rows, neighbors = neighbor_pairs()
 
-        # Color particle according to its angle
-        colors.append(radians_to_rgb(newVelAngle))
+    # Move particles, using modulo because board is periodic
+    particles.move_to((particles.positions + particles.velocities * delta_t) % side_length)
 
-        v_accum += particle.velocity
+    # Change direction using neighbors and self, plus noise
+    noise = np.random.uniform(-arguments['eta'] / 2, arguments['eta'] / 2, len(particles))
+    new_angles = noise + avg_angles(rows, neighbors, np.arctan2(particles.velocities[:, 1], particles.velocities[:, 0]))
+    particles.set_velocities(particle_velocity * np.column_stack((np.cos(new_angles), np.sin(new_angles))))
+    if arguments['verbose']:
+        for particle in particles:
+            print("Velocity of particle #%i: %s" % (particle.id, particle.velocity))
 
     # Process Va, absolute value of average normalized velocity
-    v_a = v_accum.magnitude() / (arguments['n'] * particle_velocity)
+    v_a = np.hypot(*particles.velocities.sum(axis=0)) / (arguments['n'] * particle_velocity)
     v_as[0].append(i)
     v_as[1].append(v_a)
     # Write this run's parameters to output file
     if i == 0:
         file = open(("%s_va.txt" % start_time), 'w')
-        density = arguments['n'] / (data.width * data.height)
-        file.write("N = %i, L = %gx%g, density = %g, eta = %g\n" % (arguments['n'], data.width, data.height,
+        density = arguments['n'] / (side_length * side_length)
+        file.write("N = %i, L = %gx%g, density = %g, eta = %g\n" % (arguments['n'], side_length, side_length,
                                                                     density, arguments['eta']))
         file.close()
     # Append Va for current time
     FileWriter.export_tuple((i, v_a), ("%s_va.txt" % start_time), 'a')
 
-    # Truncate file for first frame, append for following frames
-    FileWriter.export_positions_ovito(particles, i, colors, ("%s_positions.txt" % start_time), 'w' if i == 0 else 'a')
+    # Color each particle according to its direction
+    colors = [radians_to_rgb(angle) for angle in particles.in_order(new_angles).tolist()]
+    positions_writer.write_system(particles, i, colors)
+
+positions_writer.close()
 
 if arguments['verbose']:
     print("Output written to %s", arguments['output'])
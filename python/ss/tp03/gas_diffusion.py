@@ -2,7 +2,7 @@ import math
 
 import ss.util.args as args
 from ss.cim.particle import Particle
-from ss.util.file_writer import FileWriter
+from ss.util.file_writer import OvitoWriter
 from ss.util.colors import radians_to_rgb
 
 # TODO: Update description
@@ -391,7 +391,7 @@ def recalculate_fp(particles):
     fp_right = right / arguments.n
     return fp_left, fp_right
 
-def write_positions(t, fp_left, particles, fake_particles, first_frame, colliding_particle, target):
+def write_positions(t, fp_left, particles, fake_particles, colliding_particle, target):
     # Render frame
     if arguments.verbose:
         print("Rendering frame, t=%g, fp=%g" % (t, fp_left))
@@ -407,8 +407,7 @@ def write_positions(t, fp_left, particles, fake_particles, first_frame, collidin
     # Color the fake middle wall particles green
     colors += [(0, 255, 0)] * len(fake_particles)
 
-    FileWriter.export_positions_ovito(particles + fake_particles, t=t, colors=colors, output=arguments.output,
-                                      mode='w' if first_frame else 'a')
+    positions_writer.write_particles(particles + fake_particles, t=t, colors=colors)
 
 
 def calculate_temperature(particles):
@@ -431,7 +430,6 @@ def calculate_temperature(particles):
 # Time variables
 t = 0
 delta_t = 0
-first_frame = True
 
 # Particle ratio on each side of the box
 fp_left = 1
@@ -457,6 +455,9 @@ temperatures = open(temp_path, "w")
 temperatures.write("time\ttemperature\n")
 temperatures.close()
 
+# Frames are written as they are rendered, see write_positions
+positions_writer = OvitoWriter(arguments.output)
+
 # Algorithm
 while fp_left > arguments.cutoff:
     if arguments.verbose:
@@ -479,10 +480,11 @@ while fp_left > arguments.cutoff:
 
     if delta_t >= arguments.delta:
         write_positions(t=t, fp_left=fp_left, particles=particles, fake_particles=fake_particles,
-                        first_frame=first_frame, colliding_particle=colliding_particle, target=target)
-        first_frame = False
+                        colliding_particle=colliding_particle, target=target)
         delta_t = 0
 
+positions_writer.close()
+
 
 print("#: %g\t%g" %(arguments.n, t))
 
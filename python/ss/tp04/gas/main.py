@@ -1,14 +1,17 @@
 import math
 import random
+from collections import defaultdict
 
 import numpy as np
-from euclid3 import Vector2
 import matplotlib.pyplot as plt
 
 from ss.cim.cell_index_method import CellIndexMethod
+from ss.cim.obstacles import Obstacles
 import ss.util.args as arg_base
-from ss.util.file_writer import FileWriter
+from ss.util.file_writer import OvitoWriter
+from ss.util.background_writer import BackgroundWriter
 from ss.cim.particle import Particle
+from ss.cim.particle_system import ParticleSystem
 from ss.tp04.solutions import verlet
 
 arg_base.parser.description = "Gas Diffusion simulation Program. Simulates how a number of given gas particles " \
@@ -102,77 +105,58 @@ def load_particles(positions, properties=None):
     return result
 
 
-def add_wall_neighbors(particle, dest):
-    """Add fake particles that will represent the wall particles that exert force on the particle"""
+def lennard_jones_force(r):
+    """Calculate lennard jones force for two particles separated by r"""
+    assert (r != 0)
+    return (12 * EPSILON / R_M) * (((R_M / r) ** 13) - ((R_M / r) ** 7))
 
-    # Check if there is interaction with the left wall
-    if particle.x <= R:
-        dest.append((Particle(x=0, y=particle.y, mass=math.inf, is_fake=True), particle.x))
 
-    # Check if there is interaction with the bottom wall
-    if particle.y <= R:
-        dest.append((Particle(x=particle.x, y=0, mass=math.inf, is_fake=True), particle.y))
+def pair_forces(pairs):
+    """Calculate the lennard jones force between each pair of neighbor particles, visiting each pair once. The force on
+    the second particle of a pair is the opposite of the force on the first one.
 
-    # Check if there is interaction with the right wall
-    if WIDTH - particle.x <= R:
-        dest.append((Particle(x=WIDTH, y=particle.y, mass=math.inf, is_fake=True), WIDTH - particle.x))
+    :return A dictionary of particle ID => [force_x, force_y], and the potential energy of all pairs"""
 
-    # Check if there is interaction with the top wall
-    if HEIGHT - particle.y <= R:
-        dest.append((Particle(x=particle.x, y=HEIGHT, mass=math.inf, is_fake=True), HEIGHT - particle.y))
+    forces = defaultdict(lambda: [0, 0])
+    potential = 0
+    for p1, p2, delta_x, delta_y, dist in pairs:
+        # Count the pair's energy for each of its particles, like potential_energy does
+        potential += 2 * lennard_jones_potential(dist)
 
-    # Is particle within the slit in Y?
-    if HEIGHT/2 - SLIT_SIZE/2 < particle.y < HEIGHT/2 + SLIT_SIZE/2:
-        # Yes - check interaction with slit corners if appropriate
-        for p2 in [SLIT_TOP, SLIT_BOTTOM]:
-            d = particle.distance_to(p2)
-            if d <= R:
-                dest.append((p2, d))
-    else:
-        # No - check interaction with middle wall horizontally
-        if abs(particle.x - WIDTH/2) <= R:
-            dest.append((Particle(x=WIDTH / 2, y=particle.y, mass=math.inf, is_fake=True), abs(particle.x - WIDTH / 2)))
+        # Check if the particles are not in the same compartment
+        if compartment(p1) != compartment(p2):
+            continue
 
+        # Project the force on each axis component; force on p1 points away from p2
+        force = lennard_jones_force(dist)
+        center_distance = math.sqrt(delta_x ** 2 + delta_y ** 2)
+        force_x, force_y = -force * delta_x / center_distance, -force * delta_y / center_distance
+        forces[p1.id][0] += force_x
+        forces[p1.id][1] += force_y
+        forces[p2.id][0] -= force_x
+        forces[p2.id][1] -= force_y
 
-def lennard_jones_force(r):
-    """Calculate lennard jones force for two particles separated by r"""
-    assert (r != 0)
-    return (12 * EPSILON / R_M) * (((R_M / r) ** 13) - ((R_M / r) ** 7))
+    return forces, potential
 
 
-def calculate_force(particle, neighbors):
-    """Calculate total force exerted on particle by neighbors with the lennard jones force"""
-    force_x = 0
-    force_y = 0
-    for neighbor, _ in neighbors:
-        if neighbor != particle:
-            # Check if the neighbor particle is not in the same compartment as the original particle
-            if not neighbor.is_fake and compartment(particle) != compartment(neighbor):
-                # TODO hacer lo de Barto de la pendiente para ver si se ven las partículas entre la ranura
-                continue
-
-            # Calculate total force magnitude
-            dist = particle.distance_to(neighbor)
-            force = lennard_jones_force(dist)
-            # Calculate angle between neighbor and particle
-            angle = math.atan2(particle.y-neighbor.y, particle.x-neighbor.x)
-            # Project the force on each axis component
-            force_x += force * math.cos(angle)
-            force_y += force * math.sin(angle)
-    return force_x, force_y
-
-
-def recalculate_fp(particles):
+def wall_forces(contacts, forces):
+    """Add the lennard jones force between each particle and the walls within its interaction radius to the given
+    dictionary of particle ID => [force_x, force_y]. Walls push particles away from their closest point."""
+
+    for p, _, delta_x, delta_y, dist in contacts:
+        force = lennard_jones_force(dist)
+        center_distance = math.sqrt(delta_x ** 2 + delta_y ** 2)
+        forces[p.id][0] -= force * delta_x / center_distance
+        forces[p.id][1] -= force * delta_y / center_distance
+
+    return forces
+
+
+def recalculate_fp(system):
     """Calculate the particle ratio on each side"""
-    left = 0
-    right = 0
-    for particle in particles:
-        if particle.position.x <= WIDTH / 2:
-            left += 1
-        else:
-            right += 1
+    left = int(np.count_nonzero(system.xs <= WIDTH / 2))
     fp_left = left / NUM_PARTICLES
-    fp_right = right / NUM_PARTICLES
+    fp_right = (len(system) - left) / NUM_PARTICLES
     return fp_left, fp_right
 
 
@@ -182,10 +166,15 @@ def potential_energy(particle, neighbors):
     potential = 0
     for neighbor, dist in neighbors:
         if neighbor != particle:
-            potential += EPSILON*((R_M/dist)**12 - 2*(R_M/dist)**6)
+            potential += lennard_jones_potential(dist)
     return potential
 
 
+def lennard_jones_potential(r):
+    """Calculate lennard jones potential energy for two particles separated by r"""
+    return EPSILON*((R_M/r)**12 - 2*(R_M/r)**6)
+
+
 def compartment(particle):
     """Return which compartment the specified particle is in. 0 for left, 1 for exact middle, 2 for right."""
     if particle.x == WIDTH / 2:
@@ -193,14 +182,12 @@ def compartment(particle):
     return 0 if particle.x < WIDTH / 2 else 2
 
 
-def velocity_histogram(particles, filename):
-    """Save a histogram with the velocity distribution for particles"""
+def velocity_histogram(system, filename):
+    """Save a histogram with the velocity distribution for the particles of a ParticleSystem"""
     # Used for 2.4
     if args['verbose']:
         print("Generating velocity histogram")
-    velocities = list()
-    for p in particles:
-        velocities.append(p.velocity.magnitude())
+    velocities = np.hypot(system.velocities[:, 0], system.velocities[:, 1])
     plt.clf()
     plt.hist(np.array(velocities), bins=np.arange(np.min(velocities)-1, np.max(velocities)+1, 0.25), histtype='bar',
              color="orange", align="left", linestyle="solid", edgecolor='black', linewidth=0.8)
@@ -215,102 +202,110 @@ def velocity_histogram(particles, filename):
 if args['time']:
     import ss.util.timer
 
-# Generate random particles
-particles = generate_random_particles()
+# Generate random particles. They are stored in a ParticleSystem and integrated all at once (see verlet#step), while
+# neighbor search and forces work on Particle-like views of them
+system = ParticleSystem.from_particles(generate_random_particles())
+particles = list(system)
 
 # Load particles from file
 # from ss.util.file_reader import FileReader
 # positions, properties = FileReader.import_positions_ovito("/Users/juanlipuma/PycharmProjects/ss/in.txt", time=48.444)
-# particles = load_particles(positions, properties)[0:100]
+# system = ParticleSystem.from_particles(load_particles(positions, properties)[0:100])
+# particles = list(system)
 # NUM_PARTICLES = 100
 
 # Generate wall/corner particles
 fake_particles = generate_fake_particles()
-SLIT_TOP = Particle(WIDTH/2, HEIGHT/2 + SLIT_SIZE/2, mass=math.inf, is_fake=True)
-SLIT_BOTTOM = Particle(WIDTH/2, HEIGHT/2 - SLIT_SIZE/2, mass=math.inf, is_fake=True)
+# Box walls, and the middle wall with the slit between compartments
+WALLS = Obstacles()
+WALLS.add_box(0, 0, WIDTH, HEIGHT)
+WALLS.add_slit(WIDTH / 2, 0, WIDTH / 2, HEIGHT, HEIGHT / 2 - SLIT_SIZE / 2, HEIGHT / 2 + SLIT_SIZE / 2)
 
 t_accum = 0
 fp_left = 1
 t = 0
 middle_histogram = False
 
-velocity_histogram(particles, "initial_velocity_histogram.jpg")
+velocity_histogram(system, "initial_velocity_histogram.jpg")
+
+# Neighbor search state is kept between steps, see CellIndexMethod#update
+cim = CellIndexMethod(particles, radius=R, width=WIDTH, height=HEIGHT, skin=args.get('skin', 0),
+                      m=args.get('m', -1), mx=args.get('mx', -1), my=args.get('my', -1), autotune=args['autotune'],
+                      tuning_cache=args.get('tuning_cache'), stats=args['stats'], obstacles=WALLS)
 
+positions_writer = OvitoWriter("output2.txt")
+# Output is written in the background while the simulation goes on, see BackgroundWriter
+output = BackgroundWriter()
 
 while fp_left > 0.5:
 
     if fp_left < 0.75 and not middle_histogram:
         # Generate a histogram when one fourth of the particles have passed to the right side
-        velocity_histogram(particles, "middle_velocity_histogram.jpg")
+        velocity_histogram(system, "middle_velocity_histogram.jpg")
         middle_histogram = True
 
-    # Calculate all neighbors for all particles
-    neighbors = CellIndexMethod(particles, radius=R, width=WIDTH, height=HEIGHT).neighbors
+    # Forces between neighbors and potential energy, calculated once per pair for the current positions
+    forces, e_u = pair_forces(cim.pairs())
+    wall_forces(cim.walls(), forces)
 
-    # Initialize variables
-    total_mass = 0
-    total_velocity = 0
-    e_u, e_k = 0, 0
-    new_positions, new_velocities = [], []
+    # Total force exerted on each particle by other particles and by the walls, in storage order
+    force_array = np.zeros((len(system), 2))
     for p in particles:
-        # Accumulate system energies (do this before adding fake wall particles since those aren't part of the system)
-        e_u += potential_energy(p, neighbors[p.id])
-        e_k += 0.5 * p.mass * (p.velocity.magnitude() ** 2)
+        force_array[p.index] = forces[p.id]
 
-        # Add fake particles to represent walls
-        add_wall_neighbors(p, neighbors[p.id])
-
-        # Calculate total force exerted on p
-        force_x, force_y = calculate_force(p, neighbors[p.id])
-        force = Vector2(force_x, force_y)
-
-        # Calculate new position and velocity using Verlet
-        new_position = verlet.r(particle=p, delta_t=delta_t, force=force)
-
-        # Calculate new position and new velocity for particle
-        new_positions.append(new_position)
-        new_velocity = verlet.v(p, delta_t, force)
-        new_velocities.append(new_velocity)
-
-        if new_position.x < 0 or new_position.y < 0 or new_position.x > WIDTH or new_position.y > HEIGHT:
-            raise Exception("The particle moved out of the bounds, x:%f y:%f, width: %f, height: %f" %(new_position.x, new_position.y, WIDTH, HEIGHT))
+    # Kinetic energy of the system
+    e_k = 0.5 * float(np.sum(system.masses * np.sum(system.velocities ** 2, axis=1)))
 
     # Save frame if necessary
     t_accum += delta_t
     if t == 0 or t_accum >= DELTA_T_SAVE:
         if args['verbose']:
             print("Saving frame at t=%f" % t)
+            if cim.skin > 0:
+                print("Neighbor lists rebuilt %i times in %i steps" % (cim.rebuild_count, cim.update_count))
+            if cim.stats is not None:
+                print("Neighbor search: %s" % cim.stats)
+            print("Output: %s" % output)
 
         # Save positions
         colors = [(255, 255, 255)] * NUM_PARTICLES
         colors += [(0, 255, 0)] * len(fake_particles)
-        FileWriter.export_positions_ovito(particles + fake_particles, t, colors=colors, mode="w" if t == 0 else "a", output="output2.txt")
+        # Pass a snapshot of particle positions, particles keep moving while the frame is written
+        order = system.order
+        output.submit(positions_writer.write_frame, t, system.ids[order].tolist() + [p.id for p in fake_particles],
+                      system.xs[order].tolist() + [p.x for p in fake_particles],
+                      system.ys[order].tolist() + [p.y for p in fake_particles], colors)
 
         # Save kinetic and potential energy for current time
         # Used for 2.2
-        file = open("energy2.txt", "w" if t == 0 else "a")
-        file.write("%g,%g,%g\n" % (t, e_k, e_u))
-        file.close()
+        output.write_text("energy2.txt", "%g,%g,%g\n" % (t, e_k, e_u), "w" if t == 0 else "a")
 
         # Save fp proportion on the left side of the compartment
         # Used for 2.3
-        file = open("fpleft2.txt", "w" if t == 0 else "a")
-        file.write("%g,%g\n" % (t, fp_left))
-        file.close()
+        output.write_text("fpleft2.txt", "%g,%g\n" % (t, fp_left), "w" if t == 0 else "a")
 
         # Reset counter
         t_accum = 0
 
-    # Evolve particles
-    for i in range(len(particles)):
-        particles[i].position = new_positions[i]
-        particles[i].velocity = new_velocities[i]
+    # Calculate new positions and velocities using Verlet
+    verlet.step(system, delta_t, force_array)
+    outside = (system.xs < 0) | (system.ys < 0) | (system.xs > WIDTH) | (system.ys > HEIGHT)
+    if outside.any():
+        i = int(np.flatnonzero(outside)[0])
+        raise Exception("The particle moved out of the bounds, x:%f y:%f, width: %f, height: %f"
+                        % (system.xs[i], system.ys[i], WIDTH, HEIGHT))
+
+    # Recalculate neighbors, moving only the particles that changed cells
+    cim.update()
 
     # Recalculate particle proportion on each compartment
-    fp_left, _ = recalculate_fp(particles=particles)
+    fp_left, _ = recalculate_fp(system)
 
     # Add delta t to total time
     t += delta_t
 
+output.close()
+positions_writer.close()
+
 # Generate a histogram for the particle velocity distribution at the end
-velocity_histogram(particles, "final_velocity_histogram2.jpg")
+velocity_histogram(system, "final_velocity_histogram2.jpg")
@@ -7,13 +7,17 @@ sys.path.append(os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__
 
 import math
 import random
+from collections import defaultdict
 
 from euclid3 import Vector2
 
 from ss.cim.cell_index_method import CellIndexMethod
+from ss.cim.obstacles import Obstacles
 import ss.util.args as arg_base
-from ss.util.file_writer import FileWriter
+from ss.util.file_writer import OvitoWriter
 from ss.util.file_reader import FileReader
+from ss.util.trajectory import TrajectoryWriter
+from ss.util.background_writer import BackgroundWriter
 from ss.cim.particle import Particle
 from ss.tp04.solutions import verlet
 from ss.tp05 import flow_sliding_window
@@ -63,6 +67,12 @@ DIAMETER = args['diameter']
 MIN_DISTANCE = 0            # Min distance between created particles [m]. Note that for this simulation, once the
                             # simulation has started particles may be closer than this. This is just for the start.
 
+# Silo walls: the bottom wall with the slit in the middle, and the side walls
+WALLS = Obstacles()
+WALLS.add_slit(0, SLIT_Y, WIDTH, SLIT_Y, (WIDTH - DIAMETER) / 2, (WIDTH + DIAMETER) / 2)
+WALLS.add_segment(0, 0, 0, HEIGHT)
+WALLS.add_segment(WIDTH, 0, WIDTH, HEIGHT)
+
 # Beverloo constant
 B = (NUM_PARTICLES/HEIGHT*WIDTH)*(G.magnitude())**0.5
 
@@ -143,57 +153,50 @@ def load_particles(in_file, time=None, frame=None):
     return result
 
 
-def add_wall_neighbors(particle, dest):
-    """Add fake particles that will represent the wall particles that exert force on the particle"""
+def pair_forces(pairs):
+    """Calculate normal and tangential forces between each pair of overlapping particles, visiting each pair once. The
+    force on the second particle of a pair is the opposite of the force on the first one.
 
-    # Check if there is interaction with the bottom wall
-    if particle.y >= SLIT_Y and (particle.x <= (WIDTH - DIAMETER) / 2 or particle.x > (WIDTH + DIAMETER) / 2):
-        fake = Particle(particle.x, SLIT_Y, radius=0, mass=math.inf, is_fake=True)
-        if superposition(particle, fake) >= 0:
-            dest.append((Particle(particle.x, SLIT_Y, radius=0, mass=math.inf, is_fake=True), particle.distance_to(fake)))
+    :return A dictionary of particle ID => [force_x, force_y]"""
 
-    # Check if there is interaction with the left wall
-    if particle.x <= particle.radius:
-        fake = Particle(0, particle.y, radius=0, mass=math.inf, is_fake=True)
-        dest.append((fake, particle.distance_to(fake)))
+    forces = defaultdict(lambda: [0, 0])
+    for p1, p2, delta_x, delta_y, distance in pairs:
+        # Distance between borders is negative when particles overlap
+        epsilon = -distance
+        if epsilon >= 0:
+            center_distance = math.sqrt(delta_x ** 2 + delta_y ** 2)
+            n_x, n_y = delta_x / center_distance, delta_y / center_distance
+            relative_velocity = p1.relative_velocity(p2)
+            fn = -K_n * epsilon
+            ft = K_t * epsilon * (relative_velocity.x * -n_y + relative_velocity.y * n_x)
 
-    # Check if there is interaction with the right wall
-    if WIDTH - particle.x <= particle.radius:
-        fake = Particle(WIDTH, particle.y, radius=0, mass=math.inf, is_fake=True)
-        dest.append((fake, particle.distance_to(fake)))
+            f_x = fn * n_x + ft * (-n_y)
+            f_y = fn * n_y + ft * n_x
+            forces[p1.id][0] += f_x
+            forces[p1.id][1] += f_y
+            forces[p2.id][0] -= f_x
+            forces[p2.id][1] -= f_y
 
+    return forces
 
-def superposition(particle, other):
-    if other.is_fake:
-        # Wall particle
-        return particle.radius - (other.position - particle.position).magnitude()
-    else:
-        # Real particle
-        return particle.radius + other.radius - (other.position - particle.position).magnitude()
 
+def wall_forces(contacts, forces):
+    """Add the normal and tangential forces between each particle and the walls it overlaps to the given dictionary of
+    particle ID => [force_x, force_y]. Walls don't move, so the relative velocity is the opposite of the particle's."""
 
-def calculate_force(particle, others):
-    f_x = f_y = 0
-    for n, _ in others:
-        epsilon = superposition(particle, n)
+    for p, _, delta_x, delta_y, distance in contacts:
+        # Distance between the border and the wall is negative when they overlap
+        epsilon = -distance
         if epsilon >= 0:
-            v_n = particle.relative_position(n).normalize()
-            fn, ft = f_n(particle, n), f_t(particle, n)
-
-            f_x += fn * v_n.x + ft * (-v_n.y)
-            f_y += fn * v_n.y + ft * v_n.x
-
-    return Vector2(f_x, f_y)
-
+            center_distance = math.sqrt(delta_x ** 2 + delta_y ** 2)
+            n_x, n_y = delta_x / center_distance, delta_y / center_distance
+            fn = -K_n * epsilon
+            ft = K_t * epsilon * (-p.velocity.x * -n_y - p.velocity.y * n_x)
 
-def f_t(particle, neighbor):
-    v_n = particle.relative_position(neighbor).normalize()
-    v_t = Vector2(-v_n.y, v_n.x)
-    return K_t * superposition(particle, neighbor) * particle.relative_velocity(neighbor).dot(v_t)
+            forces[p.id][0] += fn * n_x + ft * (-n_y)
+            forces[p.id][1] += fn * n_y + ft * n_x
 
-
-def f_n(particle, neighbor):
-    return -K_n * superposition(particle, neighbor)
+    return forces
 
 
 def evolve_particles(particles, new_positions, new_velocities, pending_particles):
@@ -223,7 +226,12 @@ def evolve_particles(particles, new_positions, new_velocities, pending_particles
             p.velocity = Particle.to_v_o(new_velocities[i])
             evolved_particles.append(p)
 
-    # Now that all regular particles have evolved, reposition pending and fallen particles ensuring no overlap (pending first)
+    # Now that all regular particles have evolved, reposition pending and fallen particles ensuring no overlap (pending
+    # first). Overlaps are checked against the particles near the respawn point, so bring the board up to date (neighbors
+    # are searched once per step, after particles evolve)
+    respawned_particles = []
+    if len(pending_particles + fallen_particles) > 0:
+        cim.relocate(particles=evolved_particles)
     for p in pending_particles + fallen_particles:
         # Replace with new particle
         # TODO: Ensure no overlap. If can't generate without overlap, choose random X
@@ -239,9 +247,9 @@ def evolve_particles(particles, new_positions, new_velocities, pending_particles
         while overlap and overlap_attempts < 100:
             new_particle = Particle(new_x, HEIGHT - p.radius - MIN_DISTANCE, radius=p.radius, mass=p.mass, v=0, o=0,
                                     id=p.id)
-            if len(evolved_particles) == 0:
-                overlap = False
-            for p2 in evolved_particles:
+            overlap = False
+            nearby = [other for other, _ in cim.query_radius(new_particle.x, new_particle.y, MIN_DISTANCE + p.radius)]
+            for p2 in nearby + respawned_particles:
                 overlap = new_particle.distance_to(p2) < MIN_DISTANCE
                 if overlap:
                     print("Overlap between #%i and #%i, setting random X for #%i" % (p.id, p2.id, p.id))
@@ -261,6 +269,7 @@ def evolve_particles(particles, new_positions, new_velocities, pending_particles
             new_particle.velocity = (new_particle.vel_module(), new_particle.vel_angle())
 
             evolved_particles.append(new_particle)
+            respawned_particles.append(new_particle)
 
     for p in evolved_particles:
         if p.x < 0 or p.x > WIDTH or p.y > HEIGHT:
@@ -288,27 +297,35 @@ pending_particles = list()      # See evolve_particles
 # Generate wall/corner particles
 fake_particles = generate_fake_particles()
 
+# Frames are saved with ID, position, color, radius and velocity, as Ovito text or in a binary trajectory
+positions_writer = TrajectoryWriter("output.traj") if args['binary'] else OvitoWriter("output.txt", index=True)
+write_positions = positions_writer.write_columns if args['binary'] else positions_writer.write_frame
+# Output is written in the background while the simulation goes on, see BackgroundWriter
+output = BackgroundWriter()
+
 t_accum = 0
 t = 0
 num_fallen_particles = 0
 # TODO: Establish end condition
 
+# Neighbor search state is kept between steps, see CellIndexMethod#update
+cim = CellIndexMethod(particles, radius=MAX_PARTICLE_RADIUS, width=WIDTH, height=HEIGHT,
+                      skin=args.get('skin', 0), m=args.get('m', -1), mx=args.get('mx', -1), my=args.get('my', -1),
+                      autotune=args['autotune'], tuning_cache=args.get('tuning_cache'), stats=args['stats'],
+                      obstacles=WALLS)
+
 while True:
-    # Calculate all neighbors for all particles
-    neighbors = CellIndexMethod(particles, radius=MAX_PARTICLE_RADIUS, width=WIDTH, height=HEIGHT).neighbors
+    # Forces between neighbors and against walls, calculated once per pair or contact for the current positions
+    forces = wall_forces(cim.walls(), pair_forces(cim.pairs()))
     # Initialize variables
     new_positions, new_velocities = [], []
     total_velocities = 0
 
     for p in particles:
 
-        # Add fake particles to represent walls
-        # TODO CHECK
-        add_wall_neighbors(p, neighbors[p.id])
-
         # Calculate total force exerted on p on the normal and tang
         # TODO check
-        force = calculate_force(p, neighbors[p.id]) + (p.mass * G)
+        force = Vector2(*forces[p.id]) + (p.mass * G)
 
         # Calculate new position and new velocity for particle
         # TODO ver lo de usar gear predictor
@@ -318,7 +335,8 @@ while True:
 
         if p.position.y >= SLIT_Y and new_position.y < SLIT_Y:
             num_fallen_particles += 1
-            flow_sliding_window.append_event("flow_n.txt", num_fallen_particles, t, "w" if num_fallen_particles == 1 else "a")
+            output.submit(flow_sliding_window.append_event, "flow_n.txt", num_fallen_particles, t,
+                          "w" if num_fallen_particles == 1 else "a")
 
         # Save new position and velocity
         new_positions.append(new_position)
@@ -329,31 +347,38 @@ while True:
     if t == 0 or t_accum >= DELTA_T_SAVE:
         if args['verbose']:
             print("Saving frame at t=%f" % t)
+            if cim.skin > 0:
+                print("Neighbor lists rebuilt %i times in %i steps" % (cim.rebuild_count, cim.update_count))
+            if cim.stats is not None:
+                print("Neighbor search: %s" % cim.stats)
+            print("Output: %s" % output)
 
         # Save particles
         colors = [(255, 255, 255)] * len(particles)  # Real particles are white
         colors += [(0, 255, 0)] * len(fake_particles)  # Fake particles are green
-        # Also save particle radius and velocity
-        extra_data = lambda particle: ("%g\t%g\t%g" % (particle.radius, particle.velocity.x, particle.velocity.y))
-        FileWriter.export_positions_ovito(particles + fake_particles, t, colors=colors, extra_data_function=extra_data,
-                                          mode="w" if t == 0 else "a", output="output.txt")
+        # Also save particle radius and velocity. Pass a snapshot of particle data, particles keep moving while the
+        # frame is written
+        saved = particles + fake_particles
+        velocities = [p.velocity for p in saved]
+        output.submit(write_positions, t, [p.id for p in saved], [p.x for p in saved], [p.y for p in saved], colors,
+                      [[p.radius for p in saved], [v.x for v in velocities], [v.y for v in velocities]])
 
         # Save Flow
         beverloo_flow = B * (DIAMETER - particle_avg_radius)**1.5
-        file = open("flow.txt", "w" if t == 0 else "a")
-        file.write("%g,%g,%g\n" % (t, num_fallen_particles/DELTA_T_SAVE, beverloo_flow))
-        file.close()
+        output.write_text("flow.txt", "%g,%g,%g\n" % (t, num_fallen_particles/DELTA_T_SAVE, beverloo_flow),
+                          "w" if t == 0 else "a")
 
         # Save kinetic energy
-        file = open("kinetic_energy.txt", "w" if t == 0 else "a")
-        file.write("%g,%g\n" % (t, 0.5*PARTICLE_MASS*NUM_PARTICLES*(total_velocities**2)))
-        file.close()
+        output.write_text("kinetic_energy.txt", "%g,%g\n" % (t, 0.5*PARTICLE_MASS*NUM_PARTICLES*(total_velocities**2)),
+                          "w" if t == 0 else "a")
 
         # Reset counter
         t_accum = 0
 
     # Evolve particles
     particles, pending_particles = evolve_particles(particles, new_positions, new_velocities, pending_particles)
+    # Recalculate neighbors, moving only the particles that changed cells (or were respawned)
+    cim.update(particles=particles)
 
     # Add delta t to total time
     t += DELTA_T
@@ -10,13 +10,17 @@ import random
 
 from euclid3 import Vector2
 
-from ss.cim.cell_index_method import CellIndexMethod
+from ss.cim.obstacles import Obstacles
+from ss.cim.sparse_cell_index_method import SparseCellIndexMethod
+from ss.cim.kd_tree import KdTree
 import ss.util.args as arg_base
-from ss.util.file_writer import FileWriter
+from ss.util.file_writer import OvitoWriter
 from ss.util.file_reader import FileReader
+from ss.util.trajectory import TrajectoryWriter
+from ss.util.background_writer import BackgroundWriter
 from ss.cim.particle import Particle
 from ss.tp05 import flow_sliding_window
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
 #TODO change descrip
 arg_base.parser.description = "Granular media simulation program. Simulates the behavior of sand-like particles " \
@@ -58,6 +62,13 @@ DIAMETER = 1.2
 DOOR_TOP = Particle(DOOR_POSITION, HEIGHT/2 + DIAMETER/2, radius=0, mass=math.inf, is_fake=True)
 DOOR_BOTTOM = Particle(DOOR_POSITION, HEIGHT/2 - DIAMETER/2, radius=0, mass=math.inf, is_fake=True)
 
+# Room walls: bottom and top (which go on past the door), left, and the wall with the door
+WALLS = Obstacles()
+WALLS.add_segment(0, 0, WIDTH, 0)
+WALLS.add_segment(0, HEIGHT, WIDTH, HEIGHT)
+WALLS.add_segment(0, 0, 0, HEIGHT)
+WALLS.add_slit(DOOR_POSITION, 0, DOOR_POSITION, HEIGHT, DOOR_BOTTOM.y, DOOR_TOP.y)
+
 # TODO: Should these be params?
 DELTA_T = 5e-2
 DELTA_T_SAVE = 1e-1
@@ -138,31 +149,6 @@ def load_particles(in_file, time=None, frame=None):
     return result
 
 
-def add_wall_neighbors(particle, dest):
-    """Add fake particles that will represent the wall particles that exert force on the particle"""
-
-    # Check if there is interaction with the bottom wall
-    if particle.y <= particle.radius:
-        fake = Particle(particle.x, 0, radius=0, mass=math.inf, is_fake=True)
-        dest.append((fake, particle.distance_to(fake)))
-
-    # Check if there is interaction with top wall
-    if particle.y + particle.radius >= HEIGHT:
-        fake = Particle(particle.x, 0, radius=0, mass=math.inf, is_fake=True)
-        dest.append((fake, particle.distance_to(fake)))
-
-    # Check if there is interaction with the left wall
-    if particle.x <= particle.radius:
-        fake = Particle(0, particle.y, radius=0, mass=math.inf, is_fake=True)
-        dest.append((fake, particle.distance_to(fake)))
-
-    # Check if there is interaction with the right wall
-    if particle.x <= DOOR_POSITION and not DOOR_BOTTOM.y <= particle.y <= DOOR_TOP.y:
-        fake = Particle(DOOR_POSITION, particle.y, radius=0, mass=math.inf, is_fake=True)
-        if particle.distance_to(fake) <= particle.radius:
-            dest.append((fake, particle.distance_to(fake)))
-
-
 def evolve_particles(particles, new_positions, new_velocities, new_radii):
     result = []
     for i in range(len(particles)):
@@ -179,28 +165,29 @@ def evolve_particles(particles, new_positions, new_velocities, new_radii):
 
 
 def target(particle):
+    """Position the particle walks to"""
     if particle.y > DOOR_TOP.y:
         if particle.x < DOOR_POSITION:
             # Above door => target top edge of door
-           return Particle(DOOR_POSITION, DOOR_TOP.y - particle.radius, radius=0, mass=math.inf, is_fake=True)
+           return Vector2(DOOR_POSITION, DOOR_TOP.y - particle.radius)
         else:
-            return Particle(WIDTH, particle.y, radius=0, mass=math.inf, is_fake=True)
+            return Vector2(WIDTH, particle.y)
     elif particle.y < DOOR_BOTTOM.y:
         if particle.x < DOOR_POSITION:
             # Below door => target bottom edge of door
-            return Particle(DOOR_POSITION, DOOR_BOTTOM.y + particle.radius, radius=0, mass=math.inf, is_fake=True)
+            return Vector2(DOOR_POSITION, DOOR_BOTTOM.y + particle.radius)
         else:
-            return Particle(WIDTH, particle.y, radius=0, mass=math.inf, is_fake=True)
+            return Vector2(WIDTH, particle.y)
     else:
         # Within door => target edge of room straight ahead
-        return Particle(WIDTH, particle.y, radius=0, is_fake=True)
+        return Vector2(WIDTH, particle.y)
 
 
 def evolve_no_contact(particle):
     # Magnitude
     new_velocity = V_D_MAX * ((particle.radius - MIN_PARTICLE_RADIUS) / (MAX_PARTICLE_RADIUS - MIN_PARTICLE_RADIUS))**BETA
     # Vector
-    new_velocity = new_velocity * particle.relative_position(target(particle)).normalize()
+    new_velocity = new_velocity * (target(particle) - particle.position).normalize()
 
     new_position = particle.position + new_velocity * DELTA_T
 
@@ -211,10 +198,14 @@ def evolve_no_contact(particle):
     return new_position, new_velocity, new_radius
 
 
-def evolve_contact(particle, others):
+def evolve_contact(particle, others, walls):
+    """Escape from the colliding particles and from the colliding walls, given as (dx, dy) from the particle's center
+    to their closest point"""
     escape_velocity = Vector2()
     for other, _ in others:
         escape_velocity += particle.relative_position(other) * -1
+    for delta_x, delta_y in walls:
+        escape_velocity -= Vector2(delta_x, delta_y)
 
     escape_velocity = escape_velocity.normalize() * V_D_MAX
     new_position = particle.position + escape_velocity * DELTA_T
@@ -235,27 +226,54 @@ particles = generate_random_particles()
 # Generate wall/corner particles
 fake_particles = generate_fake_particles()
 
+# Frames are saved with ID, position, color, radius and velocity, as Ovito text or in a binary trajectory
+positions_writer = TrajectoryWriter("output.traj") if args['binary'] else OvitoWriter("output.txt", index=True)
+write_positions = positions_writer.write_columns if args['binary'] else positions_writer.write_frame
+# Output is written in the background while the simulation goes on, see BackgroundWriter
+output = BackgroundWriter()
+
 t_accum = 0
 t = 0
 exit_times = {}
 
+# Neighbor search state is kept between steps, see ArrayCellIndexMethod#update. Pedestrians may be pushed out of the
+# room, so search with a k-d tree or a sparse grid, which accept any position. Grid cells are square, with a side that
+# fits Mx cells along the room's width and My along its height if given, or else the smallest that fits the biggest
+# radius particles grow to (radii grow in steps, so they may go past MAX_PARTICLE_RADIUS by up to one step, see
+# evolve_no_contact)
+cell_size = max(WIDTH / args['mx'] if 'mx' in args else 0, HEIGHT / args['my'] if 'my' in args else 0) \
+    or MAX_PARTICLE_RADIUS + 2 * MAX_PARTICLE_RADIUS * (1 + DELTA_T / TAU)
+
+
+def neighbor_search(particles):
+    """Builds a k-d tree or a sparse grid for the given particles, whichever is expected to be faster for how crowded
+    they are (see KdTree#best_index). Only neighbors within MIN_DISTANCE collide, read them as the closest of the
+    neighbors within MAX_PARTICLE_RADIUS."""
+    return KdTree.best_index_from_particles(particles, grid=SparseCellIndexMethod, radius=MAX_PARTICLE_RADIUS,
+                                            width=WIDTH, height=HEIGHT, cell_size=cell_size, cutoffs=[MIN_DISTANCE],
+                                            obstacles=WALLS)
+
+
+cim = neighbor_search(particles)
+
 while len(particles) > 0:
-    # Calculate all neighbors for all particles
-    neighbors = CellIndexMethod(particles, radius=MAX_PARTICLE_RADIUS, width=WIDTH, height=HEIGHT).neighbors
+    # Neighbors of all particles, calculated for the current positions
+    neighbors = cim.neighbors_within(MIN_DISTANCE)
+    # Walls each particle collides with
+    walls = defaultdict(list)
+    for particle, _, delta_x, delta_y, distance in cim.walls():
+        if distance <= MIN_DISTANCE:
+            walls[particle.id].append((delta_x, delta_y))
     # Initialize variables
     new_positions, new_velocities, new_radii = [], [], []
     total_velocities = 0
 
     for p in particles:
 
-        # Add fake particles to represent walls
-        # TODO CHECK
-        add_wall_neighbors(p, neighbors[p.id])
-        # Cell index method returns neighbors within MAX_PARTICLE_RADIUS. Keep only those within MIN_DISTANCE.
-        neighbors[p.id] = [tuple for tuple in neighbors[p.id] if tuple[1] <= MIN_DISTANCE]
-        colliding = len(neighbors[p.id]) > 0
+        colliding = len(neighbors[p.id]) > 0 or len(walls[p.id]) > 0
 
-        new_position, new_velocity, new_radius = evolve_contact(p, neighbors[p.id]) if colliding else evolve_no_contact(p)
+        new_position, new_velocity, new_radius = evolve_contact(p, neighbors[p.id], walls[p.id]) if colliding \
+            else evolve_no_contact(p)
 
         if p.position.x <= DOOR_POSITION < new_position.x:
             # Record exit time for this particle. In case this particle re-exits (because it collided right as it was exiting and was pushed behind the door), save latest time.
@@ -271,25 +289,37 @@ while len(particles) > 0:
     if t == 0 or t_accum >= DELTA_T_SAVE:
         if args['verbose']:
             print("Saving frame at t=%f" % t)
+            print("Output: %s" % output)
 
         # Save particles
         colors = [(255, 255, 255)] * len(particles)  # Real particles are white
         colors += [(0, 255, 0)] * len(fake_particles)  # Fake particles are green
-        # Also save particle radius and velocity
-        extra_data = lambda particle: ("%g\t%g\t%g" % (particle.radius, particle.velocity.x, particle.velocity.y))
-        FileWriter.export_positions_ovito(particles + fake_particles, t, colors=colors, extra_data_function=extra_data,
-                                          mode="w" if t == 0 else "a", output="output.txt")
+        # Also save particle radius and velocity. Pass a snapshot of particle data, particles keep moving while the
+        # frame is written
+        saved = particles + fake_particles
+        velocities = [p.velocity for p in saved]
+        output.submit(write_positions, t, [p.id for p in saved], [p.x for p in saved], [p.y for p in saved], colors,
+                      [[p.radius for p in saved], [v.x for v in velocities], [v.y for v in velocities]])
 
         # Reset counter
         t_accum = 0
 
     # Evolve particles
     particles = evolve_particles(particles, new_positions, new_velocities, new_radii)
+    # Recalculate neighbors (without the particles that left the room)
+    if len(particles) > 0:
+        cim.update(particles=particles)
+        # Pedestrians crowd at the door as they leave, switch to the tree (or back to the grid) when it gets faster
+        if isinstance(cim, KdTree) != KdTree.prefers_tree(cim.xs, cim.ys, cim.radii, MAX_PARTICLE_RADIUS, WIDTH,
+                                                          HEIGHT):
+            cim = neighbor_search(particles)
 
     # Add delta t to total time
     t += DELTA_T
 
 # Simulation complete
+output.close()
+positions_writer.close()
 if args['verbose']:
     print("Simulation complete, saving exit times to calculate flow...")
 
@@ -11,8 +11,27 @@ parser.add_argument("--width", "-w", help="Board side width. Decimal. If not pro
                                           "containing all particles", type=float, default=3)
 parser.add_argument("-m", help="Cells per longest side (width or height). Integer. If not provided, will calculate an"
                                "optimal value for the particles of the simulation", type=int)
+parser.add_argument("--mx", help="Cells per row (along the width). Integer. If not provided, will be derived from M if "
+                                 "given, or else calculate an optimal value for the board width", type=int)
+parser.add_argument("--my", help="Cells per column (along the height). Integer. If not provided, will be derived from M "
+                                 "if given, or else calculate an optimal value for the board height", type=int)
+parser.add_argument("--autotune", help="Choose M by ranking candidates with a cost model and timing the best ones (M = 1 "
+                                       "being brute force). Ignored if M is provided, and by simulations "
+                                       "without a bounded board (tp06)", action="store_true", default=False)
+parser.add_argument("--tuning_cache", help="Path of a JSON file where M choices of --autotune are cached per (N, L, "
+                                           "Rc, periodic) profile, so later runs reuse them")
+parser.add_argument("--skin", help="Verlet list skin distance. Decimal. If provided, neighbors are searched within the "
+                                   "interaction radius plus this distance, and searched again only when a particle "
+                                   "moves more than half of it. If not provided, neighbors are searched every step",
+                    type=float)
+parser.add_argument("--stats", help="Collect neighbor search counters and timings (cells visited, candidate and "
+                                    "accepted pairs, cell occupancy, binning and pair testing time) and print them with "
+                                    "each saved frame", action="store_true", default=False)
 parser.add_argument("--output", "-o", help="Path of output file, if the script generates an output. Defaults to "
                                            "'./output.txt'", default="./output.txt")
+parser.add_argument("--binary", help="Save frames to a binary trajectory file (see ss.util.trajectory) instead of an "
+                                     "Ovito text file, in simulations that support it. Much faster to write and read, "
+                                     "convert to Ovito text to visualize", action="store_true", default=False)
 parser.add_argument("--periodic", "-p", help="Make the board periodic (particles that go \"out of board\" come in from"
                                              "the other side)", action="store_true", default=False)
 parser.add_argument("--verbose", "-v", help="Print verbose information while running", action="store_true",
@@ -0,0 +1,123 @@
+import atexit
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class BackgroundWriter:
+    """Runs output (frames, energies, flow...) in a background thread, so simulations keep computing while it's
+    formatted and written. Writes are queued and run one at a time in the order they were submitted. The queue is
+    bounded: when the thread falls behind, #submit waits for room (the time spent waiting is added up in
+    `blocked_time`) instead of piling up frames in memory.
+
+    Pending writes are finished on #close, which is also called on exit (including exits caused by an exception). If a
+    write fails, later writes are skipped and the error is raised by the next #submit, #flush or #close."""
+
+    def __init__(self, max_pending=8):
+        """
+        :arg max_pending : Max writes waiting in the queue. Defaults to 8.
+        """
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.blocked_time = 0.0     # Seconds spent waiting for room in the queue
+        self.write_time = 0.0       # Seconds spent writing, in the background thread
+        self.write_count = 0
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="BackgroundWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, function, *args, **kwargs):
+        """Queues a call to function(*args, **kwargs), to run after every call submitted before it. The arguments
+        must not change after they are submitted, so pass a snapshot (e.g. lists of values, or #snapshot of arrays)
+        instead of objects the simulation keeps updating, such as Particles."""
+
+        if self.closed:
+            raise Exception("Background writer is closed")
+        self.check_error()
+        start = time.perf_counter()
+        self.queue.put((function, args, kwargs))
+        self.blocked_time += time.perf_counter() - start
+
+    def write_text(self, output, text, mode='a'):
+        """Queues writing text to a file, opening and closing it like simulations do for observables."""
+
+        self.submit(self.write_file, output, text, mode)
+
+    @staticmethod
+    def write_file(output, text, mode):
+        with open(output, mode) as file:
+            file.write(text)
+
+    @staticmethod
+    def snapshot(*arrays):
+        """Read-only copies of the given arrays, safe to submit while the originals keep changing."""
+
+        result = []
+        for array in arrays:
+            copy = np.array(array)
+            copy.flags.writeable = False
+            result.append(copy)
+        return result[0] if len(result) == 1 else result
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                function, args, kwargs = item
+                if self.error is None:
+                    start = time.perf_counter()
+                    try:
+                        function(*args, **kwargs)
+                    except BaseException as e:
+                        self.error = e
+                    self.write_time += time.perf_counter() - start
+                    self.write_count += 1
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            raise Exception("Background write failed: %s" % self.error) from self.error
+
+    def flush(self):
+        """Waits until every submitted write is done."""
+
+        start = time.perf_counter()
+        self.queue.join()
+        self.blocked_time += time.perf_counter() - start
+        self.check_error()
+
+    def close(self):
+        """Finishes pending writes and stops the background thread. Does nothing if already closed."""
+
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        start = time.perf_counter()
+        self.queue.put(None)
+        self.thread.join()
+        self.blocked_time += time.perf_counter() - start
+        self.check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, *_):
+        if exception_type is None:
+            self.close()
+        else:
+            # Keep the original exception, writes done so far are still finished
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def __str__(self):
+        return "%i writes, %.4fs writing in the background, %.4fs blocked waiting for the writer" \
+               % (self.write_count, self.write_time, self.blocked_time)
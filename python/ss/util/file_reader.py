@@ -1,5 +1,12 @@
+import os
 import re
+from collections import deque
+from itertools import islice
+
+import numpy as np
+
 from ss.cim.particle import Particle
+from ss.util.ovito_index import OvitoIndex
 
 
 class FileReader:
@@ -48,7 +55,8 @@ class FileReader:
     @staticmethod
     def import_positions_ovito(input, time=None, frame=None):
         """Import particles and their properties from a given input file. File should be one generated by
-        FileWriter#export_positions_ovito
+        FileWriter#export_positions_ovito. Frames are found through an index of the file (see OvitoIndex), so only the
+        requested frame is parsed.
 
         :arg time : float
                 Time at which to capture particles. If None (default), will get first frame.
@@ -70,55 +78,73 @@ class FileReader:
                 time = -1
                 seek_to_last = True
 
-        file = open(input, 'r')
-        base_data, properties = [], []
-
-        matched = False
-        seek_frame = 1
-        while not matched:
-            test = file.readline()
-            if test == "":
-                # Reached EOF
-                if seek_to_last:
-                    break
-                else:
-                    raise Exception("Could not find specified time and/or frame in file")
-
-            num_particles = int(test)
-            seek_time = float(file.readline())
-
-            if frame is None and time is None:
-                # Match first frame
-                matched = True
-            elif seek_time == time:
-                if frame is not None and seek_time != frame:
-                    raise Exception("Frame #%i matches time %g, not the specified time %g. Aborting" % (seek_frame, seek_time, time))
-                else:
-                    matched = True
-            elif seek_frame == frame:
-                if time is not None and seek_time != time:
-                    raise Exception("Frame #%i matches time %g, not the specified time %g. Aborting" % (seek_frame, seek_time, time))
-                else:
-                    matched = True
-            elif seek_to_last:
-                # Match every frame, we will return the last one we captured
-                matched = True
-                # Reset data so we don't return the whole file
-                base_data, properties = [], []
+        # Seek straight to the frame. Without an index, the last frame is found reading backwards from the end of the
+        # file, and any other frame by indexing the file (once, the index is saved next to it)
+        last = OvitoIndex.last_frame_offset(input) \
+            if seek_to_last and not os.path.exists(OvitoIndex.path(input)) else None
+        if last is not None:
+            offset, num_particles = last
+        else:
+            index = OvitoIndex.load(input)
+            if seek_to_last and len(index) == 0:
+                return [], []
+            record = index.records[index.find(time=time, frame=frame)]
+            offset, num_particles = int(record['offset']), int(record['count'])
 
+        base_data, properties = [], []
+        with open(input, 'rb') as file:
+            file.seek(offset)
+            file.readline()     # Number of particles
+            file.readline()     # Time
             for i in range(num_particles):
-                line = file.readline().strip()
-                if matched:
-                    # 1st value is ID, 2nd is X, 3rd is Y, all the remaining ones are properties; convert all to floats
-                    id, x, y, *remainder = map(float, re.split("[ \t]+", line))
-                    base_data.append((int(id), x, y))
-                    properties.append(tuple(remainder))
-
-            if seek_to_last:
-                # Keep seeking more frames, finish on EOF
-                matched = False
-
-            seek_frame += 1
+                # 1st value is ID, 2nd is X, 3rd is Y, all the remaining ones are properties; convert all to floats
+                id, x, y, *remainder = map(float, re.split("[ \t]+", file.readline().decode().strip()))
+                base_data.append((int(id), x, y))
+                properties.append(tuple(remainder))
 
-        file.close()
         return base_data, properties
+
+    @staticmethod
+    def iterate_positions_ovito(input, columns=None, stride=1, start_time=None, end_time=None):
+        """Yields the frames of a file generated by FileWriter#export_positions_ovito (or OvitoWriter) one at a time, in
+        a single pass over the file, so only one frame is in memory at a time. Frames are parsed as a whole into NumPy
+        arrays, and frames that aren't wanted are skipped without parsing them. An incomplete last frame (e.g. one being
+        written) is ignored.
+
+        :arg columns : (Optional) list of columns to get, counting from 0: 0 is ID, 1 and 2 are X and Y, then color (3
+                       to 5) and any extra data. Defaults to all of them.
+        :arg stride : Yield 1 in every `stride` frames (within the time window). Defaults to 1, every frame.
+        :arg start_time : (Optional) Skip frames before this time.
+        :arg end_time : (Optional) Skip frames after this time.
+        :return Generator of (t, data) tuples, data being an N x (number of columns) array of floats"""
+
+        if stride < 1:
+            raise Exception("Invalid stride %i, must be at least 1" % stride)
+
+        matched = 0
+        with open(input, 'r') as file:
+            while True:
+                header = file.readline()
+                if not header.strip():
+                    return
+                num_particles = int(header)
+                time = file.readline()
+                if not time.endswith('\n'):
+                    return
+                t = float(time)
+
+                wanted = (start_time is None or t >= start_time) and (end_time is None or t <= end_time)
+                if wanted:
+                    wanted = matched % stride == 0
+                    matched += 1
+                if not wanted:
+                    deque(islice(file, num_particles), maxlen=0)
+                    continue
+
+                lines = list(islice(file, num_particles))
+                if len(lines) < num_particles or (lines and not lines[-1].endswith('\n')):
+                    return
+                if num_particles == 0:
+                    yield t, np.zeros((0, len(columns) if columns is not None else 0))
+                else:
+                    yield t, np.loadtxt(lines, ndmin=2, usecols=columns)
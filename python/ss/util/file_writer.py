@@ -1,4 +1,10 @@
 import datetime
+import os
+from itertools import chain
+
+import numpy as np
+
+from ss.util.ovito_index import OvitoIndex
 
 
 class FileWriter:
@@ -39,37 +45,120 @@ class FileWriter:
         # Set custom axis values to match cells
         file.write('ax = gca;\n')
         file.write('ax.XLim = [0 %g]; ax.YLim = [0 %g];\n' % (board.width, board.height))
-        file.write('ax.XTick = [0:%g:%g]; ax.YTick = [0:%g:%g];\n' % ((board.width / board.m), board.width,
-                                                                      (board.height / board.m), board.height))
+        file.write('ax.XTick = [0:%g:%g]; ax.YTick = [0:%g:%g];\n' % ((board.width / board.mx), board.width,
+                                                                      (board.height / board.my), board.height))
         file.write('grid on;\n')
         file.close()
 
     @staticmethod
     def export_positions_ovito(particles, t=0, colors=None, extra_data_function=None, output='output.txt', mode="w"):
-        if colors is not None and len(colors) != len(particles):
-            raise Exception('Colors length (%i) doesn\'t match particles length (%i), can\'t write Ovito file.'
-                            % (len(colors), len(particles)))
+        """Writes a single frame, see OvitoWriter. Simulations that save many frames should keep an OvitoWriter
+        instead, which doesn't reopen the file and takes extra data as columns instead of a function."""
 
-        file = open(output, mode)
-        file.write('%i\n' % len(particles))
-        file.write('%g\n' % t)
-        for i in range(len(particles)):
-            particle = particles[i]
-            file.write('%i\t%g\t%g' % (particle.id, particle.x, particle.y))
-            # Write colors if present, else white
-            r, g, b = colors[i] if colors is not None else (255, 255, 255)
-            file.write('\t%g\t%g\t%g' % (r, g, b))
-            # Write any extra data, if specified
-            if extra_data_function is not None:
-                file.write("\t")
-                file.write(extra_data_function(particle))
-
-            file.write('\n')
-
-        file.close()
+        extra = None if extra_data_function is None else [[extra_data_function(particle) for particle in particles]]
+        with OvitoWriter(output, mode) as writer:
+            writer.write_particles(particles, t, colors=colors, extra=extra, extra_format='%s')
 
     @staticmethod
     def export_tuple(tuple, output='%s_va.txt' % datetime.datetime.now().isoformat(), mode="w"):
         file = open(output, mode)
         file.write("%i\t%g\n" % tuple)
         file.close()
+
+
+class OvitoWriter:
+    """Writes frames to an Ovito-compatible file, keeping it open between frames. Each frame has the number of
+    particles, the time, and then a line per particle with its ID, X, Y, color (r, g, b) and any extra data, separated by
+    tabs. Whole frames are formatted at once from columns of data and written with a single call."""
+
+    # Color of particles when colors aren't given
+    WHITE = '\t255\t255\t255'
+
+    def __init__(self, output='output.txt', mode='w', index=False):
+        """
+        :arg output : Path of the file to write.
+        :arg mode : 'w' to create (or overwrite) the file, 'a' to add frames to it.
+        :arg index : Whether to keep an index of the frames next to the file as they are written (see OvitoIndex), so
+                     readers can seek straight to any frame. Defaults to False.
+        """
+        self.output = output
+        self.index = None
+        if index:
+            if mode == 'a' and os.path.exists(output):
+                self.index = OvitoIndex.load(output)
+            else:
+                self.index = OvitoIndex(output)
+                self.index.save()
+        elif mode == 'w' and os.path.exists(OvitoIndex.path(output)):
+            # An index of a previous file would be rebuilt when read, but there's no use in keeping it around
+            os.remove(OvitoIndex.path(output))
+        self.file = open(output, mode)
+
+    def write_frame(self, t, ids, xs, ys, colors=None, extra=None, extra_format=None):
+        """Writes a frame. Columns may be lists or NumPy arrays.
+
+        :arg ids : IDs of the particles.
+        :arg xs : X coordinates of the particles.
+        :arg ys : Y coordinates of the particles.
+        :arg colors : (Optional) (r, g, b) color of each particle, as a list of tuples or an Nx3 array. Defaults to
+                      white.
+        :arg extra : (Optional) list of columns of extra data, written after colors.
+        :arg extra_format : (Optional) Format of the extra data of a particle, e.g. '%g\t%.3f'. Defaults to '%g' for
+                            each extra column, separated by tabs.
+        """
+        if colors is not None and len(colors) != len(ids):
+            raise Exception('Colors length (%i) doesn\'t match particles length (%i), can\'t write Ovito file.'
+                            % (len(colors), len(ids)))
+
+        columns = [self.to_list(ids), self.to_list(xs), self.to_list(ys)]
+        line = '%i\t%g\t%g'
+        if colors is None:
+            line += self.WHITE
+        else:
+            columns += list(zip(*self.to_list(colors))) if len(colors) > 0 else [[], [], []]
+            line += '\t%g\t%g\t%g'
+        if extra:
+            columns += [self.to_list(column) for column in extra]
+            line += '\t' + (extra_format if extra_format is not None else '\t'.join(['%g'] * len(extra)))
+        line += '\n'
+
+        values = tuple(chain.from_iterable(zip(*columns)))
+        header = '%i\n%g\n' % (len(ids), t)
+        if self.index is None:
+            self.file.write(header + (line * len(ids)) % values)
+            self.file.flush()
+        else:
+            offset = self.file.tell()
+            self.file.write(header + (line * len(ids)) % values)
+            self.file.flush()
+            # Index the time as written, which is what readers will compare to
+            self.index.append(float(header.split()[1]), offset, len(ids))
+
+    def write_particles(self, particles, t=0, colors=None, extra=None, extra_format=None):
+        """Writes a frame with the given particles, see #write_frame."""
+
+        self.write_frame(t, [p.id for p in particles], [p.x for p in particles], [p.y for p in particles],
+                         colors=colors, extra=extra, extra_format=extra_format)
+
+    def write_system(self, system, t=0, colors=None, extra=None, extra_format=None):
+        """Writes a frame with the particles of a ParticleSystem, straight from its arrays. Particles are written in
+        insertion order (see ParticleSystem#order), which is also the order of colors and extra columns, see
+        #write_frame."""
+
+        order = system.order
+        self.write_frame(t, system.ids[order], system.xs[order], system.ys[order], colors=colors, extra=extra,
+                         extra_format=extra_format)
+
+    @staticmethod
+    def to_list(column):
+        """Converts NumPy arrays to lists of Python numbers, so they are formatted like Python numbers."""
+        return column.tolist() if isinstance(column, np.ndarray) else column
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,167 @@
+import os
+from collections import deque
+from itertools import islice
+
+import numpy as np
+
+
+class OvitoIndex:
+    """Index of the frames of an Ovito file (see OvitoWriter), kept in a sidecar file next to it (`<file>.idx`) so
+    readers can seek straight to a frame instead of parsing every frame before it. Each frame has a record with its
+    time, the byte offset where it starts and its number of particles; the frame number is the record's position.
+
+    Indexes are written by OvitoWriter as it goes (with `index=True`), or built with a single scan that skips particle
+    lines without parsing them. Frames appended to a file after its index was written are indexed when it's loaded, and
+    an index that doesn't match its file (e.g. the file was written again) is built again."""
+
+    RECORD = np.dtype([('time', '<f8'), ('offset', '<i8'), ('count', '<i8')])
+
+    # Bytes read at a time when looking for the last frame from the end of a file
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, input, records=None):
+        self.input = input
+        self.records = np.zeros(0, dtype=self.RECORD) if records is None else records
+
+    @staticmethod
+    def path(input):
+        return input + '.idx'
+
+    @classmethod
+    def load(cls, input, save=True):
+        """Loads the index of the given file, building it or bringing it up to date with the file if needed.
+
+        :arg save : Whether to save the index if it had to be built or updated. Failing to save it isn't an error (e.g.
+                    the file's directory may be read only)."""
+
+        index = cls(input)
+        if os.path.exists(cls.path(input)):
+            index.records = np.fromfile(cls.path(input), dtype=cls.RECORD)
+        if not index.valid():
+            index.records = np.zeros(0, dtype=cls.RECORD)
+
+        count = len(index.records)
+        index.scan()
+        if save and len(index.records) != count:
+            try:
+                index.save()
+            except OSError:
+                pass
+        return index
+
+    def valid(self):
+        """Whether the frame headers at the indexed offsets match the index. Checks the first and last frames."""
+
+        if len(self.records) == 0:
+            return True
+        if self.records['offset'][-1] >= os.path.getsize(self.input):
+            return False
+        with open(self.input, 'rb') as file:
+            for record in (self.records[0], self.records[-1]):
+                file.seek(int(record['offset']))
+                try:
+                    if int(file.readline()) != record['count'] or float(file.readline()) != record['time']:
+                        return False
+                except ValueError:
+                    return False
+        return True
+
+    def scan(self):
+        """Indexes the frames after the last indexed one, reading only frame headers. An incomplete last frame (e.g. one
+        being written) isn't indexed."""
+
+        records = self.records.tolist()
+        with open(self.input, 'rb') as file:
+            if records:
+                _, offset, count = records.pop()
+                file.seek(offset)
+            while True:
+                offset = file.tell()
+                header = file.readline()
+                if not header.strip():
+                    break
+                count = int(header)
+                time = file.readline()
+                if not time.endswith(b'\n'):
+                    break
+                if count > 0:
+                    # Skip particle lines in bulk, without splitting them
+                    deque(islice(file, count - 1), maxlen=0)
+                    if not file.readline().endswith(b'\n'):
+                        break
+                records.append((float(time), offset, count))
+        self.records = np.array(records, dtype=self.RECORD)
+
+    def save(self):
+        self.records.tofile(self.path(self.input))
+
+    def append(self, time, offset, count):
+        """Adds a frame to the index, and to its sidecar file."""
+
+        record = np.array([(time, offset, count)], dtype=self.RECORD)
+        self.records = np.concatenate((self.records, record))
+        with open(self.path(self.input), 'ab') as file:
+            record.tofile(file)
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, time=None, frame=None):
+        """Position of the frame with the given time and/or number (counting from 1; -1 is the last frame). With neither,
+        the first frame."""
+
+        if len(self.records) == 0:
+            raise Exception("Could not find specified time and/or frame in file")
+        if frame == -1 or time == -1:
+            return len(self.records) - 1
+        if frame is not None:
+            if not 1 <= frame <= len(self.records):
+                raise Exception("Could not find specified time and/or frame in file")
+            k = frame - 1
+            if time is not None and self.records['time'][k] != time:
+                raise Exception("Frame #%i matches time %g, not the specified time %g. Aborting"
+                                % (frame, self.records['time'][k], time))
+            return k
+        if time is not None:
+            matches = np.flatnonzero(self.records['time'] == time)
+            if len(matches) == 0:
+                raise Exception("Could not find specified time and/or frame in file")
+            return int(matches[0])
+        return 0
+
+    @classmethod
+    def last_frame_offset(cls, input):
+        """Finds where the last frame of a file starts by reading it backwards, without an index. Frame headers (count
+        and time) are the only lines without tabs, since particle lines have at least ID, X and Y.
+
+        :return (offset, count), or None if the last frame is incomplete or can't be found"""
+
+        with open(input, 'rb') as file:
+            end = os.path.getsize(input)
+            data, block = b'', cls.BLOCK_SIZE
+            while end > 0:
+                start = max(0, end - block)
+                file.seek(start)
+                data = file.read(end - start) + data
+                # Read twice as much each time, so big frames don't take many passes over the data
+                end, block = start, block * 2
+                lines = data.split(b'\n')
+                if lines and lines[-1] == b'':
+                    lines.pop()
+                # The first line may be cut in half unless this is the start of the file
+                first = 0 if start == 0 else 1
+                for q in range(len(lines) - 1, first, -1):
+                    if b'\t' not in lines[q]:
+                        # Time line found, the count line is right before it
+                        if b'\t' in lines[q - 1]:
+                            return None
+                        try:
+                            count = int(lines[q - 1])
+                        except ValueError:
+                            return None
+                        if count != len(lines) - q - 1:
+                            return None
+                        return start + sum(len(line) + 1 for line in lines[:q - 1]), count
+                if start == 0:
+                    return None
+        return None
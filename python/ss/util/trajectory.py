@@ -0,0 +1,255 @@
+"""Binary trajectory files: a header with the column schema of particle rows, followed by frames, each one being its
+time and number of particles (see Trajectory.FRAME_HEADER) and then a block of fixed-width rows. Much smaller and faster
+to write than Ovito text files, and frames are read straight from a memory map without parsing. Convert to Ovito text
+only to visualize, with TrajectoryReader#to_ovito or by running this module."""
+
+import json
+import os
+
+import numpy as np
+
+
+class Trajectory:
+    """Layout of binary trajectory files"""
+
+    MAGIC = b'SSTRAJ\x00\x01'
+    # Time and particle count of each frame
+    FRAME_HEADER = np.dtype([('t', '<f8'), ('n', '<u8')])
+    # Default columns, in the same order as Ovito files written by simulations: ID, position, color, radius and velocity
+    COLUMNS = ('id', 'x', 'y', 'red', 'green', 'blue', 'radius', 'vx', 'vy')
+    # Types of columns that aren't floats, which use the file's precision
+    COLUMN_TYPES = {'id': '<i8', 'red': 'u1', 'green': 'u1', 'blue': 'u1'}
+    # Value of columns missing from a frame; colors default to white like in FileWriter#export_positions_ovito
+    DEFAULTS = {'red': 255, 'green': 255, 'blue': 255}
+
+    @classmethod
+    def row_dtype(cls, columns, precision='float64'):
+        """Type of the rows with the given columns, floats being 'float32' or 'float64'."""
+
+        if precision not in ('float32', 'float64'):
+            raise Exception("Invalid precision '%s', must be float32 or float64" % precision)
+        float_type = '<f4' if precision == 'float32' else '<f8'
+        return np.dtype([(name, cls.COLUMN_TYPES.get(name, float_type)) for name in columns])
+
+    @classmethod
+    def header(cls, dtype):
+        """Bytes of the file header for rows of the given type. Padded so frames start 8-byte aligned."""
+
+        schema = json.dumps({'columns': [[name, dtype.fields[name][0].str] for name in dtype.names]}).encode()
+        schema += b' ' * (-(len(cls.MAGIC) + 4 + len(schema)) % 8)
+        return cls.MAGIC + np.uint32(len(schema)).tobytes() + schema
+
+    @classmethod
+    def parse_header(cls, data):
+        """Parses the header at the start of the given bytes.
+
+        :return (row dtype, size of the header in bytes)"""
+
+        if bytes(data[:len(cls.MAGIC)]) != cls.MAGIC:
+            raise Exception("Not a binary trajectory file, or unsupported version")
+        start = len(cls.MAGIC) + 4
+        length = int(np.frombuffer(bytes(data[len(cls.MAGIC):start]), dtype='<u4')[0])
+        schema = json.loads(bytes(data[start:start + length]).decode())
+        return np.dtype([(name, type) for name, type in schema['columns']]), start + length
+
+
+class TrajectoryWriter:
+    """Writes frames to a binary trajectory file. Each frame is flushed as it's written, so files can be read while a
+    simulation runs and keep every complete frame if it's interrupted."""
+
+    def __init__(self, output='output.traj', columns=Trajectory.COLUMNS, precision='float64', mode='w'):
+        """
+        :arg output : Path of the file to write.
+        :arg columns : Names of the columns of each row. Defaults to Trajectory.COLUMNS.
+        :arg precision : 'float64' (default) or 'float32', type of float columns.
+        :arg mode : 'w' to create (or overwrite) the file, 'a' to add frames to an existing file, whose columns must be
+                    the same.
+        """
+        self.dtype = Trajectory.row_dtype(columns, precision)
+        self.output = output
+        if mode == 'a' and os.path.exists(output) and os.path.getsize(output) > 0:
+            with open(output, 'rb') as file:
+                start = file.read(len(Trajectory.MAGIC) + 4)
+                dtype, _ = Trajectory.parse_header(start + file.read(int(np.frombuffer(start[-4:], dtype='<u4')[0])))
+            if dtype != self.dtype:
+                raise Exception("Can't append to %s, its columns (%s) don't match (%s)" % (output, dtype, self.dtype))
+            self.file = open(output, 'ab')
+        elif mode in ('w', 'a'):
+            self.file = open(output, 'wb')
+            self.file.write(Trajectory.header(self.dtype))
+        else:
+            raise Exception("Invalid mode '%s', must be 'w' or 'a'" % mode)
+
+    def write_frame(self, t, **columns):
+        """Writes a frame with the given arrays (or sequences) for each column, all of the same length. Missing columns
+        are filled with Trajectory.DEFAULTS, or 0."""
+
+        unknown = set(columns) - set(self.dtype.names)
+        if unknown:
+            raise Exception("Unknown columns %s, file columns are %s" % (sorted(unknown), self.dtype.names))
+        n = len(next(iter(columns.values()))) if columns else 0
+        rows = np.empty(n, dtype=self.dtype)
+        for name in self.dtype.names:
+            rows[name] = columns[name] if name in columns else Trajectory.DEFAULTS.get(name, 0)
+
+        self.file.write(np.array((t, n), dtype=Trajectory.FRAME_HEADER).tobytes())
+        self.file.write(rows.tobytes())
+        self.file.flush()
+
+    def write_columns(self, t, ids, xs, ys, colors=None, extra=None):
+        """Writes a frame taking the same arguments as OvitoWriter#write_frame: extra columns are the columns of the
+        file after id, x, y and colors, in order."""
+
+        columns = {'id': ids, 'x': xs, 'y': ys}
+        if colors is not None:
+            colors = np.asarray(colors).reshape(-1, 3)
+            columns.update(red=colors[:, 0], green=colors[:, 1], blue=colors[:, 2])
+        names = [name for name in self.dtype.names if name not in ('id', 'x', 'y', 'red', 'green', 'blue')]
+        if extra is not None and len(extra) > len(names):
+            raise Exception("Got %i extra columns, file has %i (%s)" % (len(extra), len(names), names))
+        columns.update(zip(names, extra or []))
+        self.write_frame(t, **columns)
+
+    def write_particles(self, particles, t=0, colors=None):
+        """Writes a frame with the given particles, like FileWriter#export_positions_ovito. Radius and velocity are
+        written if they are columns of the file.
+
+        :arg colors : (Optional) list of (r, g, b) colors for each particle. Defaults to white."""
+
+        if colors is not None and len(colors) != len(particles):
+            raise Exception('Colors length (%i) doesn\'t match particles length (%i), can\'t write trajectory.'
+                            % (len(colors), len(particles)))
+        columns = {'id': [p.id for p in particles], 'x': [p.x for p in particles], 'y': [p.y for p in particles]}
+        if colors is not None:
+            colors = np.asarray(colors).reshape(-1, 3)
+            columns.update(red=colors[:, 0], green=colors[:, 1], blue=colors[:, 2])
+        if 'radius' in self.dtype.names:
+            columns['radius'] = [p.radius for p in particles]
+        if 'vx' in self.dtype.names or 'vy' in self.dtype.names:
+            velocities = [p.velocity for p in particles]
+            columns.update(vx=[v.x for v in velocities], vy=[v.y for v in velocities])
+        self.write_frame(t, **{name: values for name, values in columns.items() if name in self.dtype.names})
+
+    def write_system(self, system, t=0, colors=None):
+        """Writes a frame with the particles of a ParticleSystem, straight from its arrays, like #write_particles.
+        Particles are written in insertion order (see ParticleSystem#order), which is also the order of colors."""
+
+        order = system.order
+        columns = {'id': system.ids[order], 'x': system.xs[order], 'y': system.ys[order],
+                   'radius': system.radii[order], 'vx': system.velocities[order, 0], 'vy': system.velocities[order, 1]}
+        if colors is not None:
+            colors = np.asarray(colors).reshape(-1, 3)
+            columns.update(red=colors[:, 0], green=colors[:, 1], blue=colors[:, 2])
+        self.write_frame(t, **{name: values for name, values in columns.items() if name in self.dtype.names})
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class TrajectoryReader:
+    """Reads frames of a binary trajectory file through a memory map: frames are NumPy structured arrays viewing the
+    file, with a field for each column (e.g. `frame['x']`), and are only read from disk when accessed. An incomplete last
+    frame (e.g. one being written) is ignored."""
+
+    def __init__(self, input):
+        self.input = input
+        self.data = np.memmap(input, dtype=np.uint8, mode='r')
+        self.dtype, self.header_size = Trajectory.parse_header(self.data)
+        self.offsets, self.times, self.counts = self.scan()
+
+    def scan(self):
+        """Finds where each frame starts by jumping from frame header to frame header, without reading rows.
+
+        :return (offsets, times, counts) arrays, with the position of the rows, time and particle count of each frame"""
+
+        offsets, times, counts = [], [], []
+        position, size = self.header_size, len(self.data)
+        while position + Trajectory.FRAME_HEADER.itemsize <= size:
+            t, n = self.data[position:position + Trajectory.FRAME_HEADER.itemsize].view(Trajectory.FRAME_HEADER)[0]
+            start = position + Trajectory.FRAME_HEADER.itemsize
+            if start + int(n) * self.dtype.itemsize > size:
+                break
+            offsets.append(start)
+            times.append(t)
+            counts.append(int(n))
+            position = start + int(n) * self.dtype.itemsize
+        return np.array(offsets, dtype=np.int64), np.array(times, dtype=np.float64), np.array(counts, dtype=np.int64)
+
+    @property
+    def columns(self):
+        return self.dtype.names
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def frame(self, k):
+        """Rows of frame k (counting from 0; negative numbers count from the end), as a structured array viewing the
+        file."""
+
+        if not -len(self) <= k < len(self):
+            raise Exception("Frame %i not found, file has %i frames" % (k, len(self)))
+        start = int(self.offsets[k])
+        return self.data[start:start + int(self.counts[k]) * self.dtype.itemsize].view(self.dtype)
+
+    def frame_at(self, time):
+        """Rows of the first frame at the given time."""
+
+        matches = np.flatnonzero(self.times == time)
+        if len(matches) == 0:
+            raise Exception("Could not find time %g in file" % time)
+        return self.frame(int(matches[0]))
+
+    def iterate(self, columns=None, stride=1, start_time=None, end_time=None):
+        """Yields frames one at a time, like FileReader#iterate_positions_ovito. Frames view the file, so only the rows
+        that are used are read from disk.
+
+        :arg columns : (Optional) list of column names to get. Defaults to all of them.
+        :arg stride : Yield 1 in every `stride` frames (within the time window). Defaults to 1, every frame.
+        :arg start_time : (Optional) Skip frames before this time.
+        :arg end_time : (Optional) Skip frames after this time.
+        :return Generator of (t, rows) tuples, rows being a structured array like #frame"""
+
+        if stride < 1:
+            raise Exception("Invalid stride %i, must be at least 1" % stride)
+        wanted = np.ones(len(self), dtype=bool)
+        if start_time is not None:
+            wanted &= self.times >= start_time
+        if end_time is not None:
+            wanted &= self.times <= end_time
+        for k in np.flatnonzero(wanted)[::stride]:
+            rows = self.frame(int(k))
+            yield float(self.times[k]), rows if columns is None else rows[list(columns)]
+
+    def to_ovito(self, output='output.txt', frames=None):
+        """Writes frames in the Ovito text format of FileWriter#export_positions_ovito: ID, X, Y and color, followed by
+        any other columns as extra data.
+
+        :arg frames : (Optional) iterable of frame numbers to write. Defaults to all of them."""
+
+        extra = [name for name in self.dtype.names if name not in ('id', 'x', 'y', 'red', 'green', 'blue')]
+        with open(output, 'w') as file:
+            for k in range(len(self)) if frames is None else frames:
+                rows = self.frame(k)
+                file.write('%i\n' % len(rows))
+                file.write('%g\n' % self.times[k])
+                columns = [rows[name].tolist() if name in self.dtype.names else [Trajectory.DEFAULTS[name]] * len(rows)
+                           for name in ('id', 'x', 'y', 'red', 'green', 'blue')]
+                columns += [rows[name].tolist() for name in extra]
+                line = '%i\t%g\t%g\t%g\t%g\t%g' + '\t%g' * len(extra) + '\n'
+                for values in zip(*columns):
+                    file.write(line % values)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a binary trajectory file to an Ovito text file")
+    parser.add_argument("input", help="Binary trajectory file", type=str)
+    parser.add_argument("output", help="Ovito file to write", type=str)
+    args = parser.parse_args()
+    TrajectoryReader(args.input).to_ovito(args.output)